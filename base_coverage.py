@@ -1,6 +1,10 @@
+import collections
 import json
+import os
+import sys
 import time
 
+import numpy
 import pysam
 from lookups import IntervalSet
 from utils import Xpos
@@ -8,40 +12,87 @@ from utils import Xpos
 
 class CoverageHandler(object):
     '''contains coverage (at multiple binning levels) for all chroms'''
-    def __init__(self, coverage_files):
+    def __init__(self, coverage_files, cache_size_bytes=0):
         self._single_chrom_coverage_handlers = {}
+        self._cache = CoverageWindowCache(cache_size_bytes) if cache_size_bytes > 0 else None
         for cf in coverage_files:
-            coverage_file = CoverageFile(cf['path'], cf.get('binned',False))
+            if cf['path'].endswith('.npy'): coverage_file = NumpyCoverageFile(cf['path'], cf.get('binned',False))
+            else: coverage_file = CoverageFile(cf['path'], cf.get('binned',False))
             for chrom in coverage_file.get_chroms():
                 if chrom not in self._single_chrom_coverage_handlers:
-                    self._single_chrom_coverage_handlers[chrom] = SingleChromCoverageHandler(chrom)
-                self._single_chrom_coverage_handlers[chrom].add_coverage_file(coverage_file, cf.get('bp-min-length',0))
-    def get_coverage_for_intervalset(self, intervalset):
+                    self._single_chrom_coverage_handlers[chrom] = SingleChromCoverageHandler(chrom, self._cache)
+                if 'bin-size' in cf: self._single_chrom_coverage_handlers[chrom].add_pyramid_level(coverage_file, cf['bin-size'])
+                else: self._single_chrom_coverage_handlers[chrom].add_coverage_file(coverage_file, cf.get('bp-min-length',0))
+    def get_coverage_for_intervalset(self, intervalset, max_bins=None):
+        '''if `max_bins` is given, returns at most that many bins (as long as a coarse enough pyramid level exists)'''
         st = time.time()
         try: single_chrom_coverage_handler = self._single_chrom_coverage_handlers[intervalset.chrom]
         except KeyError: print 'Warning: No coverage for chrom', intervalset.chrom; return []
-        coverage = []
-        intervalset_length = intervalset.get_length()
-        for pair in intervalset.to_obj()['list_of_pairs']:
-            coverage.extend(single_chrom_coverage_handler.get_coverage_for_range(pair[0], pair[1], length=intervalset_length))
+        pairs = intervalset.to_obj()['list_of_pairs']
+        if max_bins is not None and intervalset.get_length() > max_bins:
+            coverage = single_chrom_coverage_handler.get_binned_coverage_for_ranges(pairs, max_bins)
+        else:
+            coverage = single_chrom_coverage_handler.get_coverage_for_ranges(pairs, length=intervalset.get_length())
         print '## COVERAGE: spent {:.3f} seconds tabixing {} coverage bins'.format(time.time()-st, len(coverage))
         return coverage
+    def get_cache_stats(self):
+        return self._cache.get_stats() if self._cache is not None else None
 
 class SingleChromCoverageHandler(object):
     '''contains coverage (at multiple binning levels) for one chrom'''
-    def __init__(self, chrom):
+    # decoded coverage is cached in windows of `WINDOW_SIZE` bases aligned to multiples of `WINDOW_SIZE`,
+    # so that overlapping queries (e.g. a variant and the region around it) share the same windows.
+    WINDOW_SIZE = 1024
+    def __init__(self, chrom, cache=None):
         self._chrom = chrom
         self._coverage_files = []
+        self._pyramid_levels = [] # coverage binned into fixed power-of-two sized bins (see data/base_coverage/pyramid_coverage.py)
+        self._cache = cache
     def add_coverage_file(self, coverage_file, min_length_in_bases):
         self._coverage_files.append({'coverage_file':coverage_file, 'bp-min-length':min_length_in_bases})
-        self._coverage_files.sort(key=lambda d:d['bp-min-length'])
+        # when a .npy and a .json.gz file cover the same `bp-min-length`, the .npy one sorts last and wins
+        self._coverage_files.sort(key=lambda d:(d['bp-min-length'], isinstance(d['coverage_file'], NumpyCoverageFile)))
+    def _get_coverage_file(self, length):
+        assert len(self._coverage_files) >= 1, (self._chrom, length, self._coverage_files, str(self))
+        assert self._coverage_files[0]['bp-min-length'] <= length, (self._chrom, length, self._coverage_files, str(self))
+        # get the last (ie, longest `bp-min-length`) coverage_file that has a `bp-min-length` <= length
+        return next(cf for cf in reversed(self._coverage_files) if cf['bp-min-length'] <= length)
     def get_coverage_for_range(self, start, stop, length=None):
         if length is None: length = stop - start
-        assert len(self._coverage_files) >= 1, (self._chrom, start, stop, length, self._coverage_files, str(self))
-        assert self._coverage_files[0]['bp-min-length'] <= length, (self._chrom, start, stop, length, self._coverage_files, str(self))
-        # get the last (ie, longest `bp-min-length`) coverage_file that has a `bp-min-length` <= length
-        coverage_file = next(cf['coverage_file'] for cf in reversed(self._coverage_files) if cf['bp-min-length'] <= length)
-        return coverage_file.get_coverage(self._chrom, start, stop)
+        return self.get_coverage_for_ranges([(start, stop)], length)
+    def get_coverage_for_ranges(self, pairs, length):
+        cf = self._get_coverage_file(length)
+        if self._cache is None:
+            return cf['coverage_file'].get_coverage_for_ranges(self._chrom, pairs)
+        coverage = []
+        for start, stop in pairs:
+            for window_start in xrange(start - start % self.WINDOW_SIZE, stop + 1, self.WINDOW_SIZE):
+                for d in self._get_window(cf, window_start):
+                    if d['end'] < start or d['start'] > stop: continue
+                    # a bin that begins before this window was already taken from the previous window
+                    if d['start'] < window_start and window_start > start: continue
+                    if d['start'] < start or d['end'] > stop:
+                        d = dict(d, start=max(d['start'], start), end=min(d['end'], stop))
+                    coverage.append(d)
+        return coverage
+    def add_pyramid_level(self, coverage_file, bin_size):
+        self._pyramid_levels.append({'coverage_file':coverage_file, 'bin-size':bin_size})
+        self._pyramid_levels.sort(key=lambda d:d['bin-size'])
+    def get_binned_coverage_for_ranges(self, pairs, max_bins):
+        if not self._pyramid_levels:
+            return self.get_coverage_for_ranges(pairs, length=sum(stop - start + 1 for start, stop in pairs))
+        # get the first (ie, finest) level whose bins overlapping `pairs` fit into `max_bins`, or the coarsest level otherwise.
+        # bin k covers positions [k * bin-size + 1, (k + 1) * bin-size], so position p falls into bin (p - 1) // bin-size
+        level = next((level for level in self._pyramid_levels if sum((stop - 1) // level['bin-size'] - (start - 1) // level['bin-size'] + 1 for start, stop in pairs) <= max_bins), self._pyramid_levels[-1])
+        return level['coverage_file'].get_coverage_for_ranges(self._chrom, pairs)
+    def _get_window(self, cf, window_start):
+        # the cached records are shared between requests, so they must never be modified
+        key = (self._chrom, cf['bp-min-length'], window_start)
+        records = self._cache.get(key)
+        if records is None:
+            records = list(cf['coverage_file'].get_coverage(self._chrom, window_start, window_start + self.WINDOW_SIZE - 1, clip=False))
+            self._cache.put(key, records)
+        return records
     def __str__(self):
         return '<SingleChromCoverageHandler chrom={} coverage_files={!r}>'.format(self._chrom, self._coverage_files)
     __repr__ = __str__
@@ -54,9 +105,10 @@ class CoverageFile(object):
         self._binned = binned
     def get_chroms(self):
         return self._tabixfile.contigs
-    def get_coverage(self, chrom, start, stop):
+    def get_coverage(self, chrom, start, stop, clip=True):
         if not self._binned:
-            for row in self._tabixfile.fetch(chrom, start, stop+1, parser=pysam.asTuple()):
+            # `fetch` takes 0-based half-open coordinates
+            for row in self._tabixfile.fetch(chrom, max(0, start-1), stop, parser=pysam.asTuple()):
                 yield json.loads(row[2])
         else:
             # Right now we don't include the region_end column in our coverage files,
@@ -66,9 +118,91 @@ class CoverageFile(object):
             for row in self._tabixfile.fetch(chrom, max(1, start-50), stop+1, parser=pysam.asTuple()):
                 d = json.loads(row[2])
                 if d['end'] < start or d['start'] > stop: continue
-                d['start'] = max(d['start'], start)
-                d['end'] = min(d['end'], stop)
+                if clip:
+                    d['start'] = max(d['start'], start)
+                    d['end'] = min(d['end'], stop)
                 yield d
+    def get_coverage_for_ranges(self, chrom, pairs):
+        coverage = []
+        for start, stop in pairs:
+            coverage.extend(self.get_coverage(chrom, start, stop))
+        return coverage
     def __str__(self):
         return '<CoverageFile chroms={} path={}>'.format(','.join(self.get_chroms()), self._tabixfile.filename)
     __repr__ = __str__
+
+class NumpyCoverageFile(object):
+    '''handles a single memory-mapped coverage file for one chrom (see data/base_coverage/convert_coverage.py)'''
+    # the file is named `[chrom].npy` and stores one fixed-width record per base (or per bin, if binned) sorted by start.
+    # only the pages touched by a query are read from disk, and no per-record JSON has to be decoded.
+    def __init__(self, path, binned):
+        self._path = path
+        self._chrom = os.path.basename(path)[:-len('.npy')]
+        self._records = numpy.load(path, mmap_mode='r')
+        self._starts = self._records['start']
+        # full-resolution files have no `end` column since every record covers a single base
+        self._ends = self._records['end'] if 'end' in self._records.dtype.names else self._starts
+        self._value_keys = [name for name in self._records.dtype.names if name not in ('start', 'end')]
+    def get_chroms(self):
+        return [self._chrom]
+    def get_coverage(self, chrom, start, stop, clip=True):
+        return self.get_coverage_for_ranges(chrom, [(start, stop)], clip)
+    def get_coverage_for_ranges(self, chrom, pairs, clip=True):
+        '''slices all (start, stop) pairs out of the arrays in one sweep and clips bins to the query ranges'''
+        if not pairs: return []
+        starts = numpy.array([pair[0] for pair in pairs], dtype=numpy.int64)
+        stops = numpy.array([pair[1] for pair in pairs], dtype=numpy.int64)
+        # the first record that ends at/after `start` and the first record that begins after `stop`
+        firsts = numpy.searchsorted(self._ends, starts, side='left')
+        lasts = numpy.maximum(numpy.searchsorted(self._starts, stops, side='right'), firsts)
+        indices = numpy.concatenate([numpy.arange(first, last) for first, last in zip(firsts, lasts)])
+        if len(indices) == 0: return []
+        pair_indices = numpy.repeat(numpy.arange(len(pairs)), lasts - firsts)
+        records = self._records[indices]
+        if clip:
+            columns = [
+                numpy.maximum(self._starts[indices], starts[pair_indices]).tolist(),
+                numpy.minimum(self._ends[indices], stops[pair_indices]).tolist(),
+            ]
+        else:
+            columns = [self._starts[indices].tolist(), self._ends[indices].tolist()]
+        # values are stored as float32; round them to keep the JSON output as compact as the original text files
+        columns.extend(numpy.around(records[key].astype(numpy.float64), 4).tolist() for key in self._value_keys)
+        keys = ['start', 'end'] + self._value_keys
+        return [dict(zip(keys, values), chrom=self._chrom) for values in zip(*columns)]
+    def __str__(self):
+        return '<NumpyCoverageFile chroms={} path={}>'.format(self._chrom, self._path)
+    __repr__ = __str__
+
+class CoverageWindowCache(object):
+    '''LRU cache of decoded coverage windows, bounded by the approximate in-memory size of the decoded records'''
+    def __init__(self, max_bytes):
+        self._max_bytes = max_bytes
+        self._windows = collections.OrderedDict() # key -> (records, size in bytes), least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        try: records, size = self._windows.pop(key)
+        except KeyError: self.misses += 1; return None
+        self._windows[key] = (records, size)
+        self.hits += 1
+        return records
+    def put(self, key, records):
+        size = self._get_size(records)
+        if size > self._max_bytes: return
+        if key in self._windows: self._bytes -= self._windows.pop(key)[1]
+        self._windows[key] = (records, size)
+        self._bytes += size
+        while self._bytes > self._max_bytes:
+            _, (_, evicted_size) = self._windows.popitem(last=False)
+            self._bytes -= evicted_size
+    @staticmethod
+    def _get_size(records):
+        # all records in a window have the same keys and value types, so measuring the first one is enough
+        size = sys.getsizeof(records)
+        if records:
+            size += len(records) * (sys.getsizeof(records[0]) + sum(sys.getsizeof(v) for v in records[0].itervalues()))
+        return size
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'windows': len(self._windows), 'bytes': self._bytes, 'max_bytes': self._max_bytes}
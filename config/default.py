@@ -40,6 +40,11 @@ API_URL_PREFIX = '/api/' + API_VERSION
 API_PAGE_SIZE = 1000
 API_MAX_REGION = 250000
 API_REQUESTS_RATE_LIMIT = ['1800/15 minute']
+API_MAX_VARIANTS = 10000               # Maximal number of variants in a single POST /variants request.
+API_VARIANTS_RATE_LIMIT = ['200000/15 minute'] # Rate limit for POST /variants, counted in requested variants.
+API_AUTH_CACHE_SIZE = 10000            # Number of recently authorized access tokens kept in memory.
+API_AUTH_CACHE_TTL = 300               # Seconds before an access token is authorized against the database again.
+API_AUTH_REVOCATION_CHECK_INTERVAL = 10 # Maximal number of seconds before a revoked access token is rejected.
 
 # BRAVO Settings
 BRAVO_AUTH_SECRET = ''
@@ -53,6 +58,7 @@ IGV_CACHE_COLLECTION = 'igv_cache'
 IGV_CACHE_DIRECTORY = '/data/cache/igv_cache/'
 IGV_CACHE_LIMIT = 1000
 BASE_COVERAGE_DIRECTORY = '/data/coverage/'
+BASE_COVERAGE_CACHE_SIZE = 256 * 1024 * 1024 # Memory (in bytes) for decoded coverage windows kept by each web worker. Set to 0 to disable.
 
 # FASTA Data URL Settings.
 FASTA_URL = 'https://<your-bravo-domain>/genomes/hs38DH.fa' # Edit to reflect your URL for your BRAVO application
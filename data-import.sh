@@ -5,3 +5,6 @@ docker exec bravo_web_1 /bin/bash -c /deploy/INSTALL.sh -v hg38 -t 8
 
 # Create variants collection in MongoDB.
 docker exec bravo_web_1 python manage.py variants -t 8 -v /data/import_vcf/chr22.TOPMed_freeze5_62784.vcf.gz
+
+# Pre-compute variant summaries for genes, transcripts and regions. Re-run after reloading variants or genes.
+docker exec bravo_web_1 python manage.py summaries -t 8
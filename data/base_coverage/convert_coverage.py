@@ -0,0 +1,65 @@
+import os
+import gzip
+import json
+import argparse
+import numpy
+
+
+argparser = argparse.ArgumentParser(description = 'Converts JSON coverage (compressed with bgzip/gzip) file into one memory-mappable NumPy (.npy) file per chromosome. Every record stores start position, mean depth, median depth and the fraction of samples covered at each depth break. Binned (pruned) coverage records also store end position.')
+argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_coverage_file', required = True, help = 'Input JSON coverage (compressed with gzip/bgzip) file.')
+argparser.add_argument('-b', '--binned', dest = 'binned', action = 'store_true', help = 'Input file stores binned coverage (i.e. it was produced by prune_coverage.py).')
+argparser.add_argument('-o', '--out', metavar = 'directory', dest = 'out_dir', required = True, help = 'Output directory. One [chromosome].npy file will be written for each chromosome.')
+
+breaks = [1, 5, 10, 15, 20, 25, 30, 50, 100] # same as in create_coverage.py
+chunk_size = 1000000 # records
+
+
+def get_dtype(binned):
+   return numpy.dtype([('start', '<i4')] + ([('end', '<i4')] if binned else []) + [(key, '<f4') for key in ['mean', 'median'] + [str(x) for x in breaks]])
+
+
+def to_record(data, binned):
+   record = [data['start']]
+   if binned:
+      record.append(data['end'])
+   record.append(data['mean'])
+   record.append(data['median'])
+   record.extend(data.get(str(x), 0.0) for x in breaks)
+   return tuple(record)
+
+
+def write_npy(raw_file, out_file, dtype):
+   records = numpy.memmap(raw_file, dtype = dtype, mode = 'r')
+   out = numpy.lib.format.open_memmap(out_file, mode = 'w+', dtype = dtype, shape = records.shape)
+   for i in xrange(0, len(records), chunk_size):
+      out[i:i + chunk_size] = records[i:i + chunk_size]
+   out.flush()
+   del out, records
+   os.remove(raw_file)
+
+
+def convert(in_coverage_file, out_dir, binned):
+   dtype = get_dtype(binned)
+   raw_files = dict()
+   chunks = dict()
+   with gzip.GzipFile(in_coverage_file, 'r') as iz:
+      for line in iz:
+         fields = line.split('\t', 2)
+         chrom = fields[0]
+         if chrom not in raw_files:
+            raw_files[chrom] = open(os.path.join(out_dir, chrom + '.npy.tmp'), 'wb')
+            chunks[chrom] = []
+         chunks[chrom].append(to_record(json.loads(fields[2]), binned))
+         if len(chunks[chrom]) >= chunk_size:
+            numpy.array(chunks[chrom], dtype = dtype).tofile(raw_files[chrom])
+            chunks[chrom] = []
+   for chrom, raw_file in raw_files.iteritems():
+      if chunks[chrom]:
+         numpy.array(chunks[chrom], dtype = dtype).tofile(raw_file)
+      raw_file.close()
+      write_npy(raw_file.name, os.path.join(out_dir, chrom + '.npy'), dtype)
+
+
+if __name__ == "__main__":
+   args = argparser.parse_args()
+   convert(args.in_coverage_file, args.out_dir, args.binned)
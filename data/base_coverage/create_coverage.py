@@ -1,13 +1,17 @@
-import gzip
 import os
 import json
 import sys
 import pysam
 import argparse
 import numpy
-import collections
+import itertools
+import multiprocessing
 from contextlib import closing
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'))
+
+from utils import get_tabix_contig_sizes
+
 argparser = argparse.ArgumentParser(description = 'Aggregate depth information (output as JSON) from individual depth files (generated using SAMtools mpileup).')
 argparser.add_argument('-i', '--in', metavar = 'file', dest = 'inFileList', required = True, help = 'Input file listing all depth files (one depth file per sample) generated using SAMtools mpileup. One file per line.')
 
@@ -16,53 +20,82 @@ sub_argparsers = argparser.add_subparsers(dest = 'subparser_name')
 chunk_argparser = sub_argparsers.add_parser('chunk', help = 'Generate and print chromosome chunks.')
 chunk_argparser.add_argument('-c', '--chromosome', metavar = 'name', dest = 'chromosome', required = True, help = 'Chromosome name.')
 chunk_argparser.add_argument('-s', '--size', metavar = 'bp', dest = 'chunk_size_bp', type = long, required = True, help = 'Maximal chunk size in base-pairs.')
+chunk_argparser.add_argument('-p', '--processes', metavar = 'number', dest = 'processes', type = int, default = 1, help = 'Number of parallel processes. If greater than 1, then all chunks are aggregated (instead of printing commands) and written to [chromosome]_[start]_[end].json.bgz files in the current directory.')
+chunk_argparser.add_argument('-w', '--window', metavar = 'bp', dest = 'window_size_bp', type = long, default = None, help = 'Number of positions aggregated at once by every process. Memory usage is proportional to window size times number of depth files. Default: the largest window (up to 50000) that fits into the memory budget.')
+chunk_argparser.add_argument('-m', '--memory', metavar = 'MB', dest = 'memory_mb', type = int, default = 1024, help = 'Memory budget per process in megabytes, used to choose the window size when it is not given. Default: 1024.')
 
 aggregate_argparser = sub_argparsers.add_parser('aggregate', help = 'Aggregate depth information across individuals.')
 aggregate_argparser.add_argument('-c', '--chromosome', metavar = 'name', dest = 'chromosome', required = True, help = 'Chromosome name.')
 aggregate_argparser.add_argument('-s', '--start', metavar = 'bp', dest = 'startbp', type = long, required = True, help = 'Region start position in bp.')
 aggregate_argparser.add_argument('-e', '--end', metavar = 'bp', dest = 'endbp', type = long, required = True, help = 'Region end position in bp.')
+aggregate_argparser.add_argument('-w', '--window', metavar = 'bp', dest = 'window_size_bp', type = long, default = None, help = 'Number of positions aggregated at once. Memory usage is proportional to window size times number of depth files. Default: the largest window (up to 50000) that fits into the memory budget.')
+aggregate_argparser.add_argument('-m', '--memory', metavar = 'MB', dest = 'memory_mb', type = int, default = 1024, help = 'Memory budget in megabytes, used to choose the window size when it is not given. Default: 1024.')
 
 breaks = [1, 5, 10, 15, 20, 25, 30, 50, 100]
+max_window_size_bp = 50000
+bytes_per_depth = 12 # int32 depths matrix, its copy for covered positions, and boolean masks of the same shape
+
+def getWindowSize(nDepthFiles, window_size_bp, memory_mb):
+   # windows are sized so that a (samples x positions) depths matrix and its temporaries stay within the memory budget
+   if window_size_bp is not None:
+      return window_size_bp
+   return max(1L, min(long(max_window_size_bp), memory_mb * 1024L * 1024L // (max(nDepthFiles, 1) * bytes_per_depth)))
 
 def getMinMaxPositions(depthFile, contig):
     with closing(pysam.TabixFile(depthFile)) as tabix:
+        if contig not in tabix.contigs:
+            return (None, None)
         first_entry = None
         for first_entry in tabix.fetch(contig, 0, parser = pysam.asTuple()):
             break
-        last_Mbp = 0
-        while any(True for _ in tabix.fetch(contig, last_Mbp, parser = pysam.asTuple())):
-            last_Mbp += 5000000
         last_entry = None
-        for last_entry in tabix.fetch(contig, last_Mbp - 5000000, parser = pysam.asTuple()):
+        # the last record starts in the last 16 kbp window of the tabix linear index
+        for last_entry in tabix.fetch(contig, max(0, get_tabix_contig_sizes(depthFile).get(contig, 0) - 16384), parser = pysam.asTuple()):
             pass
         return (long(first_entry[1]) if first_entry is not None else None, long(last_entry[1]) if last_entry is not None else None)
 
-def chunk(inFileList, contig, chunk_size_bp):
-    depthFiles = readDepthFileList(args.inFileList)
-    starts = []
-    ends = []
-    for depthFile in depthFiles:
-        start, end = getMinMaxPositions(depthFile, contig)
-        if start is not None:
-            starts.append(start)
-        if end is not None:
-            ends.append(end)
-    start = min(starts)
-    end = max(ends)
-    n_chunks = int(numpy.ceil((end - start) / float(chunk_size_bp)))
-    for i, s in enumerate(xrange(start, end, chunk_size_bp)):
-        e = end if i == n_chunks - 1 else s + chunk_size_bp - 1
-        output_file = contig + '_' + str(s) + '_' + str(e) + '.json.bgz'
-        print 'python', os.path.realpath(__file__), '-i', inFileList, 'aggregate', '-c', contig, '-s', s, '-e', e, '| bgzip -c >', output_file
-
-def readDepthChunk(depthFile, contig, start, end):
-   chunk = dict()
-   if start > 0:
-       start -= 1
-   with closing(pysam.Tabixfile(depthFile)) as tabix:
-      for row in tabix.fetch(contig, start, end, parser = pysam.asTuple()):
-         chunk[long(row[1])] = int(row[3])
-   return chunk
+def getMinMaxPositionsStar(args):
+   return getMinMaxPositions(*args)
+
+def aggregateChunkStar(args):
+   inFileList, contig, start, end, window_size_bp, output_file = args
+   depthFiles = readDepthFileList(inFileList)
+   with pysam.BGZFile(output_file, 'w') as oz:
+      writeDepthChunks(readDepthChunks(depthFiles, contig, start, end, window_size_bp), contig, float(len(depthFiles)), oz)
+   return output_file
+
+def chunk(inFileList, contig, chunk_size_bp, processes, window_size_bp, memory_mb):
+    depthFiles = readDepthFileList(inFileList)
+    window_size_bp = getWindowSize(len(depthFiles), window_size_bp, memory_mb)
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        positions = (pool.imap if pool is not None else itertools.imap)(getMinMaxPositionsStar, ((depthFile, contig) for depthFile in depthFiles))
+        starts = []
+        ends = []
+        for start, end in positions:
+            if start is not None:
+                starts.append(start)
+            if end is not None:
+                ends.append(end)
+        start = min(starts)
+        end = max(ends)
+        n_chunks = int(numpy.ceil((end - start) / float(chunk_size_bp)))
+        chunks = []
+        for i, s in enumerate(xrange(start, end, chunk_size_bp)):
+            e = end if i == n_chunks - 1 else s + chunk_size_bp - 1
+            output_file = contig + '_' + str(s) + '_' + str(e) + '.json.bgz'
+            chunks.append((inFileList, contig, s, e, window_size_bp, output_file))
+        if pool is None:
+            for _, _, s, e, _, output_file in chunks:
+                print 'python', os.path.realpath(__file__), '-i', inFileList, 'aggregate', '-c', contig, '-s', s, '-e', e, '-w', window_size_bp, '| bgzip -c >', output_file
+        else:
+            for output_file in pool.imap_unordered(aggregateChunkStar, chunks):
+                sys.stdout.write('Done {}\n'.format(output_file))
+                sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 def readDepthFileList(inFileList):
    depthFiles = list()
@@ -74,39 +107,56 @@ def readDepthFileList(inFileList):
          depthFiles.append(line)
    return depthFiles
 
-def readDepthChunks(depthFiles, contig, start, end):
-   chunks = dict()
-   for depthFile in depthFiles:
-      chunk = readDepthChunk(depthFile, contig, start, end)
-      for position, depth in chunk.iteritems():
-         if position in chunks:
-            chunks[position].append(depth)
-         else:
-            chunks[position] = [depth]
-   return chunks
-
-def writeDepthChunks(chunks, chromosome, nDepthFiles):
+def readDepthChunks(depthFiles, contig, start, end, window_size_bp):
+   # yields (positions, depths) for consecutive windows of at most `window_size_bp` positions, where `depths` is
+   # a (samples x positions) matrix with -1 for positions missing in a sample's depth file.
+   # Every depth file is opened once and stays open until all windows are read.
+   tabixes = []
+   try:
+      for depthFile in depthFiles:
+         tabix = pysam.Tabixfile(depthFile)
+         tabixes.append(tabix)
+      for window_start in xrange(start, end + 1, window_size_bp):
+         window_end = min(window_start + window_size_bp - 1, end)
+         depths = numpy.full((len(depthFiles), window_end - window_start + 1), -1, dtype = numpy.int32)
+         for i, tabix in enumerate(tabixes):
+            if contig not in tabix.contigs:
+               continue
+            rows = [(row[1], row[3]) for row in tabix.fetch(contig, max(0, window_start - 1), window_end, parser = pysam.asTuple())]
+            if rows:
+               rows = numpy.array(rows, dtype = numpy.int64)
+               depths[i, rows[:, 0] - window_start] = rows[:, 1]
+         covered = (depths >= 0).any(axis = 0)
+         yield numpy.arange(window_start, window_end + 1)[covered], depths[:, covered]
+   finally:
+      for tabix in tabixes:
+         tabix.close()
+
+def writeDepthChunks(chunks, chromosome, nDepthFiles, out = sys.stdout):
    if chromosome.startswith('chr'):
        chromosome = chromosome[3:]
-   for position, depths in collections.OrderedDict(sorted(chunks.items())).iteritems():
-      counts = [0] * len(breaks)
-      for depth in depths:
-         for i in xrange(len(breaks) - 1, -1, -1):
-            if depth >= breaks[i]:
-               counts[i] += 1
-               break
-      for i in xrange(len(breaks) - 2, -1, -1):
-         counts[i] += counts[i + 1];
-
-      sys.stdout.write('%s\t%d\t{"chrom":"%s","start":%d,"end":%d,"mean":%g,"median":%g' % (chromosome, position, chromosome, position, position, numpy.mean(depths), numpy.median(depths)))
-      for i in xrange(0, len(breaks)):
-         sys.stdout.write(',"%d":%g' % (breaks[i], counts[i] / nDepthFiles))
-      sys.stdout.write('}\n')
+   for positions, depths in chunks:
+      if len(positions) == 0:
+         continue
+      # mean and median are computed across samples present at a position, the fractions are across all samples
+      n_present = (depths >= 0).sum(axis = 0)
+      means = numpy.maximum(depths, 0).sum(axis = 0, dtype = numpy.float64) / n_present
+      depths.sort(axis = 0) # missing (-1) values come first
+      n_samples = depths.shape[0]
+      columns = numpy.arange(depths.shape[1])
+      medians = (depths[n_samples - n_present + (n_present - 1) // 2, columns] + depths[n_samples - n_present + n_present // 2, columns]) / 2.0
+      fractions = [(depths >= x).sum(axis = 0) / nDepthFiles for x in breaks]
+      for j, position in enumerate(positions):
+         out.write('%s\t%d\t{"chrom":"%s","start":%d,"end":%d,"mean":%g,"median":%g' % (chromosome, position, chromosome, position, position, means[j], medians[j]))
+         for i in xrange(0, len(breaks)):
+            out.write(',"%d":%g' % (breaks[i], fractions[i][j]))
+         out.write('}\n')
 
 if __name__ == '__main__':
    args = argparser.parse_args()
    if args.subparser_name == 'chunk':
-      chunk(args.inFileList, args.chromosome, args.chunk_size_bp)
+      chunk(args.inFileList, args.chromosome, args.chunk_size_bp, args.processes, args.window_size_bp, args.memory_mb)
    elif args.subparser_name == 'aggregate':
       depthFiles = readDepthFileList(args.inFileList)
-      writeDepthChunks(readDepthChunks(depthFiles, args.chromosome, args.startbp, args.endbp), args.chromosome, float(len(depthFiles)))
+      window_size_bp = getWindowSize(len(depthFiles), args.window_size_bp, args.memory_mb)
+      writeDepthChunks(readDepthChunks(depthFiles, args.chromosome, args.startbp, args.endbp, window_size_bp), args.chromosome, float(len(depthFiles)))
@@ -1,101 +1,92 @@
 import sys
 import pysam
 import gzip
-import json
-from collections import deque
+import heapq
 import argparse
-import operator
+import itertools
+import multiprocessing
+from contextlib import closing
 
 
-argparser = argparse.ArgumentParser(description = 'Merges overlapping JSON coverage (compressed with bgzip/gzip) files. Requirements: (a) All files must store same chromosome; (b) No regions can be covered by more than two files; (c) There are no such two files, that store nested regions; (d) All positions within single coverage file are unique and in ascending order.')
-argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_files_list', required = True, help = 'List of JSON coverage (compressed with bgzip/gzip) files. One file per line.')
-argparser.add_argument('-o', '--out', metavar = 'file', dest = 'out_merged_file', required = True, help = 'Output JSON coverage (compressed with bgzip) file')
+argparser = argparse.ArgumentParser(description = 'Merges overlapping JSON coverage (compressed with bgzip/gzip) files. Any number of files may overlap; when several files store the same position, the record with the highest mean depth is kept. Requirements: (a) Every file must store a single chromosome; (b) All positions within single coverage file are unique and in ascending order.')
+argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_files_list', required = True, help = 'List of JSON coverage (compressed with bgzip/gzip) files. One file per line. Files may store different chromosomes.')
+argparser.add_argument('-o', '--out', metavar = 'file', dest = 'out_merged_file', required = True, help = 'Output JSON coverage (compressed with bgzip) file. If input files store more than one chromosome, then the file name must include {chrom} placeholder e.g. {chrom}.full.json.gz.')
+argparser.add_argument('-t', '--threads', metavar = 'number', dest = 'threads', type = int, default = 1, help = 'Number of chromosomes merged in parallel. Default: 1.')
+
+write_buffer_size = 4 * 1024 * 1024 # bytes
 
 
 def read_files_list(files_list):
-   unordered_coverage_files = dict()
+   coverage_files_by_chrom = dict()
    with open(files_list, 'r') as ifile:
       for line in ifile:
          if line.startswith('#'):
             continue
          coverage_file = line.rstrip()
+         if not coverage_file:
+            continue
          with gzip.GzipFile(coverage_file) as iz:
             for line in iz:
-               fields = line.rstrip().split('\t', 2)
-               position = long(fields[1])
-               chrom = fields[0]
-               unordered_coverage_files[position] = (coverage_file, chrom)
+               chrom = line.split('\t', 1)[0]
+               coverage_files_by_chrom.setdefault(chrom, []).append(coverage_file)
                break
-   ordered_coverage_files = [{
-            'name': unordered_coverage_files[position][0],
-            'chrom': unordered_coverage_files[position][1],
-            'leftmost_position': position,
-            'next_leftmost_position': sys.maxsize} for position in sorted(unordered_coverage_files.iterkeys())]
-   for i in xrange(1, len(ordered_coverage_files)):
-      if ordered_coverage_files[i - 1]['chrom'] != ordered_coverage_files[i]['chrom']:
-         raise Exception('Input files store different contigs/chromosomes!')
-      if ordered_coverage_files[i - 1]['leftmost_position'] == ordered_coverage_files[i]['leftmost_position']:
-         raise Exception('Two input files store identical leftmost positions!')
-   for i in xrange(0, len(ordered_coverage_files) - 1):
-      ordered_coverage_files[i]['next_leftmost_position'] = ordered_coverage_files[i + 1]['leftmost_position']
-   return ordered_coverage_files
-
+   return coverage_files_by_chrom
 
-def merge_coverage_files(coverage_files, out_coverage_file):
-   with pysam.BGZFile(out_coverage_file, 'w') as oz:
-      overlap_head = deque([])
-      overlap_tail = deque([])
-      for coverage_file in coverage_files:
-         last_position = None
-         with gzip.GzipFile(coverage_file['name']) as iz:
-            for line in iz:
-               fields = line.split('\t')
-               chrom = fields[0]
-               if chrom != coverage_file['chrom']:
-                  raise Exception('Multiple chromosomes detected within {} coverage file!'.format(coverage_file['name']))
-               position = long(fields[1])
 
-               if last_position is None or last_position < position:
-                  last_position = position
-               else:
-                  raise Exception('Positions within {} coverage file are not in ascending order or not unique!'.format(coverage_file['name']))
+def get_mean(line):
+   # reads "mean" value without decoding the whole JSON
+   i = line.index('"mean":') + 7
+   j = line.index(',', i)
+   return float(line[i:j])
 
-               while overlap_head:
-                  (overlap_position, overlap_line) = overlap_head[0]
 
-                  if overlap_position >= coverage_file['next_leftmost_position']:
-                     raise Exception("Overlapping regions are present in more than two coverage files!")
+def read_coverage_file(coverage_file, chrom, order):
+   last_position = None
+   with gzip.GzipFile(coverage_file) as iz:
+      for line in iz:
+         fields = line.split('\t', 2)
+         if fields[0] != chrom:
+            raise Exception('Multiple chromosomes detected within {} coverage file!'.format(coverage_file))
+         position = long(fields[1])
+         if last_position is not None and last_position >= position:
+            raise Exception('Positions within {} coverage file are not in ascending order or not unique!'.format(coverage_file))
+         last_position = position
+         yield (position, order, line)
 
-                  if overlap_position < position:
-                     oz.write(overlap_line)
-                     overlap_head.popleft()
-                  elif overlap_position == position:
-                     overlap_head.popleft()
-                     overlap_data = json.loads(overlap_line.split('\t')[2])
-                     data = json.loads(fields[2])
-                     if overlap_data['mean'] > data['mean']:
-                        line = overlap_line
-                     else:
-                        break
-                  else:
-                     break
 
-               if position < coverage_file['next_leftmost_position']:
-                  oz.write(line)
-               else:
-                  overlap_tail.append((position, line))
+def merge_coverage_files(chrom, coverage_files, out_coverage_file):
+   records = heapq.merge(*[read_coverage_file(coverage_file, chrom, order) for order, coverage_file in enumerate(coverage_files)])
+   with pysam.BGZFile(out_coverage_file, 'w') as oz:
+      buffer = []
+      buffer_size = 0
+      for position, group in itertools.groupby(records, key = lambda record: record[0]):
+         line = next(group)[2]
+         for _, _, other_line in group:
+            if get_mean(other_line) >= get_mean(line):
+               line = other_line
+         buffer.append(line)
+         buffer_size += len(line)
+         if buffer_size >= write_buffer_size:
+            oz.write(''.join(buffer))
+            buffer = []
+            buffer_size = 0
+      if buffer:
+         oz.write(''.join(buffer))
+   pysam.tabix_index(out_coverage_file, seq_col = 0, start_col = 1, end_col = 1, force = True)
+   return out_coverage_file
 
-         if overlap_head:
-            raise Exception("Nested regions detected in two coverage files!")
-         overlap_head = overlap_tail
-         overlap_tail = deque([])
 
-      if overlap_tail:
-         raise Exception("Error while merging coverage files!")
+def merge_coverage_files_star(args):
+   return merge_coverage_files(*args)
 
 
 if __name__ == "__main__":
    args = argparser.parse_args()
-   coverage_files = read_files_list(args.in_files_list)
-   merge_coverage_files(coverage_files, args.out_merged_file)
-   pysam.tabix_index(args.out_merged_file, seq_col = 0, start_col = 1, end_col = 1)
+   coverage_files_by_chrom = read_files_list(args.in_files_list)
+   if len(coverage_files_by_chrom) > 1 and '{chrom}' not in args.out_merged_file:
+      argparser.error('Input files store {} chromosomes, but output file name has no {{chrom}} placeholder.'.format(len(coverage_files_by_chrom)))
+   jobs = [(chrom, coverage_files, args.out_merged_file.format(chrom = chrom)) for chrom, coverage_files in coverage_files_by_chrom.iteritems()]
+   with closing(multiprocessing.Pool(max(1, min(args.threads, len(jobs))))) as pool:
+      for out_merged_file in pool.imap_unordered(merge_coverage_files_star, jobs):
+         sys.stdout.write('Done {}\n'.format(out_merged_file))
+         sys.stdout.flush()
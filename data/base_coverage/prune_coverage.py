@@ -1,36 +1,53 @@
+import re
 import gzip
 import pysam
-import json
 import sys
 import argparse
+from contextlib import nested
 
-argparser = argparse.ArgumentParser(description = 'Prunes base coverage by grouping bases into bins of similar median and mean depths. Starting with base X that has mean and median depths Z(X) and Y(X), every next base X+1 is added to the same bin if |Z(X+1) - Z(X)| <= LIMIT and |Y(X+1) - Y(X)| <= LIMIT')
+argparser = argparse.ArgumentParser(description = 'Prunes base coverage by grouping bases into bins of similar median and mean depths. Starting with base X that has mean and median depths Z(X) and Y(X), every next base X+1 is added to the same bin if |Z(X+1) - Z(X)| <= LIMIT and |Y(X+1) - Y(X)| <= LIMIT. Several limits can be given to produce several pruned files in one pass over the input.')
 argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_coverage_file', required = True, help = 'Input JSON coverage (compressed with gzip/bgzip) file')
-argparser.add_argument('-l', '--limit', metavar = 'float', dest = 'fluctuation_limit', required = True, type = float, help = 'Threshold for maximal fluctuation of median and mean depths within a bin.')
-argparser.add_argument('-o', '--out', metavar = 'file', dest = 'out_coverage_file', required = True, help = 'Output JSON coverage (compressed with bgzip) file')
+argparser.add_argument('-l', '--limit', metavar = 'float', dest = 'fluctuation_limits', required = True, type = float, nargs = '+', help = 'Threshold(s) for maximal fluctuation of median and mean depths within a bin.')
+argparser.add_argument('-o', '--out', metavar = 'file', dest = 'out_coverage_files', required = True, nargs = '+', help = 'Output JSON coverage (compressed with bgzip) file(s). One file for every threshold, in the same order.')
 
+end_regex = re.compile(r'"end":\s*\d+')
 
-def write_data(of, json_data):
-   of.write('{}\t{}\t'.format(json_data['chrom'], json_data['start']))
-   json.dump(json_data, of, separators = (',', ':'))
-   of.write('\n')
 
+def get_value(line, key):
+   # reads a numeric value without decoding the whole JSON
+   i = line.index('"{}":'.format(key)) + len(key) + 3
+   j = line.find(',', i)
+   if j < 0:
+      j = line.index('}', i)
+   return float(line[i:j])
 
-def prune(in_coverage_file, out_coverage_file, fluctuation_limit = 0.25):
-   with gzip.GzipFile(in_coverage_file, 'r') as iz, pysam.BGZFile(out_coverage_file, 'w') as oz:
-      fields = iz.readline().split('\t')
-      bin_data = json.loads(fields[2])
+
+def write_data(of, line, end):
+   # every bin is stored as the JSON of its first base with the "end" set to the last base of the bin
+   of.write(end_regex.sub('"end":{}'.format(end), line, count = 1))
+
+
+def prune(in_coverage_file, out_coverage_files, fluctuation_limits = [0.25]):
+   with gzip.GzipFile(in_coverage_file, 'r') as iz, nested(*[pysam.BGZFile(out_coverage_file, 'w') for out_coverage_file in out_coverage_files]) as ozs:
+      line = iz.readline()
+      bins = [[line, get_value(line, 'mean'), get_value(line, 'median'), line.split('\t', 2)[1]] for _ in fluctuation_limits]
       for line in iz:
-         fields = line.split('\t')
-         data = json.loads(fields[2])
-         if ((abs(bin_data['mean'] - data['mean']) > fluctuation_limit) or (abs(bin_data['median'] - data['median']) > fluctuation_limit)):
-             write_data(oz, bin_data)
-             bin_data = data
-         bin_data['end'] = data['start']
-      write_data(oz, bin_data)
+         mean = get_value(line, 'mean')
+         median = get_value(line, 'median')
+         position = line.split('\t', 2)[1]
+         for oz, fluctuation_limit, bin in zip(ozs, fluctuation_limits, bins):
+            if abs(bin[1] - mean) > fluctuation_limit or abs(bin[2] - median) > fluctuation_limit:
+               write_data(oz, bin[0], bin[3])
+               bin[0], bin[1], bin[2] = line, mean, median
+            bin[3] = position
+      for oz, bin in zip(ozs, bins):
+         write_data(oz, bin[0], bin[3])
 
 
 if __name__ == "__main__":
    args = argparser.parse_args()
-   prune(args.in_coverage_file, args.out_coverage_file, args.fluctuation_limit)
-   pysam.tabix_index(args.out_coverage_file, seq_col = 0, start_col = 1, end_col = 1)
+   if len(args.fluctuation_limits) != len(args.out_coverage_files):
+      argparser.error('Number of output files must be equal to the number of thresholds.')
+   prune(args.in_coverage_file, args.out_coverage_files, args.fluctuation_limits)
+   for out_coverage_file in args.out_coverage_files:
+      pysam.tabix_index(out_coverage_file, seq_col = 0, start_col = 1, end_col = 1)
@@ -0,0 +1,70 @@
+import os
+import argparse
+import numpy
+from convert_coverage import write_npy
+
+
+argparser = argparse.ArgumentParser(description = 'Builds a multi-resolution coverage pyramid from a full-resolution NumPy coverage file (produced by convert_coverage.py). Each level bins coverage into fixed power-of-two sized windows: mean depth and fractions of samples above depth breaks are averaged over covered bases in a window, and median depth is the average of per-base medians.')
+argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_coverage_file', required = True, help = 'Input full-resolution [chromosome].npy coverage file.')
+argparser.add_argument('-m', '--min-bin-size', metavar = 'number', dest = 'min_bin_size', type = int, default = 16, help = 'Smallest bin size in base-pairs (power of two). Default: 16.')
+argparser.add_argument('-M', '--max-bin-size', metavar = 'number', dest = 'max_bin_size', type = int, default = 65536, help = 'Largest bin size in base-pairs (power of two). Default: 65536.')
+argparser.add_argument('-o', '--out', metavar = 'directory', dest = 'out_dir', required = True, help = 'Output directory. Level with bin size N will be written to [directory]/N/[chromosome].npy.')
+
+
+def get_bin_sizes(min_bin_size, max_bin_size):
+   bin_sizes = []
+   bin_size = 1
+   while bin_size <= max_bin_size:
+      if bin_size >= min_bin_size:
+         bin_sizes.append(bin_size)
+      bin_size *= 2
+   return bin_sizes
+
+
+def aggregate(records, bin_size, dtype):
+   # bin k covers positions [k * bin_size + 1, (k + 1) * bin_size]; records are sorted by position
+   starts = records['start'].astype(numpy.int64)
+   bins = (starts - 1) // bin_size
+   firsts = numpy.flatnonzero(numpy.concatenate(([True], bins[1:] != bins[:-1])))
+   lasts = numpy.append(firsts[1:], len(bins)) - 1
+   counts = (lasts - firsts + 1).astype(numpy.float64)
+   aggregated = numpy.empty(len(firsts), dtype = dtype)
+   aggregated['start'] = starts[firsts]
+   aggregated['end'] = starts[lasts]
+   for name in dtype.names[2:]:
+      aggregated[name] = numpy.add.reduceat(records[name].astype(numpy.float64), firsts) / counts
+   return aggregated
+
+
+def build(in_coverage_file, out_dir, bin_sizes):
+   chrom = os.path.basename(in_coverage_file)[:-len('.npy')]
+   records = numpy.load(in_coverage_file, mmap_mode = 'r')
+   assert 'end' not in records.dtype.names, 'Input coverage file must store full-resolution coverage.'
+   dtype = numpy.dtype([('start', '<i4'), ('end', '<i4')] + [(name, records.dtype[name]) for name in records.dtype.names[1:]])
+   raw_files = dict()
+   for bin_size in bin_sizes:
+      level_dir = os.path.join(out_dir, str(bin_size))
+      if not os.path.isdir(level_dir):
+         os.makedirs(level_dir)
+      raw_files[bin_size] = open(os.path.join(level_dir, chrom + '.npy.tmp'), 'wb')
+   # process positions in chunks aligned to the largest bin, so that no bin is split between chunks
+   chunk_size = max(bin_sizes) * max(1, 4194304 // max(bin_sizes))
+   i = 0
+   while i < len(records):
+      chunk_end = ((int(records['start'][i]) - 1) // chunk_size + 1) * chunk_size
+      j = int(numpy.searchsorted(records['start'], chunk_end, side = 'right'))
+      chunk = records[i:j]
+      for bin_size in bin_sizes:
+         aggregate(chunk, bin_size, dtype).tofile(raw_files[bin_size])
+      i = j
+   for bin_size, raw_file in raw_files.iteritems():
+      raw_file.close()
+      write_npy(raw_file.name, os.path.join(out_dir, str(bin_size), chrom + '.npy'), dtype)
+
+
+if __name__ == "__main__":
+   args = argparser.parse_args()
+   bin_sizes = get_bin_sizes(args.min_bin_size, args.max_bin_size)
+   if not bin_sizes:
+      argparser.error('No power-of-two bin sizes between {} and {}.'.format(args.min_bin_size, args.max_bin_size))
+   build(args.in_coverage_file, args.out_dir, bin_sizes)
@@ -16,7 +16,7 @@ import sys
 import time
 import traceback
 from collections import Counter, defaultdict
-from datetime import timedelta
+from datetime import datetime, timedelta
 from ipaddress import AddressValueError, ip_network
 from multiprocessing import Process
 
@@ -37,6 +37,8 @@ from flask_login import (LoginManager, UserMixin, current_user, login_user,
 from lookups import IntervalSet, TranscriptSet
 from parsing import *
 from utils import *
+from webargs import fields
+from webargs.flaskparser import parser
 from werkzeug.contrib.fixers import ProxyFix
 
 bp = Blueprint('bp', __name__, template_folder='templates', static_folder='static')
@@ -66,6 +68,13 @@ BASE_COVERAGE.extend({'bp-min-length':0,                  'path':path} for path
 BASE_COVERAGE.extend({'bp-min-length':300, 'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_25e-2/*.json.gz'))
 BASE_COVERAGE.extend({'bp-min-length':1000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_50e-2/*.json.gz'))
 BASE_COVERAGE.extend({'bp-min-length':3000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_75e-2/*.json.gz'))
+# memory-mapped coverage converted with data/base_coverage/convert_coverage.py takes precedence over the .json.gz files for the same chrom
+BASE_COVERAGE.extend({'bp-min-length':0,                  'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'full/*.npy'))
+BASE_COVERAGE.extend({'bp-min-length':300, 'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_25e-2/*.npy'))
+BASE_COVERAGE.extend({'bp-min-length':1000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_50e-2/*.npy'))
+BASE_COVERAGE.extend({'bp-min-length':3000,'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'bin_75e-2/*.npy'))
+# power-of-two binned coverage pyramid built with data/base_coverage/pyramid_coverage.py, used when the client asks for a limited number of bins
+BASE_COVERAGE.extend({'bin-size':int(os.path.basename(os.path.dirname(path))), 'binned':True, 'path':path} for path in glob.glob(app.config['BASE_COVERAGE_DIRECTORY'] + 'pyramid/*/*.npy'))
 
 MAX_REGION_LENGTH = int(350e3) # Longer than TTN (305kb), short enough to perform okay.
 
@@ -82,15 +91,9 @@ def get_db(new_connection=False):
 get_db._mongo_client = pymongo.MongoClient(host=app.config['MONGO']['host'], port=app.config['MONGO']['port'], connect=False)
 sequencesClient = sequences.SequencesClient(app.config['IGV_CRAM_DIRECTORY'], app.config['IGV_REFERENCE_PATH'], app.config['IGV_CACHE_DIRECTORY'], app.config['IGV_CACHE_COLLECTION'], 100)
 
-@boltons.cacheutils.cached({})
-def get_autocomplete_strings():
-    autocomplete_strings = get_db().genes.distinct('gene_name')
-    autocomplete_strings.extend(get_db().genes.distinct('other_names', {'other_names': {'$ne': None}}))
-    return sorted(set(autocomplete_strings))
-
 @boltons.cacheutils.cached({})
 def get_coverage_handler():
-    return CoverageHandler(BASE_COVERAGE)
+    return CoverageHandler(BASE_COVERAGE, app.config['BASE_COVERAGE_CACHE_SIZE'])
 
 
 def require_agreement_to_terms_and_store_destination(func):
@@ -137,9 +140,9 @@ def homepage():
 def autocomplete():
     db = get_db()
     query = request.args.get('query', '')
-    suggestions = lookups.get_awesomebar_suggestions(get_autocomplete_strings(), query, db)
+    suggestions = lookups.get_awesomebar_suggestions(db, query)
     _log('  =>  {} results'.format(len(suggestions)))
-    return jsonify([{'value': s} for s in sorted(suggestions)])
+    return jsonify([{'value': s} for s in suggestions])
 
 
 @bp.route('/awesome')
@@ -166,6 +169,8 @@ def user_profile_page():
             if error is None:
                 db = get_db()
                 result = db.users.update_one({"user_id": current_user.get_id()}, {"$set": {"enabled_api": enabled_api, "no_newsletters": no_newsletters}})
+                if not enabled_api:
+                    set_access_token_revocation_epoch(db, datetime.utcnow())
                 success = True
                 current_user.enabled_api = enabled_api
                 current_user.no_newsletters = no_newsletters
@@ -184,6 +189,16 @@ def administration_page():
         return render_template('administration.html', error = error, success = success)
     except: _err(); abort(500)
 
+@bp.route('/administration/cache_stats')
+@require_agreement_to_terms_and_store_destination
+def administration_cache_stats_api():
+    if not current_user.admin:
+        abort(404)
+    return jsonify({
+        'reference_data': lookups.ReferenceDataCache.get_stats(),
+        'coverage': get_coverage_handler().get_cache_stats(),
+    })
+
 @bp.route('/administration/users', methods = ['POST'])
 @require_agreement_to_terms_and_store_destination
 def administration_users_api():
@@ -245,7 +260,9 @@ def variant_page(variant_id):
             IntervalSet.from_xstart_xstop(variant['xpos'], variant['xpos']+len(variant['ref'])-1))
 
         metrics = lookups.get_metrics(db)
-        variant['quality_metrics']['QUAL'] = variant['site_quality']
+        # details of a variant are missing while `manage.py variants` swaps in a new load
+        if 'quality_metrics' in variant:
+            variant['quality_metrics']['QUAL'] = variant['site_quality']
 
         lookups.remove_some_extraneous_information(variant)
 
@@ -357,9 +374,13 @@ def download_region_variants(chrom, start, stop):
 
 def _get_variants_csv_for_intervalset(intervalset, filename):
     _log()
-    resp = make_response(lookups.get_variants_csv_str_for_intervalset(get_db(), intervalset))
+    csv_chunks = lookups.get_variants_csv_for_intervalset(get_db(), intervalset)
+    if request.args.get('gzip', '').lower() in ['1', 'true']:
+        resp = Response(gzip_chunks(csv_chunks), mimetype='application/gzip')
+        filename += '.gz'
+    else:
+        resp = Response(csv_chunks, mimetype='text/csv')
     resp.headers['Content-Disposition'] = 'attachment; filename={}'.format(filename)
-    resp.mimetype='text/csv'
     return resp
 
 
@@ -367,16 +388,14 @@ def _get_variants_csv_for_intervalset(intervalset, filename):
 @require_agreement_to_terms_and_store_destination
 def gene_summary_api(gene_id):
     try:
-        intervalset = IntervalSet.from_gene(get_db(), gene_id)
-        return jsonify(lookups.get_summary_for_intervalset(get_db(), intervalset))
+        return jsonify(lookups.get_summary_for_gene(get_db(), gene_id))
     except:_err(); abort(500)
 
 @bp.route('/api/summary/transcript/<transcript_id>')
 @require_agreement_to_terms_and_store_destination
 def transcript_summary_api(transcript_id):
     try:
-        intervalset = IntervalSet.from_transcript(get_db(), transcript_id)
-        return jsonify(lookups.get_summary_for_intervalset(get_db(), intervalset))
+        return jsonify(lookups.get_summary_for_transcript(get_db(), transcript_id))
     except:_err(); abort(500)
 
 @bp.route('/api/summary/region/<chrom>-<start>-<stop>')
@@ -425,29 +444,44 @@ def _get_variants_subset_response_for_intervalset(intervalset):
     ret['draw'] = args['draw']
     return jsonify(ret)
 
+coverage_arguments = {
+    # `bins` is the maximum number of coverage bins; `width` is the width of the plot in pixels, ie, one bin per pixel
+    'bins': fields.Int(required=False, missing=None),
+    'width': fields.Int(required=False, missing=None),
+}
+
+def _get_coverage_max_bins():
+    # must be called outside of `try: ... except: abort(500)`, so that invalid values are answered with 422 by webargs
+    args = parser.parse(coverage_arguments, request)
+    max_bins = args['bins'] if args['bins'] is not None else args['width']
+    return max(1, max_bins) if max_bins is not None else None
+
 @bp.route('/api/coverage/gene/<gene_id>')
 @require_agreement_to_terms_and_store_destination
 def gene_coverage_api(gene_id):
+    max_bins = _get_coverage_max_bins()
     try:
         intervalset = IntervalSet.from_gene(get_db(), gene_id)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset, max_bins))
     except:_err(); abort(500)
 
 @bp.route('/api/coverage/transcript/<transcript_id>')
 @require_agreement_to_terms_and_store_destination
 def transcript_coverage_api(transcript_id):
+    max_bins = _get_coverage_max_bins()
     try:
         intervalset = IntervalSet.from_transcript(get_db(), transcript_id)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset, max_bins))
     except:_err(); abort(500)
 
 @bp.route('/api/coverage/region/<chrom>-<start>-<stop>')
 @require_agreement_to_terms_and_store_destination
 def region_coverage_api(chrom, start, stop):
+    max_bins = _get_coverage_max_bins()
     try:
         start,stop = int(start),int(stop); assert stop-start <= MAX_REGION_LENGTH
         intervalset = IntervalSet.from_chrom_start_stop(chrom, start, stop)
-        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset))
+        return jsonify(get_coverage_handler().get_coverage_for_intervalset(intervalset, max_bins))
     except:_err(); abort(500)
 
 @bp.route('/multi_variant_rsid/<rsid>')
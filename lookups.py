@@ -1,34 +1,178 @@
+import array
+import bisect
 import itertools
 import json
 import re
+import sys
+import threading
 import time
+from collections import namedtuple
 
+import boltons.cacheutils
 import boltons.iterutils
 import pymongo
 import pysam
 from utils import *  # TODO: explicitly list
 
 SEARCH_LIMIT = 10000
+ANNOTATION_CODEC_CHECK_INTERVAL = 1 # seconds between checks for a reloaded variants collection, whose annotations the cached codec may fail to decode
+
+class ReferenceDataCache(object):
+    '''
+    Process-wide cache of values computed from collections that only change when `manage.py` (re)loads them.
+    Every value depends on one or more datasets, named like in db.versions, and is recomputed as soon as the version of any of them changes.
+    '''
+    VERSION_CHECK_INTERVAL = 60 # seconds between checks for new versions of the datasets
+
+    _locks_lock = threading.Lock()
+    _locks = {} # key -> lock held while the value is computed
+    _values = {} # key -> (versions of the datasets the value was computed from, value)
+    _stats = {} # key -> {'hits': ..., 'misses': ..., 'stale': ...}
+    _versions = {}
+    _versions_checked_at = None
+
+    @classmethod
+    def get(cls, db, key, datasets, compute, serve_stale=True, max_version_age=None):
+        """
+        Returns the value for `key`, computing it if there is none yet or any of the `datasets` has a new version.
+        While one caller recomputes an outdated value, others get the outdated one instead of waiting, unless `serve_stale` is False.
+        Versions are checked every VERSION_CHECK_INTERVAL seconds, or every `max_version_age` seconds if given.
+        """
+        versions = cls.get_versions(db, datasets, max_version_age)
+        stats = cls._stats.setdefault(key, {'hits': 0, 'misses': 0, 'stale': 0})
+        entry = cls._values.get(key)
+        if entry is not None and entry[0] == versions:
+            stats['hits'] += 1
+            return entry[1]
+        lock = cls._get_lock(key)
+        if entry is not None and serve_stale:
+            if not lock.acquire(False):
+                stats['stale'] += 1
+                return entry[1]
+        else:
+            lock.acquire()
+        try:
+            entry = cls._values.get(key)
+            if entry is None or entry[0] != versions:
+                stats['misses'] += 1
+                entry = cls._values[key] = (versions, compute())
+            else:
+                stats['hits'] += 1
+            return entry[1]
+        finally:
+            lock.release()
+
+    @classmethod
+    def _get_lock(cls, key):
+        lock = cls._locks.get(key)
+        if lock is None:
+            with cls._locks_lock:
+                lock = cls._locks.setdefault(key, threading.Lock())
+        return lock
+
+    @classmethod
+    def get_versions(cls, db, datasets, max_age=None):
+        "Versions of the datasets, which can be part of the keys of other caches that must be dropped when `manage.py` reloads the datasets."
+        if cls._versions_checked_at is None or time.time() - cls._versions_checked_at >= (max_age if max_age is not None else cls.VERSION_CHECK_INTERVAL):
+            # `manage.py` records when it last (re)loaded every dataset
+            cls._versions = {version['_id']: version['loaded_at'] for version in db.versions.find()}
+            cls._versions_checked_at = time.time()
+        return tuple(cls._versions.get(name) for name in datasets)
+
+    @classmethod
+    def get_stats(cls):
+        stats = {}
+        for key, counts in cls._stats.items():
+            total = counts['hits'] + counts['misses'] + counts['stale']
+            stats[key] = dict(counts, hit_rate=float(counts['hits']) / total if total else None, cached=key in cls._values)
+        return stats
+
+
+class GeneModelIndex(object):
+    '''
+    Read-only, in-memory copy of the genes, transcripts and exons collections, shared by the whole process.
+    It is rebuilt when `manage.py genes` records a new version of the gene models.
+    '''
+    Transcript = namedtuple('Transcript', ['transcript_id', 'gene_id', 'chrom', 'start', 'stop', 'strand', 'xstart', 'xstop'])
+    Exon = namedtuple('Exon', ['chrom', 'start', 'stop', 'strand', 'feature_type', 'gene_id', 'transcript_id'])
+
+    @classmethod
+    def get(cls, db):
+        return ReferenceDataCache.get(db, 'gene_model_index', ['genes'], lambda: cls(db))
+
+    def __init__(self, db):
+        st = time.time()
+        strings = {} # share identical strings between records
+        share = lambda s: strings.setdefault(s, s) if isinstance(s, basestring) else s
+        self._genes, self._genes_by_name, self._genes_by_other_name = {}, {}, {}
+        for gene in db.genes.find(projection={'_id': False}):
+            # like find_one(), keep the first document in natural order
+            self._genes.setdefault(gene['gene_id'], gene)
+            self._genes_by_name.setdefault(gene['gene_name'], gene)
+            for other_name in gene.get('other_names') or []:
+                self._genes_by_other_name.setdefault(other_name, gene)
+        self.autocomplete = AutocompleteIndex(self._genes_by_name.keys(), self._genes_by_other_name.keys())
+        self._transcripts = {}
+        for transcript in db.transcripts.find(projection={'_id': False}):
+            if transcript['transcript_id'] not in self._transcripts:
+                self._transcripts[share(transcript['transcript_id'])] = self.Transcript(**{field: share(transcript[field]) for field in self.Transcript._fields})
+        self._exons_by_gene, self._exons_by_transcript, exons_by_chrom = {}, {}, {}
+        for exon in db.exons.find(projection={'_id': False, 'exon_id': False, 'xstart': False, 'xstop': False}):
+            exon = self.Exon(**{field: share(exon[field]) for field in self.Exon._fields})
+            self._exons_by_gene.setdefault(exon.gene_id, []).append(exon)
+            self._exons_by_transcript.setdefault(exon.transcript_id, []).append(exon)
+            exons_by_chrom.setdefault(exon.chrom, []).append(exon)
+        # For each chrom, exons sorted by start and the running maximum of their stops.
+        # Exons that overlap [start, stop] are then all within exons[bisect_left(max_stops, start):bisect_right(starts, stop)].
+        self._exons_by_chrom = {}
+        for chrom, exons in exons_by_chrom.items():
+            exons.sort(key=lambda exon: exon.start)
+            starts, max_stops = array.array('l', (exon.start for exon in exons)), array.array('l')
+            for exon in exons: max_stops.append(max(exon.stop, max_stops[-1]) if max_stops else exon.stop)
+            self._exons_by_chrom[chrom] = (starts, max_stops, exons)
+        print '## GENE_MODEL_INDEX: spent {:.3f} seconds indexing {} genes, {} transcripts'.format(time.time()-st, len(self._genes), len(self._transcripts))
+
+    def get_gene(self, gene_id):
+        gene = self._genes.get(gene_id)
+        return dict(gene) if gene else None
+    def get_gene_by_name(self, gene_name):
+        gene = self._genes_by_name.get(gene_name) or self._genes_by_other_name.get(gene_name)
+        return dict(gene) if gene else None
+    def get_transcript(self, transcript_id):
+        transcript = self._transcripts.get(transcript_id)
+        return dict(transcript._asdict()) if transcript else None
+    def get_exons_for_gene(self, gene_id):
+        return [dict(exon._asdict()) for exon in self._exons_by_gene.get(gene_id, [])]
+    def get_exons_for_transcript(self, transcript_id):
+        return [dict(exon._asdict()) for exon in self._exons_by_transcript.get(transcript_id, [])]
+    def get_exons_for_chrom_start_stop(self, chrom, start, stop):
+        if chrom.startswith('chr'): chrom = chrom[3:]
+        if chrom not in self._exons_by_chrom: return []
+        starts, max_stops, exons = self._exons_by_chrom[chrom]
+        return [dict(exon._asdict()) for exon in exons[bisect.bisect_left(max_stops, start):bisect.bisect_right(starts, stop)] if exon.stop >= start]
+
 
 def get_gene(db, gene_id):
-    return db.genes.find_one({'gene_id': gene_id}, projection={'_id': False})
+    return GeneModelIndex.get(db).get_gene(gene_id)
 
 def get_gene_by_name(db, gene_name):
-    # try gene_name field first
-    gene = db.genes.find_one({'gene_name': gene_name}, projection={'_id': False})
-    if gene:
-        return gene
-    # if not, try gene['other_names']
-    return db.genes.find_one({'other_names': gene_name}, projection={'_id': False})
+    # tries gene['gene_name'] first, then gene['other_names']
+    return GeneModelIndex.get(db).get_gene_by_name(gene_name)
 
 
 def get_transcript(db, transcript_id):
-    return db.transcripts.find_one({'transcript_id': transcript_id}, projection={'_id': False})
+    return GeneModelIndex.get(db).get_transcript(transcript_id)
 
 
 def get_variant(db, xpos, ref, alt):
-    variant = db.variants.find_one({'xpos': xpos, 'ref': ref, 'alt': alt}, projection={'_id': False})
+    variant = db.variants.find_one({'xpos': xpos, 'ref': ref, 'alt': alt})
     if variant is None: return None
+    # depths, qualities, metrics and population frequencies are stored separately since the variant page is the only place that shows them
+    details = db.variant_details.find_one({'_id': variant.pop('_id')}, projection={'_id': False})
+    if details is not None:
+        variant.update(details)
+    if 'vep_annotations' in variant:
+        variant['vep_annotations'] = get_annotation_codec(db).decode_all(variant['vep_annotations'])
     if variant['rsids'] == []:
         variant['rsids'] = list('rs{}'.format(r['rsid']) for r in db.dbsnp.find({'xpos': xpos}))
         if variant['rsids']:
@@ -70,25 +214,68 @@ def get_variants_by_rsid(db, rsid):
 def get_variants_from_dbsnp(db, rsid):
     if not rsid.startswith('rs') or not rsid[2:].isdigit():
         return None
-    position = db.dbsnp.find_one({'rsid': rsid})
-    if position:
-        variants = list(db.variants.find({'xpos': {'$lte': position['xpos'], '$gte': position['xpos']}}, projection={'_id': False}))
-        if variants:
-            for variant in variants:
-                remove_some_extraneous_information(variant)
-            return variants
-    return []
+    # db.dbsnp stores only the integer part of rsIds. Join the variants at that position in the same round trip.
+    positions = list(db.dbsnp.aggregate([
+        {'$match': {'rsid': int(rsid[2:])}},
+        {'$limit': 1},
+        {'$lookup': {'from': 'variants', 'localField': 'xpos', 'foreignField': 'xpos', 'as': 'variants'}},
+    ]))
+    variants = positions[0]['variants'] if positions else []
+    for variant in variants:
+        variant.pop('_id', None)
+        remove_some_extraneous_information(variant)
+    return variants
+
+
+def _run_concurrently(*funcs):
+    """Calls each function in its own thread (a greenlet, under gevent) and returns their results in order."""
+    results = [None] * len(funcs)
+    errors = []
+    def run(i):
+        try: results[i] = funcs[i]()
+        except: errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(1, len(funcs))]
+    for thread in threads: thread.start()
+    run(0)
+    for thread in threads: thread.join()
+    if errors: raise errors[0][0], errors[0][1], errors[0][2]
+    return results
 
-#@boltons.cacheutils.cached({})
 
-def get_awesomebar_suggestions(autocomplete_strings, query, db):
+class AutocompleteIndex(object):
+    '''Gene symbols and aliases, case-folded and sorted, for prefix lookups from the awesomebar.'''
+    def __init__(self, gene_names, other_names):
+        self._gene_names = self._fold_and_sort(gene_names)
+        self._other_names = self._fold_and_sort(set(other_names) - set(gene_names))
+    @staticmethod
+    def _fold_and_sort(names):
+        names = sorted(names, key=lambda name: (name.lower(), name))
+        return [name.lower() for name in names], names
+    @staticmethod
+    def _get_prefixed(folded_and_names, prefix, cap):
+        folded, names = folded_and_names
+        results = []
+        for i in xrange(bisect.bisect_left(folded, prefix), len(folded)):
+            if len(results) >= cap or not folded[i].startswith(prefix): break
+            results.append(names[i])
+        return results
+    def get_suggestions(self, query, cap):
+        """Up to `cap` names that start with `query` (ignoring case): exact matches first, then gene symbols, then aliases."""
+        prefix = query.lower()
+        gene_names = self._get_prefixed(self._gene_names, prefix, cap)
+        other_names = self._get_prefixed(self._other_names, prefix, cap)
+        # exact matches sort first within each list
+        exact = [name for name in gene_names + other_names if name.lower() == prefix]
+        results = exact + [name for name in gene_names + other_names if name.lower() != prefix]
+        return results[:cap]
+
+
+def get_awesomebar_suggestions(db, query):
     cap = 10
     rs_max_length = 9999999999
 
     # first look for genes, genes have priority over rsIds (e.g. there is a gene RS1)
-    regex = re.compile('^' + re.escape(query), re.IGNORECASE)
-    results = (r for r in autocomplete_strings if regex.match(r))
-    results = list(itertools.islice(results, 0, cap))
+    results = GeneModelIndex.get(db).autocomplete.get_suggestions(query, cap)
 
     try:
         if len(results) < cap and query.startswith('rs'): # if query starts with "rs" and there is still place for autocomplete dropdown, look for rsIds.
@@ -117,30 +304,35 @@ _regex_chr = re.compile(_regex_pattern_chr+'$')
 _regex_chr_pos = re.compile(_regex_pattern_chr_pos+'$')
 _regex_chr_start_end = re.compile(_regex_pattern_chr_start_end+'$')
 _regex_chr_pos_ref_alt = re.compile(_regex_pattern_chr_pos_ref_alt+'$')
+_regex_rsid = re.compile(r'^rs\d+$')
 
 
 def get_awesomebar_result(db, query):
+    # Classify the query first, so that only an rsid costs database round trips (two, concurrently). Everything else is answered from memory.
     query = query.strip() # TODO:check if query is not None
+    gene_model_index = GeneModelIndex.get(db)
 
     # rsid
-    variants = get_variants_by_rsid(db, query.lower())
-    if variants:
-        if len(variants) == 1:
-            return 'variant', {'variant_id': variants[0]['variant_id']}
-        else:
-            if query.lower() not in variants[0]['rsids']:
-                print('Warning: get_variants_by_rsid(db, "{query_lower!r}") returned ({variants!r}) but {query_lower!r} is not in {variants[0].rsids!r}.'.format(
-                    query_lower=query.lower(), variants=variants))
-            return 'multi_variant_rsid', {'rsid': query.lower()}
-    variants = get_variants_from_dbsnp(db, query.lower())
-    if variants:
-        if len(variants) == 1:
-            return 'variant', {'variant_id': variants[0]['variant_id']}
-        else:
-            return 'multi_variant_rsid', {'rsid': query.lower()}
+    if _regex_rsid.match(query.lower()):
+        variants, dbsnp_variants = _run_concurrently(
+            lambda: get_variants_by_rsid(db, query.lower()),
+            lambda: get_variants_from_dbsnp(db, query.lower()))
+        if variants:
+            if len(variants) == 1:
+                return 'variant', {'variant_id': variants[0]['variant_id']}
+            else:
+                if query.lower() not in variants[0]['rsids']:
+                    print('Warning: get_variants_by_rsid(db, "{query_lower!r}") returned ({variants!r}) but {query_lower!r} is not in {variants[0].rsids!r}.'.format(
+                        query_lower=query.lower(), variants=variants))
+                return 'multi_variant_rsid', {'rsid': query.lower()}
+        if dbsnp_variants:
+            if len(dbsnp_variants) == 1:
+                return 'variant', {'variant_id': dbsnp_variants[0]['variant_id']}
+            else:
+                return 'multi_variant_rsid', {'rsid': query.lower()}
 
     # gene symbol
-    gene = get_gene_by_name(db, query)
+    gene = gene_model_index.get_gene_by_name(query)
     if gene:
         return 'gene', {'gene_id': gene['gene_id']}
 
@@ -149,19 +341,19 @@ def get_awesomebar_result(db, query):
     query = query.upper()
 
     # uppercase gene symbol
-    gene = get_gene_by_name(db, query)
+    gene = gene_model_index.get_gene_by_name(query)
     if gene:
         return 'gene', {'gene_id': gene['gene_id']}
 
     # ENSG
     if query.startswith('ENSG'):
-        gene = get_gene(db, query)
+        gene = gene_model_index.get_gene(query)
         if gene:
             return 'gene', {'gene_id': gene['gene_id']}
 
     # ENST
     if query.startswith('ENST'):
-        transcript = get_transcript(db, query)
+        transcript = gene_model_index.get_transcript(query)
         if transcript:
             return 'transcript', {'transcript_id': transcript['transcript_id']}
 
@@ -203,12 +395,12 @@ class IntervalSet(object):
         return cls(chrom1, [[start, stop]])
     @classmethod
     def from_gene(cls, db, gene_id):
-        exons = db.exons.find({'gene_id': gene_id, 'feature_type': { "$in": ['CDS', 'UTR', 'exon'] }}, projection={'_id': False})
-        return cls._from_exons(exons)
+        exons = GeneModelIndex.get(db).get_exons_for_gene(gene_id)
+        return cls._from_exons(exon for exon in exons if exon['feature_type'] in ['CDS', 'UTR', 'exon'])
     @classmethod
     def from_transcript(cls, db, transcript_id):
-        exons = db.exons.find({'transcript_id': transcript_id, 'feature_type': { "$in": ['CDS', 'UTR', 'exon'] }}, projection={'_id': False})
-        return cls._from_exons(exons)
+        exons = GeneModelIndex.get(db).get_exons_for_transcript(transcript_id)
+        return cls._from_exons(exon for exon in exons if exon['feature_type'] in ['CDS', 'UTR', 'exon'])
     @classmethod
     def _from_exons(cls, exons):
         # note: these "exons" are not all literally exons, some are CDS or UTR features
@@ -253,16 +445,15 @@ class TranscriptSet(object):
         self.genes = genes
     @classmethod
     def from_gene(cls, db, gene_id):
-        all_exons = list(db.exons.find({'gene_id': gene_id}, {'_id':False}))
+        all_exons = GeneModelIndex.get(db).get_exons_for_gene(gene_id)
         return cls._from_exons(db, all_exons)
     @classmethod
     def from_transcript(cls, db, transcript_id):
-        all_exons = list(db.exons.find({'transcript_id': transcript_id}, {'_id':False}))
+        all_exons = GeneModelIndex.get(db).get_exons_for_transcript(transcript_id)
         return cls._from_exons(db, all_exons)
     @classmethod
     def from_chrom_start_stop(cls, db, chrom, start, stop):
-        xstart,xstop = Xpos.from_chrom_pos(chrom,start),Xpos.from_chrom_pos(chrom,stop)
-        all_exons = list(db.exons.find({'xstop':{'$gte':xstart},'xstart':{'$lte':xstop}}, {'_id':False}))
+        all_exons = GeneModelIndex.get(db).get_exons_for_chrom_start_stop(chrom, start, stop)
         return cls._from_exons(db, all_exons)
     @classmethod
     def _from_exons(cls, db, all_exons):
@@ -271,7 +462,7 @@ class TranscriptSet(object):
         all_transcripts = []
         for transcript_id, exons in sortedgroupby(all_exons, key=lambda exon:exon['transcript_id']):
             exons = sorted(exons, key=lambda exon:exon['start'])
-            transcript = db.transcripts.find_one({'transcript_id':transcript_id})
+            transcript = get_transcript(db, transcript_id)
             gene_id = exons[0]['gene_id']
             exons = [{key: exon[key] for key in ['feature_type','strand','start','stop']} for exon in exons]
             weight = 0 # 10 * CDS length + UTR length + exon length + 1e10 * canonical
@@ -308,6 +499,15 @@ class TranscriptSet(object):
 
 
 def get_metrics(db):
+    return list(ReferenceDataCache.get(db, 'metrics', ['metrics'], lambda: _get_metrics(db)))
+
+
+def get_annotation_codec(db):
+    # an outdated codec can't decode annotations of the reloaded collection, so it is never served stale and is checked every ANNOTATION_CODEC_CHECK_INTERVAL seconds
+    return ReferenceDataCache.get(db, 'annotation_codec', ['variants'], lambda: AnnotationCodec.load(db, 'variants'), serve_stale=False, max_version_age=ANNOTATION_CODEC_CHECK_INTERVAL)
+
+
+def _get_metrics(db):
     metrics = []
     cursor = db.metrics.find({'type': 'percentiles'}, projection = {'_id': False})
     for document in cursor:
@@ -321,21 +521,57 @@ def remove_some_extraneous_information(variant):
 
 
 
-def get_summary_for_intervalset(db, intervalset):
+SUMMARY_KEYS = 'lof lof_lc mis syn indel total'.split()
+SUMMARY_PREFIX_BLOCK_SIZE = 10000 # bases per document in db.summary_prefixes
+
+def get_summary_flags_for_variant(variant):
+    """Which summary counts a PASS variant contributes to, in the order of SUMMARY_KEYS. Must agree with `mongo_match_cond` in _get_summary_counts_from_variants()."""
+    csqidx = variant['worst_csqidx']
+    annotations = variant.get('vep_annotations') or [{}]
+    lof = csqidx < Consequence.as_obj['n_lof']
+    return (
+        int(lof),
+        int(lof and annotations[0].get('LoF') == 'LC'),
+        int(Consequence.as_obj['n_lof'] <= csqidx < Consequence.as_obj['n_lof_mis']),
+        int(Consequence.as_obj['n_lof_mis'] <= csqidx < Consequence.as_obj['n_lof_mis_syn']),
+        int(len(variant['ref']) != 1 or len(variant['alt']) != 1),
+        1,
+    )
+
+def _summaries_are_current(db):
+    """Whether db.summaries and db.summary_prefixes were loaded after the variants and gene models they count. `manage.py variants` and `manage.py genes` don't update them."""
+    summaries, variants, genes = ReferenceDataCache.get_versions(db, ['summaries', 'variants', 'genes'])
+    return all(version is None or (summaries is not None and version <= summaries) for version in [variants, genes])
+
+def get_summary_prefix(db, chrom, pos):
+    """Summary counts of PASS variants on `chrom` at or before `pos`, or None if `manage.py summaries` hasn't been run for `chrom`."""
+    block = db.summary_prefixes.find_one({'chrom': chrom, 'block': {'$lte': pos // SUMMARY_PREFIX_BLOCK_SIZE}}, sort=[('block', pymongo.DESCENDING)], projection={'_id': False})
+    if block is None: return None
+    n = bisect.bisect_right(block['pos'], pos)
+    return {key: block['before'][key] + (block['counts'][key][n-1] if n > 0 else 0) for key in SUMMARY_KEYS}
+
+def _get_summary_counts_from_prefixes(db, intervalset):
+    if not _summaries_are_current(db): return None
+    ret = {key:0 for key in SUMMARY_KEYS}
+    for start, stop in intervalset.to_obj()['list_of_pairs']:
+        before, through = get_summary_prefix(db, intervalset.chrom, start-1), get_summary_prefix(db, intervalset.chrom, stop)
+        if before is None or through is None: return None
+        for key in SUMMARY_KEYS: ret[key] += through[key] - before[key]
+    return ret
+
+def _get_summary_counts_from_variants(db, intervalset):
     # Note: querying for each extent in intervalset.to_list_of_mongos() is >100X faster than using intervalset.to_mongo() and I have no idea why. Try query planner?
-    st = time.time()
     mongo_match_cond = {
         'lof': {'$lt': ['$worst_csqidx', Consequence.as_obj['n_lof']]},
         'lof_lc': {'$and': [
             {'$lt': ['$worst_csqidx', Consequence.as_obj['n_lof']]},
-            {'$in':[{'k':"LoF",'v':"LC"},{'$objectToArray':{'$arrayElemAt':["$vep_annotations",0]}}]} # this is gross but I couldn't find a better way.
+            get_annotation_codec(db).first_annotation_has('LoF', 'LC'),
         ]},
         'mis': {'$and': [{'$gte': ['$worst_csqidx', Consequence.as_obj['n_lof']]},     {'$lt':['$worst_csqidx', Consequence.as_obj['n_lof_mis']]}]},
         'syn': {'$and': [{'$gte': ['$worst_csqidx', Consequence.as_obj['n_lof_mis']]}, {'$lt':['$worst_csqidx', Consequence.as_obj['n_lof_mis_syn']]}]},
         'indel': {'$or': [{'$ne': [1, {'$strLenBytes':'$ref'}]}, {'$ne': [1, {'$strLenBytes':'$alt'}]}]},
     }
-    keys = 'lof lof_lc mis syn indel total'.split()
-    ret = {key:0 for key in keys}
+    ret = {key:0 for key in SUMMARY_KEYS}
     for mongo_match_region in intervalset.to_list_of_mongos():
         x = db.variants.aggregate([
             {'$match': mkdict(mongo_match_region, {'filter':'PASS'})},
@@ -352,8 +588,10 @@ def get_summary_for_intervalset(db, intervalset):
         x = list(x);
         if len(x) == 0: continue # no variants in interval
         assert len(x) == 1; x = x[0]
-        for key in keys: ret[key] += x.get(key,0)
-    print '## SUMMARY: spent {:0.3f} seconds tabulating {} variants'.format(time.time() - st, ret['total'])
+        for key in SUMMARY_KEYS: ret[key] += x.get(key,0)
+    return ret
+
+def _summary_counts_to_rows(ret):
     return [
         ('All - SNPs', ret['total'] - ret['indel']),
         ('All - Indels', ret['indel']),
@@ -363,14 +601,25 @@ def get_summary_for_intervalset(db, intervalset):
         ('Coding - Synonymous', ret['syn']),
     ]
 
-
-def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, order, filter_info, skip, length):
-    # 1. match what the user asked for - using [intervalset, filter_info]
-    # 2. project to just keys for sorting, sort, and get `_id`s - using [order]
-    # 3. get `n_filtered` and `length`-many `_id`s - using [skip, length]
-    # 4. look up those `_id`s and project - using [columns_to_return]
+def get_summary_for_intervalset(db, intervalset):
     st = time.time()
+    ret = _get_summary_counts_from_prefixes(db, intervalset)
+    if ret is None: ret = _get_summary_counts_from_variants(db, intervalset)
+    print '## SUMMARY: spent {:0.3f} seconds tabulating {} variants'.format(time.time() - st, ret['total'])
+    return _summary_counts_to_rows(ret)
+
+def get_summary_for_gene(db, gene_id):
+    summary = db.summaries.find_one({'gene_id': gene_id}, projection={'_id': False}) if _summaries_are_current(db) else None
+    if summary is None: return get_summary_for_intervalset(db, IntervalSet.from_gene(db, gene_id))
+    return _summary_counts_to_rows(summary['counts'])
+
+def get_summary_for_transcript(db, transcript_id):
+    summary = db.summaries.find_one({'transcript_id': transcript_id}, projection={'_id': False}) if _summaries_are_current(db) else None
+    if summary is None: return get_summary_for_intervalset(db, IntervalSet.from_transcript(db, transcript_id))
+    return _summary_counts_to_rows(summary['counts'])
+
 
+def _get_mongo_match_for_filter_info(intervalset, filter_info):
     mongo_match = [intervalset.to_mongo()]
     if filter_info.get('filter_value',None) is not None:
         if filter_info['filter_value'] == 'PASS': mongo_match.append({'filter': 'PASS'})
@@ -384,7 +633,38 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
     if filter_info.get('category',None) is not None:
         if filter_info['category'].strip() == 'LoF': mongo_match.append({'worst_csqidx': {'$lt': Consequence.as_obj['n_lof']}})
         elif filter_info['category'].strip() == 'LoF+Missense': mongo_match.append({'worst_csqidx': {'$lt': Consequence.as_obj['n_lof_mis']}})
-
+    return mongo_match
+
+
+def _get_mongo_match_after(key, direction, value):
+    # mongo sorts null (and missing) before every number, but `$gt`/`$lt` never match across types.
+    if direction == pymongo.ASCENDING:
+        return {key: {'$ne': None}} if value is None else {key: {'$gt': value}}
+    if value is None: return None # nothing sorts below null
+    return {'$or': [{key: {'$lt': value}}, {key: None}]}
+
+def _get_mongo_keyset_match(sort_keys, last_key):
+    '''
+    Match everything that sorts strictly after `last_key`.
+    `sort_keys` is like [(key, direction), ..., ('_id', ASCENDING)] and `last_key` holds the values of those keys for the last variant of a page.
+    '''
+    branches = []
+    for i, (key, direction) in enumerate(sort_keys):
+        after = _get_mongo_match_after(key, direction, last_key[i])
+        if after is None: continue
+        equal = [{k: v} for (k, _), v in zip(sort_keys[:i], last_key[:i])]
+        branches.append({'$and': equal + [after]} if equal else after)
+    return {'$or': branches}
+
+# The number of variants that match (intervalset, filter_info), and the last sort key of every page served for (intervalset, filter_info, order).
+# Both let us avoid re-scanning everything before the requested page on every DataTables request.
+# Keys include the version of the variants dataset, so that counts and page boundaries are not reused after `manage.py` reloads it.
+_variants_subset_counts = boltons.cacheutils.LRU(max_size=1000)
+_variants_subset_cursors = boltons.cacheutils.LRU(max_size=1000)
+VARIANTS_SUBSET_PAGE_BOUNDARIES = 100 # page boundaries kept for every (intervalset, filter_info, order), least recently used are dropped
+
+def _get_variants_subset_sort(db, columns_to_return, order):
+    # returns (computed sort keys, sort keys, keys of returned columns, projection) for the columns and order requested by DataTables
     cols = {
         # after pre-processing, these will look like:
         # <name>: {'sort': {'project': <projection>, 'sort_key': <key>}, 'return': {'project': <projection>}}
@@ -394,7 +674,7 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
         'csq': {'sort': 'worst_csqidx', 'return':{'project': {
             'worst_csqidx':1,
             'HGVS':'$worst_csq_HGVS',
-            'low_conf': {'$in':[{'k':"LoF",'v':"LC"},{'$objectToArray':{'$arrayElemAt':["$vep_annotations",0]}}]}, # Gross, but I don't know a better way.
+            'low_conf': get_annotation_codec(db).first_annotation_has('LoF', 'LC'),
         }}},
         'filter': {},
         'allele_count': {'sort': True},
@@ -418,35 +698,77 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
             print('COL = ', col)
             raise
 
-    mongo_projection_before_sort = {}
+    mongo_computed_sort_keys = {}
     mongo_sort = OrderedDict()
     for order_item in order:
         direction = {'asc': pymongo.ASCENDING, 'desc':pymongo.DESCENDING}[order_item['dir']]
         colidx = order_item['column']; colname = columns_to_return[colidx]['name']; col = cols[colname]
-        mongo_projection_before_sort.update(col['sort']['project'])
-        mongo_sort[col['sort']['sort_key']] = direction
-
-    mongo_projection = mkdict(*[cols[ctr['name']]['return']['project'] for ctr in columns_to_return], _id=False)
-
-    v_ids_curs = db.variants.aggregate([
-        {'$match': {'$and': mongo_match}},
-        {'$project': mongo_projection_before_sort},
-        {'$sort': mongo_sort},
-        {'$project': {'_id': 1}},
-        {'$group': {'_id':0, 'count':{'$sum':1}, 'results':{'$push':'$$ROOT'}}},
-        {'$project': {'_id':0, 'count':1, 'ids':{'$slice':['$results',skip,length]}}},
-    ])
-    print '## VARIANT_SUBSET: spent {:.3f} seconds creating cursor'.format(time.time()-st); st = time.time()
-    v_ids_result = list(v_ids_curs)
-    if len(v_ids_result) == 0:
-        n_filtered, variants = 0, []
-    else:
-        assert len(v_ids_result) == 1
-        n_filtered = v_ids_result[0]['count']
+        mongo_computed_sort_keys.update((k, v) for k, v in col['sort']['project'].items() if v != 1)
+        mongo_sort.setdefault(col['sort']['sort_key'], direction)
+    mongo_sort['_id'] = pymongo.ASCENDING # tie-breaker, so that every variant has a unique position
+    sort_keys = tuple(mongo_sort.items())
+
+    returned_keys = set(mkdict(*[cols[ctr['name']]['return']['project'] for ctr in columns_to_return]))
+    mongo_projection = mkdict({key: 1 for key, _ in sort_keys}, *[cols[ctr['name']]['return']['project'] for ctr in columns_to_return])
+
+    return mongo_computed_sort_keys, sort_keys, returned_keys, mongo_projection
+
+def _get_variants_subset_pipeline(mongo_match, mongo_computed_sort_keys, sort_keys, mongo_projection, resume_key, skip, length):
+    # `skip` counts from the variant after `resume_key` (the sort key of a page boundary) if there is one
+    pipeline = [{'$match': {'$and': mongo_match}}]
+    if mongo_computed_sort_keys: pipeline.append({'$addFields': mongo_computed_sort_keys})
+    if resume_key is not None: pipeline.append({'$match': _get_mongo_keyset_match(sort_keys, resume_key)})
+    pipeline.append({'$sort': OrderedDict(sort_keys)})
+    if skip > 0: pipeline.append({'$skip': skip})
+    pipeline.append({'$limit': length})
+    pipeline.append({'$project': mongo_projection}) # b/c fancy projections require .aggregate()
+    return pipeline
+
+def get_variants_subset_pipeline(db, intervalset, columns_to_return, order, filter_info, length):
+    '''
+    Aggregation pipeline for the first page of the variant table, exactly like the one `get_variants_subset_for_intervalset` runs, e.g. to explain it.
+    '''
+    mongo_match = _get_mongo_match_for_filter_info(intervalset, filter_info)
+    mongo_computed_sort_keys, sort_keys, returned_keys, mongo_projection = _get_variants_subset_sort(db, columns_to_return, order)
+    return _get_variants_subset_pipeline(mongo_match, mongo_computed_sort_keys, sort_keys, mongo_projection, None, 0, length)
+
+def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, order, filter_info, skip, length):
+    # 1. match what the user asked for - using [intervalset, filter_info]
+    # 2. get `n_filtered` from the cache, or count it once - using [intervalset, filter_info]
+    # 3. resume from the closest page boundary already served at or before `skip`, so we only skip within that page - using [order, skip].
+    #    Jumping to a page that is far from every served one (e.g. DataTables "Last") still skips all variants before it.
+    # 4. sort, page and project in a single query - using [order, length, columns_to_return]
+    # 5. remember the sort key of the last variant, so that the next page can resume from it
+    st = time.time()
+
+    mongo_match = _get_mongo_match_for_filter_info(intervalset, filter_info)
+    mongo_computed_sort_keys, sort_keys, returned_keys, mongo_projection = _get_variants_subset_sort(db, columns_to_return, order)
+
+    count_key = (ReferenceDataCache.get_versions(db, ['variants']), str(intervalset), json.dumps(filter_info, sort_keys=True))
+    n_filtered = _variants_subset_counts.get(count_key)
+    if n_filtered is None:
+        # counting each extent of the intervalset separately is much faster than counting `intervalset.to_mongo()`. They never overlap.
+        n_filtered = sum(db.variants.count({'$and': [mongo_match_region] + mongo_match[1:]}) for mongo_match_region in intervalset.to_list_of_mongos())
+        _variants_subset_counts[count_key] = n_filtered
         print '## VARIANT_SUBSET: spent {:0.3f} seconds counting {} variants that match filters'.format(time.time()-st, n_filtered); st = time.time()
-        v_ids = [v['_id'] for v in v_ids_result[0]['ids']]
-        variants = [next(db.variants.aggregate([{'$match': {'_id': vid}}, {'$project': mongo_projection}])) for vid in v_ids] # b/c fancy projections require .aggregate()
-        print '## VARIANT_SUBSET: spent {:0.3f} seconds fetching {} full variants by id'.format(time.time()-st, len(variants)); st = time.time()
+
+    cursor_key = (count_key, sort_keys)
+    page_boundaries = _variants_subset_cursors.get(cursor_key) # {n_variants_before: sort key of the variant just before}
+    if page_boundaries is None:
+        page_boundaries = _variants_subset_cursors[cursor_key] = boltons.cacheutils.LRU(max_size=VARIANTS_SUBSET_PAGE_BOUNDARIES)
+    resume_from = max(offset for offset in itertools.chain([0], page_boundaries.keys()) if offset <= skip)
+    resume_key = page_boundaries.get(resume_from) if resume_from > 0 else None
+    if resume_key is None: resume_from = 0 # dropped by another request in the meantime
+
+    pipeline = _get_variants_subset_pipeline(mongo_match, mongo_computed_sort_keys, sort_keys, mongo_projection, resume_key, skip - resume_from, length)
+    variants = list(db.variants.aggregate(pipeline))
+    print '## VARIANT_SUBSET: spent {:0.3f} seconds fetching {} variants after skipping {} from a page boundary at {}'.format(time.time()-st, len(variants), skip-resume_from, resume_from)
+
+    if variants:
+        page_boundaries[skip + len(variants)] = [variants[-1].get(key) for key, _ in sort_keys]
+    for variant in variants:
+        for key in [key for key in variant if key not in returned_keys]:
+            del variant[key]
 
     return {
         'recordsFiltered': n_filtered,
@@ -455,23 +777,34 @@ def get_variants_subset_for_intervalset(db, intervalset, columns_to_return, orde
     }
 
 
-def get_variants_csv_str_for_intervalset(db, intervalset):
+def get_variants_csv_for_intervalset(db, intervalset, chunk_size=65536):
+    """Yields the CSV of the variants in an intervalset in chunks of about `chunk_size` bytes, reading only the columns it writes."""
     import io, csv
     out = io.BytesIO()
     writer = csv.writer(out)
     fields = 'chrom pos ref alt rsids filter genes allele_num allele_count allele_freq hom_count site_quality quality_metrics.DP cadd_phred'.split()
     writer.writerow(fields)
-    variants = get_variants_in_intervalset(db, intervalset)
-    for v in variants:
+    variants = get_variants_in_intervalset(db, intervalset, projection=mkdict(fields))
+    for v in join_variant_details(db, variants, ['quality_metrics.DP']):
         row = []
         for field in fields:
             if '.' in field: parts = field.split('.', 1); row.append(v.get(parts[0], {}).get(parts[1], ''))
             elif field in ['rsids','genes']: row.append('|'.join(v.get(field, [])))
             else: row.append(v.get(field, ''))
         writer.writerow(row)
-    return out.getvalue()
-def get_variants_in_intervalset(db, intervalset):
+        if out.tell() >= chunk_size:
+            yield out.getvalue()
+            out.seek(0); out.truncate()
+    yield out.getvalue()
+def join_variant_details(db, variants, fields, batch_size=1000):
+    """Yields variants (which must include `_id`) with the given `fields` of db.variant_details added, looking them up in batches. Removes `_id`."""
+    for batch in boltons.iterutils.chunked_iter(variants, batch_size):
+        details = {d['_id']: d for d in db.variant_details.find({'_id': {'$in': [v['_id'] for v in batch]}}, projection=mkdict(fields))}
+        for v in batch:
+            v.update((k, d) for k, d in details.get(v.pop('_id'), {}).items() if k != '_id')
+            yield v
+def get_variants_in_intervalset(db, intervalset, projection={'_id': False}):
     """Variants that overlap an intervalset"""
     for mongo_match_region in intervalset.to_list_of_mongos():
-        for variant in db.variants.find(mongo_match_region, projection={'_id': False}):
+        for variant in db.variants.find(mongo_match_region, projection=projection):
             yield variant
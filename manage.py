@@ -2,20 +2,26 @@
 
 import argparse
 import contextlib
+import datetime
 import functools
 import gzip
 import json
 import multiprocessing
+import multiprocessing.pool
 import os
+import struct
 import sys
 import time
-from itertools import chain, islice
+from itertools import groupby
 
+import bson
+import lookups
 import parsing
 import pymongo
 import pysam
 import sequences
 from flask import Config
+from utils import AnnotationCodec, Xpos, get_tabix_contig_sizes
 
 argparser = argparse.ArgumentParser(description = 'Tool for creating and populating Bravo database.')
 argparser_subparsers = argparser.add_subparsers(help = '', dest = 'command')
@@ -34,6 +40,7 @@ argparser_whitelist.add_argument('-w', '--whitelist', metavar = 'file', required
 argparser_dbsnp = argparser_subparsers.add_parser('dbsnp', help = 'Creates and populates MongoDB collection with dbSNP variants.')
 argparser_dbsnp.add_argument('-d', '--dbsnp', metavar = 'file', required = True, type = str, nargs = '+', dest = 'dbsnp_files', help = 'File (or multiple files split by chromosome) with variants from dbSNP, compressed using bgzip and indexed using tabix. File must have three tab-delimited columns without header: integer part of rsId, chromosome, position (0-based).')
 argparser_dbsnp.add_argument('-t', '--threads', metavar = 'number', required = False, type = int, default = 1, dest = 'threads', help = 'Number of threads to use.')
+argparser_dbsnp.add_argument('-c', '--chunk-size', metavar = 'base-pairs', required = False, type = int, default = 1000000, dest = 'chunk_size', help = 'Chromosomes are split into chunks of this size, which are loaded in parallel. Default: 1000000.')
 
 argparser_metrics = argparser_subparsers.add_parser('metrics', help = 'Creates and populates MongoDB collection with pre-calculated metrics across all variants.')
 argparser_metrics.add_argument('-m', '--metrics', metavar = 'file', required = True, type = str, dest = 'metrics_file', help = 'File with the pre-calculated metrics across all variants. Every metric must be stored on a separate line in JSON format.')
@@ -41,6 +48,11 @@ argparser_metrics.add_argument('-m', '--metrics', metavar = 'file', required = T
 argparser_variants = argparser_subparsers.add_parser('variants', help = 'Creates and populates MongoDB collection for variants.')
 argparser_variants.add_argument('-v', '--variants', metavar = 'file', required = True, type = str, nargs = '+', dest = 'variants_files', help = 'VCF/BCF file (or multiple files split by chromosome) with variants, compressed using bgzip and indexed using tabix.')
 argparser_variants.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of thrads to use.')
+argparser_variants.add_argument('-c', '--chunk-size', metavar = 'base-pairs', required = False, type = int, default = 1000000, dest = 'chunk_size', help = 'Chromosomes are split into chunks of this size, which are loaded in parallel. Default: 1000000.')
+argparser_variants.add_argument('--compact-annotations', required = False, action = 'store_true', dest = 'compact_annotations', help = 'Store VEP annotations as positional arrays with integer consequence codes. Field names are kept once in annotation_fields collection.')
+
+argparser_summaries = argparser_subparsers.add_parser('summaries', help = 'Creates and populates MongoDB collections with pre-computed variant summaries for every gene and transcript, and with cumulative variant counts for arbitrary regions. Must be re-run after loading variants or gene models.')
+argparser_summaries.add_argument('-t', '--threads', metavar = 'number', required = False, type = int, default = 1, dest = 'threads', help = 'Number of threads to use.')
 
 argparser_bamcache = argparser_subparsers.add_parser('bam_cache', help = 'Creates MongoDB collection for storing paths to cached BAM\CRAM files for the IGV browser.')
 
@@ -48,6 +60,8 @@ argparser_custom_variants = argparser_subparsers.add_parser('custom_variants', h
 argparser_custom_variants.add_argument('-v', '--variants', metavar = 'file', required = True, type = str, nargs = '+', dest = 'variants_files', help = 'VCF/BCF file (or multiple files split by chromosome) with variants, compressed using bgzip and indexed using tabix.')
 argparser_custom_variants.add_argument('-n', '--name', metavar = 'name', required = True, type = str, dest = 'collection_name', help = 'MongoDB destination collection name.')
 argparser_custom_variants.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of thrads to use.')
+argparser_custom_variants.add_argument('-c', '--chunk-size', metavar = 'base-pairs', required = False, type = int, default = 1000000, dest = 'chunk_size', help = 'Chromosomes are split into chunks of this size, which are loaded in parallel. Default: 1000000.')
+argparser_custom_variants.add_argument('--compact-annotations', required = False, action = 'store_true', dest = 'compact_annotations', help = 'Store VEP annotations as positional arrays with integer consequence codes. Field names are kept once in annotation_fields collection.')
 
 
 argparser_percentiles = argparser_subparsers.add_parser('percentiles', help = 'Loads percentiles for each variant from INFO field in the provided VCF. Percentiles in the INFO field must have \'_P\' suffix and store two comma separated values: lower bound and upper bound.')
@@ -55,6 +69,13 @@ argparser_percentiles.add_argument('-v', '--variants', metavar = 'file', require
 argparser_percentiles.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of thrads to use.')
 
 
+argparser_indexes = argparser_subparsers.add_parser('indexes', help = 'Creates compound indexes on variants collection for sorted and filtered region queries from the API and the browser. Loading variants already creates them, so this is only needed for collections loaded before.')
+argparser_indexes.add_argument('-n', '--name', metavar = 'name', required = False, type = str, default = 'variants', dest = 'collection_name', help = 'MongoDB collection with variants. Default: variants.')
+
+argparser_explain = argparser_subparsers.add_parser('explain', help = 'Runs explain on representative API queries and browser pipelines and reports collection scans, queries that examine many more index keys than matching variants, and unused indexes. Exits with non-zero status if any such query was found.')
+argparser_explain.add_argument('-n', '--name', metavar = 'name', required = False, type = str, default = 'variants', dest = 'collection_name', help = 'MongoDB collection with variants. Default: variants.')
+argparser_explain.add_argument('-l', '--length', metavar = 'base-pairs', required = False, type = int, default = 100000, dest = 'region_length', help = 'Length of the region used in the test queries. Default: 100000.')
+
 #argparser_update_variants = argparser_subparsers.add_parser('update', help = 'Updates variants collection with provided INFO fields from input VCF/BCF.')
 #argparser_update_variants.add_argument('-v', '--variants', metavar = 'file', required = True, type = str, nargs = '+', dest = 'variants_files', help = 'VCF/BCF file (or multiple files split by chromosome) with variants, compressed using bgzip and indexed using tabix.')
 #argparser_update_variants.add_argument('-t', '--threads', metavar = 'number', required = True, type = int, default = 1, dest = 'threads', help = 'Number of threads to use.')
@@ -65,8 +86,21 @@ def get_db_connection():
     return mongo[mongo_db_name]
 
 
+def set_collection_version(db, name):
+    """Records that the collection(s) `name` were (re)loaded, so that running BRAVO instances can refresh what they keep in memory.
+
+    Arguments:
+    name -- name of the loaded dataset, e.g. 'genes' or 'metrics'. Every `load_*` function records its dataset.
+    """
+    db.versions.replace_one({'_id': name}, {'_id': name, 'loaded_at': datetime.datetime.utcnow()}, upsert = True)
+
+
+gene_models_batch_size = 10000 # number of genes, transcripts or exons inserted at once
+
+
 def load_gene_models(canonical_transcripts_file, omim_file, genenames_file, gencode_file):
     """Creates and populates the following MongoDB collections: genes, transcripts, exons.
+    Collections are loaded into staging collections, which replace the live collections when all three are done.
 
     Arguments:
     canonical_transcripts_file -- file with a list of canonical transcripts. No header. Two columns: Ensebl gene ID, Ensembl transcript ID.
@@ -75,9 +109,11 @@ def load_gene_models(canonical_transcripts_file, omim_file, genenames_file, genc
     gencode_file -- file from GENCODE in compressed GTF format.
     """
     db = get_db_connection()
-    db.genes.drop()
-    db.transcripts.drop()
-    db.exons.drop()
+    for collection in ['genes', 'transcripts', 'exons']:
+        db[_get_staging_name(collection)].drop() # gene models load in minutes, so they are always loaded from scratch
+    genes = db[_get_staging_name('genes')]
+    transcripts = db[_get_staging_name('transcripts')]
+    exons = db[_get_staging_name('exons')]
 
     canonical_transcripts = dict()
     with gzip.GzipFile(canonical_transcripts_file, 'r') as ifile:
@@ -94,30 +130,47 @@ def load_gene_models(canonical_transcripts_file, omim_file, genenames_file, genc
         for gene in parsing.get_genenames(ifile):
             genenames[gene['ensembl_gene']] = (gene['gene_full_name'], gene['gene_other_names'])
 
+    # one pass over GENCODE: every region goes to the batch of its collection, batches are inserted unordered when full
+    batches = {'genes': [], 'transcripts': [], 'exons': []}
     with gzip.GzipFile(gencode_file, 'r') as ifile:
-        for gene in parsing.get_regions_from_gencode_gtf(ifile, {'gene'}):
-            gene_id = gene['gene_id']
-            if gene_id in canonical_transcripts:
-                gene['canonical_transcript'] = canonical_transcripts[gene_id]
-            if gene_id in omim_annotations:
-                gene['omim_accession'] = omim_annotations[gene_id][0]
-                gene['omim_description'] = omim_annotations[gene_id][1]
-            if gene_id in genenames:
-                gene['full_gene_name'] = genenames[gene_id][0]
-                gene['other_names'] = genenames[gene_id][1]
-            db.genes.insert_one(gene)
-    db.genes.create_indexes([pymongo.operations.IndexModel(key) for key in ['gene_id', 'gene_name', 'other_names', 'xstart', 'xstop']])
-    sys.stdout.write('Inserted {} gene(s).\n'.format(db.genes.count()))
-
-    with gzip.GzipFile(gencode_file, 'r') as ifile:
-        db.transcripts.insert_many(transcript for transcript in parsing.get_regions_from_gencode_gtf(ifile, {'transcript'}))
-    db.transcripts.create_indexes([pymongo.operations.IndexModel(key) for key in ['transcript_id', 'gene_id']])
-    sys.stdout.write('Inserted {} transcript(s).\n'.format(db.transcripts.count()))
-
-    with gzip.GzipFile(gencode_file, 'r') as ifile:
-        db.exons.insert_many(exon for exon in parsing.get_regions_from_gencode_gtf(ifile, {'exon', 'CDS', 'UTR'}))
-    db.exons.create_indexes([pymongo.operations.IndexModel(key) for key in ['exon_id', 'transcript_id', 'gene_id']])
-    sys.stdout.write('Inserted {} exon(s).\n'.format(db.exons.count()))
+        for region in parsing.get_regions_from_gencode_gtf(ifile, {'gene', 'transcript', 'exon', 'CDS', 'UTR'}):
+            if 'feature_type' in region:
+                collection = 'exons'
+            elif 'gene_name' in region:
+                collection = 'genes'
+                gene_id = region['gene_id']
+                if gene_id in canonical_transcripts:
+                    region['canonical_transcript'] = canonical_transcripts[gene_id]
+                if gene_id in omim_annotations:
+                    region['omim_accession'] = omim_annotations[gene_id][0]
+                    region['omim_description'] = omim_annotations[gene_id][1]
+                if gene_id in genenames:
+                    region['full_gene_name'] = genenames[gene_id][0]
+                    region['other_names'] = genenames[gene_id][1]
+            else:
+                collection = 'transcripts'
+            batch = batches[collection]
+            batch.append(region)
+            if len(batch) >= gene_models_batch_size:
+                db[_get_staging_name(collection)].insert_many(batch, ordered = False)
+                del batch[:]
+    for collection, batch in batches.iteritems():
+        if batch:
+            db[_get_staging_name(collection)].insert_many(batch, ordered = False)
+
+    # indexes of the three collections are built concurrently
+    indexes = [
+        (genes, ['gene_id', 'gene_name', 'other_names', 'xstart', 'xstop']),
+        (transcripts, ['transcript_id', 'gene_id']),
+        (exons, ['exon_id', 'transcript_id', 'gene_id'])
+    ]
+    with contextlib.closing(multiprocessing.pool.ThreadPool(len(indexes))) as threads_pool:
+        threads_pool.map(lambda (collection, keys): collection.create_indexes([pymongo.operations.IndexModel(key, background = True) for key in keys]), indexes)
+    sys.stdout.write('Inserted {} gene(s).\n'.format(genes.count()))
+    sys.stdout.write('Inserted {} transcript(s).\n'.format(transcripts.count()))
+    sys.stdout.write('Inserted {} exon(s).\n'.format(exons.count()))
+    finish_staging(db, 'genes', 'transcripts', 'exons')
+    set_collection_version(db, 'genes')
 
 
 def create_users():
@@ -160,28 +213,217 @@ def get_file_contig_pairs(files):
     return sorted(file_contig_pairs, key = lambda x: x[1]) # stable sort to make same chromsome entries adjacent
 
 
-def _write_to_collection(args, collection, reader, histograms = True):
-    file, chrom = args
-    if chrom != 'PAR':
-        db = get_db_connection()
-        documents = reader(file, chrom, None, None, histograms)
-        for document in documents:
-            db[collection].insert_many(chain([document], islice(documents, 99999))) # insert in chunks of 100000 documents
+insert_batch_size = 1000 # number of documents sent to MongoDB in one insert; pymongo splits larger messages itself
+progress_interval = 10 # seconds between progress reports
+# fields that are shown only on the variant page and are moved from `variants` to `variant_details`
+variant_details_fields = ['genotype_depths', 'genotype_qualities', 'quality_metrics', 'quality_metrics_percentiles', 'pop_afs']
+
+
+def get_file_contig_chunks(files, chunk_size):
+    """Creates [(file, chrom, start, end), ...] list, which splits every chromosome into chunks of `chunk_size` base-pairs using tabix index.
+    Positions are 0-based and end is exclusive. The last chunk of every chromosome has no end (None), so no records are missed.
+
+    Arguments:
+    files -- list of one or more tabix'ed files.
+    chunk_size -- chunk size in base-pairs.
+    """
+    contig_sizes = {file: get_tabix_contig_sizes(file) for file in set(files)}
+    for file in sorted(set(files)):
+        if not contig_sizes[file]:
+            sys.stdout.write('Warning: no tabix (.tbi) or CSI (.csi) index found for {}. Every chromosome of this file is loaded as a single chunk.\n'.format(file))
+    file_contig_chunks = []
+    for file, chrom in get_file_contig_pairs(files):
+        size = contig_sizes[file].get(chrom, 0)
+        starts = range(0, size, chunk_size) if size > 0 else [0]
+        for i, start in enumerate(starts):
+            file_contig_chunks.append((file, chrom, start, starts[i + 1] if i + 1 < len(starts) else None))
+    return file_contig_chunks
+
+
+def _init_loading_worker():
+    # every worker process keeps one connection for all chunks it loads
+    global worker_db
+    worker_db = get_db_connection()
+
+
+def _get_chunk_object_id(load_id, chunk_index, document_index):
+    """Returns ObjectId for a document loaded from a chunk. All ids of a chunk share the same 8 leading bytes, so that documents left by an interrupted attempt can be found and removed.
+    Ids start with the load id, so that documents of different loads never share an id, e.g. when variants are joined with variant details during a reload.
+
+    Arguments:
+    load_id -- id of the load returned by `start_staging`.
+    chunk_index -- index of the chunk in the list returned by `get_file_contig_chunks`.
+    document_index -- index of the document within the chunk.
+    """
+    return bson.objectid.ObjectId(struct.pack('>III', load_id, chunk_index, document_index))
+
+
+def _insert_chunk_batch(collection, batch, details_collection, details_batch):
+    worker_db[collection].insert_many(batch, ordered = False)
+    if details_batch:
+        worker_db[details_collection].insert_many(details_batch, ordered = False)
+
+
+def _write_chunk_to_collection(args, collection, reader, histograms, annotation_fields, details_collection, load_id):
+    chunk_index, (file, chrom, start, end) = args
+    n_documents = 0
+    if chrom == 'PAR':
+        return n_documents
+    annotation_codec = AnnotationCodec(annotation_fields)
+    chunk_ids = {'$gte': _get_chunk_object_id(load_id, chunk_index, 0), '$lt': _get_chunk_object_id(load_id, chunk_index + 1, 0)}
+    worker_db[collection].delete_many({'_id': chunk_ids})
+    if details_collection is not None:
+        worker_db[details_collection].delete_many({'_id': chunk_ids})
+    batch = []
+    details_batch = []
+    for document in reader(file, chrom, start, end, histograms):
+        document['_id'] = _get_chunk_object_id(load_id, chunk_index, n_documents + len(batch))
+        if annotation_codec.compact:
+            document['vep_annotations'] = annotation_codec.encode_all(document['vep_annotations'])
+        batch.append(document)
+        if details_collection is not None:
+            details = {'_id': document['_id']}
+            for field in variant_details_fields:
+                if field in document:
+                    details[field] = document.pop(field)
+            if len(details) > 1:
+                details_batch.append(details)
+        if len(batch) >= insert_batch_size:
+            _insert_chunk_batch(collection, batch, details_collection, details_batch)
+            n_documents += len(batch)
+            batch = []
+            details_batch = []
+    if batch:
+        _insert_chunk_batch(collection, batch, details_collection, details_batch)
+        n_documents += len(batch)
+    worker_db.load_checkpoints.update_one({'_id': collection}, {'$addToSet': {'done': chunk_index}})
+    return n_documents
+
+
+def _get_staging_name(collection):
+    return '{}_staging'.format(collection)
+
+
+def start_staging(db, collection, inputs):
+    """Prepares staging collection, where `collection` is loaded before it replaces the live one.
+    Returns set of indices of chunks that were already loaded by an interrupted run with the same inputs, and the id of the load (32-bit integer), which is kept when an interrupted load resumes.
+    If inputs differ from the interrupted run, then staging collection is dropped and loading starts from scratch.
+
+    Arguments:
+    db -- database connection.
+    collection -- name of the live MongoDB collection.
+    inputs -- list that identifies the load e.g. input file names, sizes, modification times and chunk size. Must be BSON serializable.
+    """
+    staging = _get_staging_name(collection)
+    checkpoint = db.load_checkpoints.find_one({'_id': staging})
+    if checkpoint is not None and checkpoint['inputs'] == inputs and 'load_id' in checkpoint:
+        return set(checkpoint['done']), checkpoint['load_id']
+    db[staging].drop()
+    load_id = int(time.time()) & 0xffffffff # the previous load of the same collection started at least a second earlier
+    db.load_checkpoints.replace_one({'_id': staging}, {'_id': staging, 'inputs': inputs, 'done': [], 'load_id': load_id}, upsert = True)
+    return set(), load_id
+
+
+def finish_staging(db, *collections):
+    """Atomically replaces every live collection with its staging collection, which must already have all its indexes.
+    Collections are replaced in the given order. Nothing is replaced if any of the staging collections is missing, e.g. after a partial load or when the swap is re-run.
+
+    Arguments:
+    db -- database connection.
+    collections -- names of the live MongoDB collections.
+    """
+    existing = set(db.collection_names())
+    missing = [_get_staging_name(collection) for collection in collections if _get_staging_name(collection) not in existing]
+    if missing:
+        raise Exception('Staging collection(s) {} not found. Load the data again.'.format(', '.join(missing)))
+    for collection in collections:
+        staging = _get_staging_name(collection)
+        # annotations are decoded according to the fields stored for the live collection
+        annotation_fields = db.annotation_fields.find_one({'_id': staging})
+        if annotation_fields is not None:
+            db.annotation_fields.replace_one({'_id': collection}, {'_id': collection, 'fields': annotation_fields['fields']}, upsert = True)
+        db[staging].rename(collection, dropTarget = True)
+        if annotation_fields is None:
+            db.annotation_fields.delete_one({'_id': collection})
+        db.annotation_fields.delete_one({'_id': staging})
+        db.load_checkpoints.delete_one({'_id': staging})
+
+
+def _write_chunks_to_staging(files, collection, reader, threads, chunk_size, histograms = True, annotation_fields = None, details_collection = None):
+    """Loads records into the staging collection of `collection`. Chunks of chromosomes are loaded in parallel and progress is reported every `progress_interval` seconds.
+    Chunks loaded by an interrupted run with the same input files and chunk size are skipped.
+
+    Arguments:
+    files -- list of one or more files compressed using bgzip and indexed using tabix.
+    collection -- name of the live MongoDB collection.
+    reader -- function that yields documents for (file, chrom, start, end, histograms).
+    threads -- number of threads to use.
+    chunk_size -- chunk size in base-pairs.
+    histograms -- if True, includes DP and GQ histograms.
+    annotation_fields -- if not None, VEP annotations are stored as positional arrays of these fields (see utils.AnnotationCodec).
+    details_collection -- if not None, fields listed in `variant_details_fields` are moved to the staging collection of `details_collection`, under the same `_id`.
+    """
+    db = get_db_connection()
+    inputs = [[os.path.abspath(file), os.path.getsize(file), int(os.path.getmtime(file))] for file in files] + [chunk_size, histograms, annotation_fields, details_collection]
+    done, load_id = start_staging(db, collection, inputs)
+    if details_collection is not None:
+        if not done:
+            db[_get_staging_name(details_collection)].drop()
+        # created up front, so that it can be swapped in even when no record has details
+        if _get_staging_name(details_collection) not in db.collection_names():
+            db.create_collection(_get_staging_name(details_collection))
+    if annotation_fields is not None:
+        db.annotation_fields.replace_one({'_id': _get_staging_name(collection)}, {'_id': _get_staging_name(collection), 'fields': annotation_fields}, upsert = True)
+    else:
+        db.annotation_fields.delete_one({'_id': _get_staging_name(collection)})
+    chunks = [(i, chunk) for i, chunk in enumerate(get_file_contig_chunks(files, chunk_size)) if i not in done]
+    sys.stdout.write('Loading {} chunk(s) of up to {} base-pairs into {}. Skipped {} chunk(s) loaded before.\n'.format(len(chunks), chunk_size, _get_staging_name(collection), len(done)))
+    n_documents = 0
+    n_chunks = 0
+    start_time = time.time()
+    report_time = start_time
+    with contextlib.closing(multiprocessing.Pool(threads, _init_loading_worker)) as threads_pool:
+        # chunks are handed to workers one at a time, so every worker holds at most one insert batch in memory
+        for n in threads_pool.imap_unordered(functools.partial(_write_chunk_to_collection, collection = _get_staging_name(collection), reader = reader, histograms = histograms, annotation_fields = annotation_fields, details_collection = _get_staging_name(details_collection) if details_collection is not None else None, load_id = load_id), chunks, chunksize = 1):
+            n_documents += n
+            n_chunks += 1
+            if time.time() - report_time >= progress_interval or n_chunks == len(chunks):
+                report_time = time.time()
+                sys.stdout.write('Loaded {} record(s) from {}/{} chunk(s), {:.0f} record(s)/sec.\n'.format(n_documents, n_chunks, len(chunks), n_documents / max(report_time - start_time, 1e-6)))
+                sys.stdout.flush()
+    return db[_get_staging_name(collection)]
+
+
+def _get_annotation_fields(variants_files):
+    """Returns field names of VEP annotations, which must be the same in all files.
+
+    Arguments:
+    variants_files -- list of one or more VCF/BCF files with variants.
+    """
+    annotation_fields = None
+    for variants_file in variants_files:
+        fields = parsing.get_vep_annotation_fields(variants_file)
+        if annotation_fields is not None and fields != annotation_fields:
+            raise Exception('VEP annotation fields in {} differ from other files.'.format(variants_file))
+        annotation_fields = fields
+    return annotation_fields
 
 
-def load_dbsnp(dbsnp_files, threads):
+def load_dbsnp(dbsnp_files, threads, chunk_size):
     """Creates and populates MongoDB collection for dbSNP variants.
+    Variants are loaded into a staging collection, which replaces the live collection when done. Interrupted load resumes from the last loaded chunk.
 
     Arguments:
     dbsnp_files -- list of one or more files with variants compressed using bgzip and indexed using tabix. File(s) must have 3 tab-delimited columns without header: integer part of rsId, chromosome, position (0-based).
     threads -- number of threads to use.
+    chunk_size -- chromosomes are split into chunks of this many base-pairs, which are loaded in parallel.
     """
     db = get_db_connection()
-    db.dbsnp.drop()
-    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = 'dbsnp', reader = parsing.get_snp_from_dbsnp_file), get_file_contig_pairs(dbsnp_files))
-    db.dbsnp.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'rsid']])
-    sys.stdout.write('Inserted {} variant(s).\n'.format(db.dbsnp.count()))
+    staging = _write_chunks_to_staging(dbsnp_files, 'dbsnp', parsing.get_snp_from_dbsnp_file, threads, chunk_size, histograms = False)
+    staging.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'rsid']])
+    sys.stdout.write('Inserted {} variant(s).\n'.format(staging.count()))
+    finish_staging(db, 'dbsnp')
+    set_collection_version(db, 'dbsnp')
 
 
 def load_metrics(metrics_file):
@@ -198,21 +440,280 @@ def load_metrics(metrics_file):
             db.metrics.insert(metric)
     db.metrics.create_index('metric')
     sys.stdout.write('Inserted {} metric(s).\n'.format(db.metrics.count()))
+    set_collection_version(db, 'metrics')
 
 
-def load_variants(variants_files, threads):
+def load_variants(variants_files, threads, chunk_size, compact_annotations):
     """Creates and populates MongoDB collection for variants.
+    Variants are loaded into a staging collection, which replaces the live collection when done. Interrupted load resumes from the last loaded chunk.
+    Fields listed in `variant_details_fields`, which are needed only on the variant page, are stored in the `variant_details` collection under the same `_id`.
 
     Arguments:
     variants_files -- list of one or more VCF/BCF files with variants (no genotypes) compressed using bgzip and indexed using tabix.
     threads -- number of threads to use.
+    chunk_size -- chromosomes are split into chunks of this many base-pairs, which are loaded in parallel.
+    compact_annotations -- if True, VEP annotations are stored as positional arrays (see utils.AnnotationCodec).
+    """
+    db = get_db_connection()
+    annotation_fields = _get_annotation_fields(variants_files) if compact_annotations else None
+    staging = _write_chunks_to_staging(variants_files, 'variants', parsing.get_variants_from_sites_vcf, threads, chunk_size, annotation_fields = annotation_fields, details_collection = 'variant_details')
+    staging.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'rsids', 'filter']] + get_variants_indexes())
+    sys.stdout.write('Inserted {} variant(s).\n'.format(staging.count()))
+    # details are swapped in first. Variants from the previous load have other ids, so the variant page shows them without details until they are swapped too.
+    # The new version is recorded right away, so that running instances refresh the annotation codec of the new collection (see ANNOTATION_CODEC_CHECK_INTERVAL in lookups.py)
+    finish_staging(db, 'variant_details', 'variants')
+    set_collection_version(db, 'variants')
+
+
+# Keys by which variants can be sorted in the API. Every sort is followed by `_id` ascending as a tie-breaker.
+variants_sort_keys = ['xpos', 'allele_count', 'allele_num', 'allele_freq', 'site_quality', 'filter', 'variant_id']
+# Columns of the variant table in the browser (see static/plot.js), in the same order.
+browser_variants_columns = ['allele', 'pos', 'csq', 'filter', 'allele_num', 'het', 'hom_count', 'allele_freq']
+explain_max_keys_per_match = 2 # queries that examine more index keys per matching variant walk the index instead of the region
+
+
+def get_variants_indexes():
+    """Returns compound indexes for region queries from the API and the browser.
+    Every region query is bounded by `xpos`, which is the most selective condition, so all sort orders scan the `xpos` range.
+    Queries sorted by position (the default) also get their `_id` tie-breaker from the index and don't sort in memory.
+    Other orders sort the variants of the region in memory: indexes that start with the sort key would walk the whole collection instead.
+    """
+    return [pymongo.operations.IndexModel([('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])]
+
+
+def create_variants_indexes(collection_name):
+    """Creates compound indexes for sorted and filtered region queries. Existing indexes are kept.
+
+    Arguments:
+    collection_name -- name of MongoDB collection with variants.
+    """
+    db = get_db_connection()
+    for index in get_variants_indexes():
+        start_time = time.time()
+        name = db[collection_name].create_indexes([index])[0]
+        sys.stdout.write('Created index {} in {:.1f} seconds.\n'.format(name, time.time() - start_time))
+
+
+def _get_plan_stages(plan):
+    """Yields all stages in the query plan tree."""
+    yield plan
+    for child in [plan.get('inputStage', None)] + plan.get('inputStages', []):
+        if child is not None:
+            for stage in _get_plan_stages(child):
+                yield stage
+
+
+def _get_variants_test_queries(db, collection_name, region_length):
+    """Returns [(description, filter, sort, limit), ...] with the query shapes used by the API (server-api.py) and to look up single variants (lookups.py).
+
+    Arguments:
+    db -- database connection.
+    collection_name -- name of MongoDB collection with variants.
+    region_length -- length of the region in base-pairs.
+    """
+    variant = db[collection_name].find_one(projection = {'_id': True, 'xpos': True, 'ref': True, 'alt': True, 'rsids': True})
+    if variant is None:
+        return []
+    xstart = variant['xpos']
+    xstop = xstart + region_length
+    region = [{'xpos': {'$gte': xstart}}, {'xpos': {'$lte': xstop}}]
+    queries = [
+        ('variant by position', {'xpos': variant['xpos'], 'ref': variant['ref'], 'alt': variant['alt']}, None, 0),
+        ('region', {'$and': region}, [('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 100),
+        ('region, PASS only', {'$and': region + [{'filter': 'PASS'}]}, [('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 100),
+        ('region, next page', {'$and': [{'$or': [{'xpos': {'$gt': xstart}}, {'_id': {'$gt': variant['_id']}}]}] + region}, [('xpos', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 100)
+    ]
+    if variant.get('rsids', None):
+        queries.append(('variant by rsid', {'rsids': variant['rsids'][0]}, None, 0))
+    for key in variants_sort_keys:
+        for direction in [pymongo.ASCENDING, pymongo.DESCENDING]:
+            queries.append(('region sorted by {} {}'.format(key, 'asc' if direction == pymongo.ASCENDING else 'desc'), {'$and': region}, [(key, direction), ('_id', pymongo.ASCENDING)], 100))
+    return queries
+
+
+def _get_browser_test_pipelines(db, collection_name, region_length):
+    """Returns [(description, pipeline), ...] with the aggregation pipelines that the variant table in the browser runs (see lookups.get_variants_subset_pipeline).
+
+    Arguments:
+    db -- database connection.
+    collection_name -- name of MongoDB collection with variants.
+    region_length -- length of the region in base-pairs.
+    """
+    variant = db[collection_name].find_one(projection = {'_id': False, 'xpos': True})
+    if variant is None:
+        return []
+    chrom, start = Xpos.to_chrom_pos(variant['xpos'])
+    intervalset = lookups.IntervalSet.from_chrom_start_stop(chrom, start, start + region_length)
+    columns = [{'name': name} for name in browser_variants_columns]
+    orders = [('default', [{'column': browser_variants_columns.index('csq'), 'dir': 'asc'}, {'column': -1, 'dir': 'desc'}])]
+    for name in ['pos', 'csq', 'allele_num', 'het', 'hom_count', 'allele_freq']:
+        for direction in ['asc', 'desc']:
+            orders.append(('{} {}'.format(name, direction), [{'column': browser_variants_columns.index(name), 'dir': direction}]))
+    pipelines = []
+    for filter_description, filter_info in [('', {}), (', PASS only', {'filter_value': 'PASS'}), (', LoF', {'category': 'LoF'})]:
+        for order_description, order in orders:
+            pipelines.append(('browser region{}, sorted by {}'.format(filter_description, order_description), lookups.get_variants_subset_pipeline(db, intervalset, columns, order, filter_info, 100)))
+    return pipelines
+
+
+def _explain_find(collection, mongo_filter, mongo_sort, limit):
+    """Returns (winning plan stages, execution stats, number of matching documents) for a find query."""
+    cursor = collection.find(mongo_filter).limit(limit)
+    if mongo_sort:
+        cursor = cursor.sort(mongo_sort)
+    explain = cursor.explain()
+    return list(_get_plan_stages(explain['queryPlanner']['winningPlan'])), explain.get('executionStats', {}), collection.count(mongo_filter)
+
+
+def _explain_pipeline(db, collection_name, pipeline):
+    """Returns (winning plan stages, execution stats, number of matching documents, True if sorts in memory) for an aggregation pipeline.
+    Aggregation explain has no execution statistics in MongoDB 3.4, so they are taken from the query that the pipeline sends to the collection.
+    """
+    # SON keeps the order of the sort keys
+    explain = db.command('aggregate', collection_name, pipeline = pipeline, explain = True, codec_options = bson.codec_options.CodecOptions(document_class = bson.son.SON))
+    stages = explain.get('stages', [])
+    cursor_stage = stages[0]['$cursor'] if stages and '$cursor' in stages[0] else explain
+    sort_in_memory = any('$sort' in stage for stage in stages)
+    plan_stages, stats, n_matching = _explain_find(db[collection_name], cursor_stage.get('query', {}), cursor_stage.get('sort', {}).items(), cursor_stage.get('limit', 0))
+    return plan_stages, stats, n_matching, sort_in_memory or any(stage['stage'] == 'SORT' for stage in plan_stages)
+
+
+def explain_variants_queries(collection_name, region_length):
+    """Runs explain on representative API queries and browser pipelines. Reports queries that scan the whole collection or examine
+    many more index keys than there are matching variants (i.e. walk an index in sort order instead of scanning the region), and indexes that no query used.
+    Returns the number of such queries.
+
+    Arguments:
+    collection_name -- name of MongoDB collection with variants.
+    region_length -- length of the region in base-pairs.
+    """
+    db = get_db_connection()
+    explains = []
+    for description, mongo_filter, mongo_sort, limit in _get_variants_test_queries(db, collection_name, region_length):
+        plan_stages, stats, n_matching = _explain_find(db[collection_name], mongo_filter, mongo_sort, limit)
+        explains.append((description, plan_stages, stats, n_matching, limit, any(stage['stage'] == 'SORT' for stage in plan_stages)))
+    for description, pipeline in _get_browser_test_pipelines(db, collection_name, region_length):
+        plan_stages, stats, n_matching, sort_in_memory = _explain_pipeline(db, collection_name, pipeline)
+        explains.append((description, plan_stages, stats, n_matching, 100, sort_in_memory))
+    n_problems = 0
+    used_indexes = set()
+    for description, plan_stages, stats, n_matching, limit, sort_in_memory in explains:
+        used_indexes.update(stage['indexName'] for stage in plan_stages if 'indexName' in stage)
+        keys_examined = stats.get('totalKeysExamined', 0)
+        problems = []
+        if any(stage['stage'] == 'COLLSCAN' for stage in plan_stages):
+            problems.append('collection scan')
+        if keys_examined > explain_max_keys_per_match * max(n_matching, limit, 1):
+            problems.append('index walk')
+        sys.stdout.write('{}\t{}\tindex: {}, sort: {}, matching: {}, returned: {}, keys examined: {}, documents examined: {}, time: {} ms\n'.format(
+            description, ', '.join(problems) if problems else 'OK',
+            ', '.join(sorted(set(stage['indexName'] for stage in plan_stages if 'indexName' in stage))) or 'none', 'in memory' if sort_in_memory else 'index',
+            n_matching, stats.get('nReturned', 'NA'), keys_examined, stats.get('totalDocsExamined', 'NA'), stats.get('executionTimeMillis', 'NA')))
+        if problems:
+            n_problems += 1
+    unused_indexes = sorted(name for name in db[collection_name].index_information() if name != '_id_' and name not in used_indexes)
+    if unused_indexes:
+        sys.stdout.write('Indexes not used by any of the queries: {}.\n'.format(', '.join(unused_indexes)))
+    return n_problems
+
+
+def _get_exon_intervalsets(db, id_field):
+    """Creates [(chrom, id, list_of_pairs), ...] list with the same padded exon extents that the browser uses for every gene or transcript.
+
+    Arguments:
+    id_field -- either 'gene_id' or 'transcript_id'.
+    """
+    exons = db.exons.find({id_field: {'$ne': None}, 'feature_type': {'$in': ['CDS', 'UTR', 'exon']}}, projection = {'_id': False, id_field: True, 'chrom': True, 'start': True, 'stop': True}).sort(id_field, pymongo.ASCENDING)
+    intervalsets = []
+    for region_id, region_exons in groupby(exons, key = lambda exon: exon[id_field]):
+        intervalset = lookups.IntervalSet._from_exons(region_exons)
+        intervalsets.append((intervalset.chrom, region_id, intervalset.to_obj()['list_of_pairs']))
+    return intervalsets
+
+
+def _write_summaries_for_chrom(args):
+    """Writes cumulative counts of PASS variants on a single chromosome in blocks of SUMMARY_PREFIX_BLOCK_SIZE bases, and returns summary documents for the given genes/transcripts.
+    Both are computed in a single sweep over the variants sorted by position.
+
+    Arguments:
+    args -- pair of chromosome name and [(id_field, id, list_of_pairs), ...] list of genes/transcripts on this chromosome.
+    """
+    chrom, intervalsets = args
+    db = get_db_connection()
+    n_keys = len(lookups.SUMMARY_KEYS)
+    endpoints = [] # counts at `stop` minus counts at `start - 1` for every extent
+    for i, (id_field, region_id, list_of_pairs) in enumerate(intervalsets):
+        for start, stop in list_of_pairs:
+            endpoints.append((start - 1, i, -1))
+            endpoints.append((stop, i, 1))
+    endpoints.sort()
+    region_counts = [[0] * n_keys for _ in intervalsets]
+    running = [0] * n_keys
+
+    def new_block(block):
+        return {'chrom': chrom, 'block': block, 'before': dict(zip(lookups.SUMMARY_KEYS, running)), 'pos': [], 'counts': {key: [] for key in lookups.SUMMARY_KEYS}}
+
+    blocks = [new_block(-1)] # so that every position has a block at or before it, even before the first variant
+    n_variants = 0
+    i_endpoint = 0
+    xstart, xstop = Xpos.from_chrom_pos(chrom, 0), Xpos.from_chrom_pos(chrom, int(1e9) - 1)
+    annotation_codec = AnnotationCodec.load(db, 'variants')
+    projection = {'_id': False, 'pos': True, 'ref': True, 'alt': True, 'worst_csqidx': True}
+    projection.update(annotation_codec.projection(['LoF']))
+    variants = db.variants.find({'xpos': {'$gte': xstart, '$lte': xstop}, 'filter': 'PASS'}, projection = projection).sort('xpos', pymongo.ASCENDING)
+    for variant in variants:
+        if 'vep_annotations' in variant:
+            variant['vep_annotations'] = annotation_codec.decode_all(variant['vep_annotations'])
+        pos = variant['pos']
+        while i_endpoint < len(endpoints) and endpoints[i_endpoint][0] < pos:
+            _, i, sign = endpoints[i_endpoint]
+            region_counts[i] = [c + sign * r for c, r in zip(region_counts[i], running)]
+            i_endpoint += 1
+        block = pos // lookups.SUMMARY_PREFIX_BLOCK_SIZE
+        if blocks[-1]['block'] != block:
+            if len(blocks) >= 1000:
+                db[_get_staging_name('summary_prefixes')].insert_many(blocks)
+                blocks = []
+            blocks.append(new_block(block))
+        running = [r + f for r, f in zip(running, lookups.get_summary_flags_for_variant(variant))]
+        blocks[-1]['pos'].append(pos)
+        for key, r in zip(lookups.SUMMARY_KEYS, running):
+            blocks[-1]['counts'][key].append(r - blocks[-1]['before'][key])
+        n_variants += 1
+    for _, i, sign in endpoints[i_endpoint:]:
+        region_counts[i] = [c + sign * r for c, r in zip(region_counts[i], running)]
+    db[_get_staging_name('summary_prefixes')].insert_many(blocks)
+    sys.stdout.write('Chromosome {}. Summarized {} PASS variant(s) for {} gene(s)/transcript(s).\n'.format(chrom, n_variants, len(intervalsets)))
+    return [{id_field: region_id, 'counts': dict(zip(lookups.SUMMARY_KEYS, counts))} for (id_field, region_id, _), counts in zip(intervalsets, region_counts)]
+
+
+def load_summaries(threads):
+    """Creates and populates MongoDB collections with variant summaries: summaries (per gene and per transcript) and summary_prefixes (cumulative counts per chromosome).
+    Both are loaded into staging collections, which replace the live ones when done, so that running instances never see partially loaded counts.
+
+    Arguments:
+    threads -- number of threads to use.
     """
     db = get_db_connection()
-    db.variants.drop()
+    summaries = db[_get_staging_name('summaries')]
+    summary_prefixes = db[_get_staging_name('summary_prefixes')]
+    for staging in [summaries, summary_prefixes]:
+        staging.drop()
+        db.create_collection(staging.name)
+    intervalsets = {chrom: [] for chrom in Xpos.CHROMOSOME_STRINGS}
+    for id_field in ['gene_id', 'transcript_id']:
+        for chrom, region_id, list_of_pairs in _get_exon_intervalsets(db, id_field):
+            if chrom in intervalsets:
+                intervalsets[chrom].append((id_field, region_id, list_of_pairs))
     with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = 'variants', reader = parsing.get_variants_from_sites_vcf), get_file_contig_pairs(variants_files))
-    db.variants.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'rsids', 'filter']])
-    sys.stdout.write('Inserted {} variant(s).\n'.format(db.variants.count()))
+        for documents in threads_pool.imap_unordered(_write_summaries_for_chrom, intervalsets.items()):
+            if documents:
+                summaries.insert_many(documents)
+    summaries.create_indexes([pymongo.operations.IndexModel(key) for key in ['gene_id', 'transcript_id']])
+    summary_prefixes.create_index([('chrom', pymongo.ASCENDING), ('block', pymongo.ASCENDING)])
+    sys.stdout.write('Inserted {} gene/transcript summaries.\n'.format(summaries.count()))
+    finish_staging(db, 'summaries', 'summary_prefixes')
+    set_collection_version(db, 'summaries')
 
 
 def create_sequence_cache(collection_name):
@@ -226,21 +727,43 @@ def create_sequence_cache(collection_name):
     sequences.SequencesClient.create_cache_collection_and_index(db, collection_name)
 
 
-def load_custom_variants(variants_files, collection_name, threads):
+def load_custom_variants(variants_files, collection_name, threads, chunk_size, compact_annotations):
     """Creates and populates MongoDB collection with given name for additional variants.
+    Variants are loaded into a staging collection, which replaces the live collection when done. Interrupted load resumes from the last loaded chunk.
 
     Arguments:
     variants_files -- list of one or more VCF/BCF files with variants (no genotypes) compressed using bgzip and indexed using tabix.
     collection_name -- name of MongoDB collection that will store variants.
     threads -- number of threads to use.
+    chunk_size -- chromosomes are split into chunks of this many base-pairs, which are loaded in parallel.
+    compact_annotations -- if True, VEP annotations are stored as positional arrays (see utils.AnnotationCodec).
     """
     db = get_db_connection()
-    if collection_name in db.collection_names():
-        db[collection_name].drop()
-    with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
-        threads_pool.map(functools.partial(_write_to_collection, collection = collection_name, reader = parsing.get_variants_from_sites_vcf, histograms = False), get_file_contig_pairs(variants_files))
-    db[collection_name].create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'filter']])
-    sys.stdout.write('Inserted {} variant(s).\n'.format(db[collection_name].count()))
+    annotation_fields = _get_annotation_fields(variants_files) if compact_annotations else None
+    staging = _write_chunks_to_staging(variants_files, collection_name, parsing.get_variants_from_sites_vcf, threads, chunk_size, histograms = False, annotation_fields = annotation_fields)
+    staging.create_indexes([pymongo.operations.IndexModel(key) for key in ['xpos', 'xstop', 'filter']] + get_variants_indexes())
+    sys.stdout.write('Inserted {} variant(s).\n'.format(staging.count()))
+    finish_staging(db, collection_name)
+    set_collection_version(db, collection_name)
+
+
+percentiles_batch_size = 10000 # number of variants, which ids are looked up at once when loading percentiles
+
+
+def _write_percentiles(db, variants):
+    # percentiles are stored with other variant details, which are keyed by `_id` of the variant
+    ids = dict()
+    for variant in db.variants.find({'xpos': {'$in': list(set(v['xpos'] for v in variants))}}, projection = {'_id': True, 'xpos': True, 'ref': True, 'alt': True}):
+        ids[(variant['xpos'], variant['ref'], variant['alt'])] = variant['_id']
+    requests = []
+    for variant in variants:
+        _id = ids.get((variant['xpos'], variant['ref'], variant['alt']), None)
+        if _id is not None:
+            requests.append(pymongo.operations.UpdateOne({'_id': _id}, {'$set': {'quality_metrics_percentiles': variant['percentiles']}}, upsert = True))
+    if not requests:
+        return 0, 0
+    res = db.variant_details.bulk_write(requests, ordered = False)
+    return len(requests), res.modified_count + res.upserted_count
 
 
 def _load_percentiles_from_vcf(vcf):
@@ -250,24 +773,22 @@ def _load_percentiles_from_vcf(vcf):
     n_modified = 0
     with gzip.GzipFile(vcf, 'r') as ivcf:
         start_time = time.time()
-        requests = []
+        variants = []
         for variant in parsing.get_variants_from_sites_vcf_only_percentiles(ivcf):
-            requests.append(pymongo.operations.UpdateOne(
-                {'xpos': variant['xpos'], 'ref': variant['ref'], 'alt': variant['alt']},
-                {'$set': {'quality_metrics_percentiles': variant['percentiles']}},
-                upsert = False))
+            variants.append(variant)
             n_variants += 1
+            if len(variants) == percentiles_batch_size:
+                matched, modified = _write_percentiles(db, variants)
+                n_matched += matched
+                n_modified += modified
+                variants = []
             if n_variants % 1000000 == 0:
-                res = db.variants.bulk_write(requests, ordered = False)
-                n_matched += res.matched_count
-                n_modified += res.modified_count
-                requests = []
                 print 'VCF {}. Processed {} variant(s) in {} second(s), {} matched, {} modified.'.format(vcf, n_variants, int(time.time() - start_time), n_matched, n_modified) 
-        if len(requests) > 0:
-            res = db.variants.bulk_write(requests, ordered = False)
-            n_matched += res.matched_count
-            n_modified += res.modified_count
-            print 'Finished. VCF {}. Processed {} variant(s) in {} second(s), {} matched, {} modified.'.format(vcf, n_variants, int(time.time() - start_time), n_matched, n_modified)
+        if len(variants) > 0:
+            matched, modified = _write_percentiles(db, variants)
+            n_matched += matched
+            n_modified += modified
+        print 'Finished. VCF {}. Processed {} variant(s) in {} second(s), {} matched, {} modified.'.format(vcf, n_variants, int(time.time() - start_time), n_matched, n_modified)
 
 
 def load_percentiles(variant_files, threads):
@@ -279,6 +800,7 @@ def load_percentiles(variant_files, threads):
     """
     with contextlib.closing(multiprocessing.Pool(threads)) as threads_pool:
         threads_pool.map_async(_load_percentiles_from_vcf, variant_files).get(9999999)
+    set_collection_version(get_db_connection(), 'variants')
 
 
 def _update_collection(args, collection, reader):
@@ -354,7 +876,7 @@ if __name__ == '__main__':
     elif args.command == 'dbsnp':
         sys.stdout.write('Creating dbSNP collection in {} database.\n'.format(mongo_db_name))
         sys.stdout.write('Using {} thread(s).\n'.format(args.threads))
-        load_dbsnp(args.dbsnp_files, args.threads)
+        load_dbsnp(args.dbsnp_files, args.threads, args.chunk_size)
         sys.stdout.write('Done creating dbSNP collection in {} database.\n'.format(mongo_db_name))
     elif args.command == 'metrics':
         sys.stdout.write('Creating metrics collection in {} database.\n'.format(mongo_db_name))
@@ -362,20 +884,34 @@ if __name__ == '__main__':
         sys.stdout.write('Done creating metrics collection in {} databases.\n'.format(mongo_db_name))
     elif args.command == 'variants':
         sys.stdout.write('Creating variants collection in {} database.\n'.format(mongo_db_name))
-        load_variants(args.variants_files, args.threads)
+        load_variants(args.variants_files, args.threads, args.chunk_size, args.compact_annotations)
         sys.stdout.write('Done creating variants collection in {} database.\n'.format(mongo_db_name))
+    elif args.command == 'summaries':
+        sys.stdout.write('Creating summaries collections in {} database.\n'.format(mongo_db_name))
+        sys.stdout.write('Using {} thread(s).\n'.format(args.threads))
+        load_summaries(args.threads)
+        sys.stdout.write('Done creating summaries collections in {} database.\n'.format(mongo_db_name))
     elif args.command == 'bam_cache':
         sys.stdout.write('Creating {} collection in {} database.\n'.format(igv_cache_collection_name, mongo_db_name))
         create_sequence_cache(igv_cache_collection_name)
         sys.stdout.write('Done creating {} collection in {} database.\n'.format(igv_cache_collection_name, mongo_db_name))
     elif args.command == 'custom_variants':
         sys.stdout.write('Creating {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
-        load_custom_variants(args.variants_files, args.collection_name, args.threads)
+        load_custom_variants(args.variants_files, args.collection_name, args.threads, args.chunk_size, args.compact_annotations)
         sys.stdout.write('Done creating {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
     elif args.command == 'percentiles':
         sys.stdout.write('Loading percentiles into {} database.\n'.format(mongo_db_name))
         load_percentiles(args.variants_files, args.threads)
         sys.stdout.write('Done loading percentiles into {} database.\n'.format(mongo_db_name))
+    elif args.command == 'indexes':
+        sys.stdout.write('Creating indexes on {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
+        create_variants_indexes(args.collection_name)
+        sys.stdout.write('Done creating indexes on {} collection in {} database.\n'.format(args.collection_name, mongo_db_name))
+    elif args.command == 'explain':
+        n_problems = explain_variants_queries(args.collection_name, args.region_length)
+        sys.stdout.write('Found {} query(ies) with collection scan or index walk.\n'.format(n_problems))
+        if n_problems > 0:
+            sys.exit(1)
 #    elif args.command == 'update':
 #        sys.stdout.write('Updating variants collection in {} database.\n'.format(mongo_db_name))
 #        update_variants(args.variants_files, args.threads)
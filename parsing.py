@@ -5,8 +5,8 @@ import itertools
 import re
 import traceback
 from contextlib import closing
+from urllib import unquote
 
-import boltons.iterutils
 import pysam
 from utils import *
 
@@ -41,14 +41,27 @@ def get_variants_from_sites_vcf_only_percentiles(sites_vcf):
             raise
 
 
+def get_vep_annotation_fields(vcf):
+    """Returns names of the fields in every annotation from `get_variants_from_sites_vcf`: VEP fields from CSQ INFO field description and the fields computed from them.
+
+    Arguments:
+    vcf -- VCF/BCF file name.
+    """
+    with closing(pysam.VariantFile(vcf)) as ifile:
+        vep_meta = ifile.header.info.get('CSQ', None)
+        if vep_meta is None:
+            raise Exception('Missing CSQ INFO field from VEP (Variant Effect Predictor)')
+        return vep_meta.description.split(':', 1)[-1].strip().split('|') + ['worst_csqidx', 'HGVS']
+
+
 def get_variants_from_sites_vcf(vcf, chrom, start_bp, end_bp, histograms = True):
     """Reads sites VCF/BCF file and returns iterator over veriant dicts.
 
     Arguments:
     vcf -- VCF/BCF file name.
     chrom -- chromosome name.
-    start_bp -- start position in base-pairs.
-    end_bp -- end position in base-pairs.
+    start_bp -- start position in base-pairs (0-based). Records that start before it are skipped, even if they overlap it, so that adjacent regions never return the same record.
+    end_bp -- end position in base-pairs (0-based, exclusive).
     histograms -- if True, includes DP and GQ histograms.
     """
     with closing(pysam.VariantFile(vcf)) as ifile:
@@ -68,17 +81,42 @@ def get_variants_from_sites_vcf(vcf, chrom, start_bp, end_bp, histograms = True)
             dp_hist_r_mids = map(float, ifile.header.info['DP_HIST_R'].description.split(':', 1)[-1].strip().split('|'))
             gq_hist_mids = map(float, ifile.header.info['GQ_HIST'].description.split(':', 1)[-1].strip().split('|'))
             gq_hist_r_mids = map(float, ifile.header.info['GQ_HIST_R'].description.split(':', 1)[-1].strip().split('|'))
+        allele_num_idx = vep_field_names.index('ALLELE_NUM')
         for record in ifile.fetch(chrom, start_bp, end_bp):
+            if start_bp is not None and record.start < start_bp:
+                continue
             try:
                 annotations = dict()
                 for annotation in record.info['CSQ']:
                     annotation = annotation.split('|')
                     assert len(vep_field_names) == len(annotation), (vep_field_names, annotation)
-                    annotation = dict(zip(vep_field_names, annotation))
-                    annotations.setdefault(int(annotation['ALLELE_NUM']), []).append(annotation)
+                    annotations.setdefault(int(annotation[allele_num_idx]), []).append(dict(itertools.izip(vep_field_names, annotation)))
+                # values shared by all alternate alleles are read from the record only once
+                info = record.info
+                record_chrom = record.contig[3:] if record.contig.startswith('chr') else record.contig
+                site_quality = record.qual
+                site_filter = ';'.join(record.filter.keys())
+                allele_counts = info['AC']
+                allele_num = info['AN']
+                allele_freqs = info['AF']
+                hom_counts = info['Hom']
+                quality_metrics = {x: info[x] for x in METRICS if x in info}
+                avgdp = info['AVGDP']
+                avgdp_r = info['AVGDP_R']
+                avggq = info['AVGGQ']
+                avggq_r = info['AVGGQ_R']
+                cadd_raw = info['CADD_RAW'] if 'CADD_RAW' in info else None
+                cadd_phred = info['CADD_PHRED'] if 'CADD_PHRED' in info else None
+                if histograms:
+                    dp_hist = map(int, info['DP_HIST'].split('|'))
+                    dp_hist_r = info['DP_HIST_R']
+                    gq_hist = map(int, info['GQ_HIST'].split('|'))
+                    gq_hist_r = info['GQ_HIST_R']
                 for i, alt_allele in enumerate(record.alts):
+                    if allele_counts[i] == 0:
+                        continue
                     variant = {}
-                    variant['chrom'] = record.contig[3:] if record.contig.startswith('chr') else record.contig
+                    variant['chrom'] = record_chrom
                     variant['pos'], variant['ref'], variant['alt'] = get_minimal_representation(record.pos, record.ref, alt_allele)
                     variant['xpos'] = Xpos.from_chrom_pos(variant['chrom'], variant['pos'])
                     variant['xstop'] = variant['xpos'] + len(variant['alt']) - len(variant['ref'])
@@ -88,28 +126,26 @@ def get_variants_from_sites_vcf(vcf, chrom, start_bp, end_bp, histograms = True)
                         variant['rsids'] = [rsid for rsid in allele_annotations[0]['Existing_variation'].split('&') if rsid.startswith('rs')]
                     else:
                         variant['rsids'] = []
-                    variant['site_quality'] = record.qual
-                    variant['filter'] = ';'.join(record.filter.keys())
-                    variant['allele_count'] = record.info['AC'][i]
-                    if variant['allele_count'] == 0:
-                        continue
-                    variant['allele_num'] = record.info['AN']
+                    variant['site_quality'] = site_quality
+                    variant['filter'] = site_filter
+                    variant['allele_count'] = allele_counts[i]
+                    variant['allele_num'] = allele_num
                     assert variant['allele_num'] != 0, variant
-                    variant['allele_freq'] = record.info['AF'][i]
+                    variant['allele_freq'] = allele_freqs[i]
                     assert variant['allele_freq'] != 0, variant
-                    variant['hom_count'] = record.info['Hom'][i]
-                    variant['quality_metrics'] = {x: record.info[x] for x in METRICS if x in record.info}
+                    variant['hom_count'] = hom_counts[i]
+                    variant['quality_metrics'] = dict(quality_metrics)
                     variant['genes'] = list(set(annotation['Gene'] for annotation in allele_annotations if annotation['Gene']))
                     variant['transcripts'] = list(set(annotation['Feature'] for annotation in allele_annotations if annotation['Feature']))
-                    variant['avgdp'] = record.info['AVGDP']
-                    variant['avgdp_alt'] = record.info['AVGDP_R'][i + 1]
-                    variant['avggq'] = record.info['AVGGQ']
-                    variant['avggq_alt'] = record.info['AVGGQ_R'][i + 1]
-                    variant['cadd_raw'] = record.info['CADD_RAW'][i] if 'CADD_RAW' in record.info else None
-                    variant['cadd_phred'] = record.info['CADD_PHRED'][i] if 'CADD_PHRED' in record.info else None
+                    variant['avgdp'] = avgdp
+                    variant['avgdp_alt'] = avgdp_r[i + 1]
+                    variant['avggq'] = avggq
+                    variant['avggq_alt'] = avggq_r[i + 1]
+                    variant['cadd_raw'] = cadd_raw[i] if cadd_raw is not None else None
+                    variant['cadd_phred'] = cadd_phred[i] if cadd_phred is not None else None
                     if histograms:
-                        variant['genotype_depths'] = map(lambda x, y: zip(x, map(int, y.split('|'))), [dp_hist_mids, dp_hist_r_mids], [record.info['DP_HIST'], record.info['DP_HIST_R'][i + 1]])
-                        variant['genotype_qualities'] = map(lambda x, y: zip(x, map(int, y.split('|'))), [gq_hist_mids, gq_hist_r_mids], [record.info['GQ_HIST'], record.info['GQ_HIST_R'][i + 1]])
+                        variant['genotype_depths'] = [zip(dp_hist_mids, dp_hist), zip(dp_hist_r_mids, map(int, dp_hist_r[i + 1].split('|')))]
+                        variant['genotype_qualities'] = [zip(gq_hist_mids, gq_hist), zip(gq_hist_r_mids, map(int, gq_hist_r[i + 1].split('|')))]
                     variant['vep_annotations'] = allele_annotations
                     clean_annotation_consequences_for_variant(variant)
                     pop_afs = get_pop_afs(variant)
@@ -166,11 +202,17 @@ def clean_annotation_consequences_for_variant(variant):
     variant['worst_csqidx'] = worst_anno['worst_csqidx']
     variant['worst_csq_HGVS'] = worst_anno['HGVS']
 
+_worst_csqidxs = {} # memoized worst csqidx for every distinct Consequence string, e.g. 'missense_variant&splice_region_variant'
 def _get_worst_csqidx_for_annotation(annotation):
-    try:
-        return min(Consequence.csqidxs[csq] for csq in annotation['Consequence'].split('&'))
-    except KeyError:
-        raise Exception("failed to get csqidx for {!r} with error: {}".format(annotation['Consequence'], traceback.format_exc()))
+    consequence = annotation['Consequence']
+    csqidx = _worst_csqidxs.get(consequence, None)
+    if csqidx is None:
+        try:
+            csqidx = min(Consequence.csqidxs[csq] for csq in consequence.split('&'))
+        except KeyError:
+            raise Exception("failed to get csqidx for {!r} with error: {}".format(consequence, traceback.format_exc()))
+        _worst_csqidxs[consequence] = csqidx
+    return csqidx
 def _annotation_severity(annotation):
     "higher is more deleterious"
     rv = -annotation['worst_csqidx']
@@ -178,9 +220,13 @@ def _annotation_severity(annotation):
     return rv
 def _get_hgvs(annotation):
     # ExAC code did fancy things, but this feels okay to me.
-    from urllib import unquote
-    hgvsp = unquote(annotation['HGVSp']).split(':',1)[-1]
-    hgvsc = unquote(annotation['HGVSc']).split(':',1)[-1]
+    hgvsp = annotation['HGVSp']
+    hgvsc = annotation['HGVSc']
+    # most HGVS strings have nothing to unquote
+    if '%' in hgvsp: hgvsp = unquote(hgvsp)
+    if '%' in hgvsc: hgvsc = unquote(hgvsc)
+    hgvsp = hgvsp.split(':',1)[-1]
+    hgvsc = hgvsc.split(':',1)[-1]
     if hgvsp and '=' not in hgvsp: return hgvsp
     if hgvsc: return hgvsc
     if hgvsp: return hgvsp
@@ -200,12 +246,20 @@ def get_pop_afs(variant):
     if 'vep_annotations' not in variant or len(variant['vep_annotations']) == 0:
         return {}
     try:
+        # single pass over annotations: all annotations of the allele must store the same AFs
+        af_strings = None
+        for ann in variant['vep_annotations']:
+            if ann['Allele'] == variant['alt'] or ann['Allele'] == '-':
+                ann_af_strings = [ann[pop].split('&')[0] for pop in POP_AFS_1000G]
+                if af_strings is None:
+                    af_strings = ann_af_strings
+                else:
+                    assert af_strings == ann_af_strings
         pop_afs = {}
-        for pop in POP_AFS_1000G:
-            af_strings = [ann[pop].split('&')[0] for ann in variant['vep_annotations'] if ann['Allele'] == variant['alt'] or ann['Allele'] == '-']
-            assert boltons.iterutils.same(af_strings)
-            if af_strings and af_strings[0] != '':
-                pop_afs[pop] = float(af_strings[0])
+        if af_strings is not None:
+            for pop, af_string in zip(POP_AFS_1000G, af_strings):
+                if af_string != '':
+                    pop_afs[pop] = float(af_string)
         if all(v==0 for v in pop_afs.values()):
             return {}
         return pop_afs
@@ -239,21 +293,37 @@ def get_omim_associations(omim_file):
         yield fields['Gene stable ID'], fields['Transcript stable ID'], fields['MIM gene accession'], fields['MIM gene description']
 
 
+def _get_gtf_attribute(attributes, key):
+    """
+    Reads one attribute from GTF attributes column (e.g. 'gene_id "ENSG00000223972.5"; gene_type "..."; ...') without splitting all of them.
+    Returns None if attribute is missing.
+    """
+    pattern = key + ' "'
+    i = attributes.find(pattern)
+    while i > 0 and attributes[i - 1] != ' ':
+        i = attributes.find(pattern, i + 1)
+    if i < 0:
+        return None
+    i += len(pattern)
+    return attributes[i:attributes.index('"', i)]
+
+
 def get_regions_from_gencode_gtf(gtf_file, region_types):
     """
     Parse gencode GTF file.
-    Returns iter of regions ditcs
+    Returns iter of regions ditcs. Genes have gene_name; transcripts have transcript_id; exon, CDS and UTR regions have transcript_id and feature_type.
     """
     for line in gtf_file:
         if line.startswith('#'):
             continue
         fields = line.rstrip('\n').split('\t')
-        if fields[2] not in region_types:
+        feature_type = fields[2]
+        if feature_type not in region_types:
             continue
         chrom = fields[0][3:]
         start = long(fields[3])
         stop = long(fields[4])
-        info = dict(x.strip().split() for x in fields[8].split(';') if x != '')
+        attributes = fields[8]
         region = {
             'chrom': chrom,
             'start': start,
@@ -261,16 +331,15 @@ def get_regions_from_gencode_gtf(gtf_file, region_types):
             'strand': fields[6],
             'xstart': Xpos.from_chrom_pos(chrom, start),
             'xstop': Xpos.from_chrom_pos(chrom, stop),
-            'gene_id': info['gene_id'].strip('"').split('.')[0],
+            'gene_id': _get_gtf_attribute(attributes, 'gene_id').split('.')[0],
         }
-        if 'gene' in region_types:
-            region['gene_name'] = info['gene_name'].strip('"')
-        if 'transcript' in region_types:
-            region['transcript_id'] = info['transcript_id'].strip('"').split('.')[0] if 'transcript_id' in info else None
-        if 'exon' in region_types or 'CDS' in region_types or 'UTR' in region_types:
-            if 'transcript_id' not in region:
-                region['transcript_id'] = info['transcript_id'].strip('"').split('.')[0] if 'transcript_id' in info else None
-            region['feature_type'] = fields[2]
+        if feature_type == 'gene':
+            region['gene_name'] = _get_gtf_attribute(attributes, 'gene_name')
+        else:
+            transcript_id = _get_gtf_attribute(attributes, 'transcript_id')
+            region['transcript_id'] = transcript_id.split('.')[0] if transcript_id is not None else None
+            if feature_type != 'transcript':
+                region['feature_type'] = feature_type
         yield region
 
 
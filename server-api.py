@@ -1,17 +1,26 @@
 import argparse
 import functools
+import itertools
+import json
 import os
 import re
 import string
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 import bson
 import jwt
+import msgpack
 from bson.json_util import dumps
-from flask import Blueprint, Flask, abort, jsonify, request
+from flask import Blueprint, Flask, Response, abort, jsonify, request
 from flask_limiter import Limiter
+from limits import parse as parse_rate_limit
+from lookups import ANNOTATION_CODEC_CHECK_INTERVAL, ReferenceDataCache
 from pymongo import ASCENDING, DESCENDING, MongoClient
-from utils import Xpos
+from pymongo.errors import DuplicateKeyError
+from utils import AnnotationCodec, Xpos, get_access_token_revocation_epoch
 from webargs import ValidationError, fields
 from webargs.flaskparser import parser
 
@@ -47,8 +56,11 @@ api_version = app.config['API_VERSION']
 
 pageSize = app.config['API_PAGE_SIZE']
 maxRegion = app.config['API_MAX_REGION']
+maxVariants = app.config['API_MAX_VARIANTS']
 
 projection = {'_id': True, 'xpos': True, 'variant_id': True, 'chrom': True, 'pos': True,  'ref': True, 'alt': True, 'site_quality': True, 'filter': True, 'allele_num': True, 'allele_count': True, 'allele_freq': True, 'rsids': True, 'avgdp': True, 'avgdp_alt': True, 'avggq': True, 'avggq_alt': True, 'vep_annotations': True }
+columnar_fields = ['chrom', 'pos', 'ref', 'alt', 'allele_count', 'allele_num', 'allele_freq', 'filter'] # default columns for format=msgpack
+variant_fields = ['variant_id', 'chrom', 'pos', 'ref', 'alt', 'site_quality', 'filter', 'allele_num', 'allele_count', 'allele_freq', 'rsids', 'avgdp', 'avgdp_alt', 'avggq', 'avggq_alt']
 allowed_sort_keys = {'pos': long, 'allele_count': int, 'allele_freq': float, 'allele_num': int, 'site_quality': float, 'filter': str, 'variant_id': str}
 allowed_filter_keys = {'allele_count', 'allele_freq', 'allele_num', 'site_quality', 'filter'}
 
@@ -95,6 +107,12 @@ def get_db():
    return mongo[mongo_db_name]
 
 
+def get_annotation_codec():
+   # tells if annotations in the API collection are stored compactly; refreshed when manage.py reloads the collection
+   db = get_db()
+   return ReferenceDataCache.get(db, 'annotation_codec:{}'.format(api_collection_name), [api_collection_name], lambda: AnnotationCodec.load(db, api_collection_name), serve_stale = False, max_version_age = ANNOTATION_CODEC_CHECK_INTERVAL)
+
+
 def validate_access_token(access_token):
    try:
       decoded_access_token = jwt.decode(access_token, BRAVO_ACCESS_SECRET)
@@ -103,14 +121,77 @@ def validate_access_token(access_token):
    return (decoded_access_token.get('email', None), decoded_access_token.get('iat', None), decoded_access_token.get('ip', None))
 
 
+class AuthorizedTokensCache(object):
+   '''Bounded cache of (email, issued_at) pairs of access tokens that were authorized recently.
+   Entries expire after `ttl` seconds. All entries are dropped as soon as the revocation epoch changes, i.e. when
+   a token is revoked or API access is disabled for a user. The epoch is read at most every `epoch_check_interval` seconds.
+   '''
+   def __init__(self, max_size, ttl, epoch_check_interval):
+      self._max_size = max_size
+      self._ttl = ttl
+      self._epoch_check_interval = epoch_check_interval
+      self._authorized = OrderedDict() # (email, issued_at) -> expiration time, oldest first
+      self._lock = threading.Lock()
+      self._epoch = None
+      self._epoch_checked_at = None
+      self.hits = 0
+      self.misses = 0
+      self.invalidations = 0
+
+   def _check_epoch(self, db):
+      now = time.time()
+      if self._epoch_checked_at is not None and now - self._epoch_checked_at < self._epoch_check_interval:
+         return
+      self._epoch_checked_at = now
+      epoch = get_access_token_revocation_epoch(db)
+      if epoch != self._epoch:
+         with self._lock:
+            self._epoch = epoch
+            self._authorized.clear()
+            self.invalidations += 1
+
+   def is_authorized(self, db, email, issued_at):
+      self._check_epoch(db)
+      expires_at = self._authorized.get((email, issued_at), None)
+      if expires_at is not None and expires_at > time.time():
+         self.hits += 1
+         return True
+      self.misses += 1
+      return False
+
+   def add(self, email, issued_at):
+      with self._lock:
+         self._authorized.pop((email, issued_at), None)
+         self._authorized[(email, issued_at)] = time.time() + self._ttl
+         while len(self._authorized) > self._max_size:
+            self._authorized.popitem(last = False)
+
+   def get_stats(self):
+      total = self.hits + self.misses
+      return {
+         'hits': self.hits,
+         'misses': self.misses,
+         'hit_ratio': float(self.hits) / total if total else None,
+         'invalidations': self.invalidations,
+         'size': len(self._authorized)
+      }
+
+
+authorized_tokens_cache = AuthorizedTokensCache(app.config['API_AUTH_CACHE_SIZE'], app.config['API_AUTH_CACHE_TTL'], app.config['API_AUTH_REVOCATION_CHECK_INTERVAL'])
+
+
 def authorize_access_token(email, issued_at):
-   document = get_db().users.find_one({ 'email': email, 'enabled_api': True, 'agreed_to_terms': True }, projection = {'_id': False})
+   db = get_db()
+   # only successful authorizations are cached, so that users who were just granted API access don't have to wait
+   if authorized_tokens_cache.is_authorized(db, email, issued_at):
+      return True
+   document = db.users.find_one({ 'email': email, 'enabled_api': True, 'agreed_to_terms': True }, projection = {'_id': False})
    if not document:
       return False
-   issued_at = datetime.utcfromtimestamp(issued_at)
    revoked_at = document.get('access_token_revoked_at', None)
-   if revoked_at is not None and revoked_at > issued_at:
+   if revoked_at is not None and revoked_at > datetime.utcfromtimestamp(issued_at):
       return False
+   authorized_tokens_cache.add(email, issued_at)
    return True
 
 
@@ -179,6 +260,24 @@ def get_name():
    return response
 
 
+def format_vcf_line(r, annotations):
+   line = '{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={}'.format(
+      r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
+      r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'])
+   if annotations is None:
+      return line
+   return line + ';CSQ=' + ','.join('|'.join(a[k] for k in annotations_ordered) for a in annotations)
+
+
+@bp.route('/auth_cache', methods = ['GET'])
+def get_auth_cache_stats():
+   if get_user_ip() not in app.config['API_IP_WHITELIST']:
+      raise UserError('not authorized')
+   response = jsonify(authorized_tokens_cache.get_stats())
+   response.status_code = 200
+   return response
+
+
 @bp.route('/variant', methods = ['GET'])
 @require_authorization
 def get_variant():
@@ -222,11 +321,12 @@ def get_variant():
       { '$project': projection },
       { '$project': rename }
    ])
+   annotation_codec = get_annotation_codec()
    if not args['vcf']:
       response['format'] = 'json'
       for r in cursor:
          last_object_id = r.pop('_id')
-         r['annotations'] = [{k: a[k] for k in annotations_ordered} for a in r['annotations']]
+         r['annotations'] = [{k: a[k] for k in annotations_ordered} for a in annotation_codec.decode_all(r['annotations'])]
          r.pop('xpos', None)
          data.append(r)
          last_variant = r
@@ -237,11 +337,7 @@ def get_variant():
       for r in cursor:
          last_object_id = r.pop('_id')
          r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['annotations'])
-         ))
+         data.append(format_vcf_line(r, annotation_codec.decode_all(r['annotations'])))
          last_variant = r
    response['data'] = data
 
@@ -250,6 +346,115 @@ def get_variant():
    return response
 
 
+def parse_variant_ids(variant_ids):
+   # returns [(variant_id, key), ...], where key is either rsid or (xpos, ref, alt)
+   queries = []
+   for variant_id in variant_ids:
+      if variant_id.startswith('rs'):
+         queries.append((variant_id, variant_id))
+         continue
+      try:
+         chrom, pos, ref, alt = variant_id.split('-')
+         pos = int(pos)
+      except ValueError as e:
+         raise UserError('Invalid variant name format: {}.'.format(variant_id))
+      if not Xpos.check_chrom(chrom):
+         raise UserError('Invalid chromosome name: {}.'.format(variant_id))
+      queries.append((variant_id, (Xpos.from_chrom_pos(chrom, pos), ref, alt)))
+   return queries
+
+
+def find_variants_in_order(collection, queries, batch_size = 1000):
+   # yields (variant_id, [variant, ...]) in the order of queries, looking up batch_size queries at once
+   for i in xrange(0, len(queries), batch_size):
+      batch = queries[i:i + batch_size]
+      xposes = list(set(key[0] for _, key in batch if isinstance(key, tuple)))
+      rsids = list(set(key for _, key in batch if not isinstance(key, tuple)))
+      mongo_filter = []
+      if xposes:
+         mongo_filter.append({'xpos': {'$in': xposes}})
+      if rsids:
+         mongo_filter.append({'rsids': {'$in': rsids}})
+      found = {}
+      # sorted here rather than in MongoDB: a batch with full annotations can exceed the in-memory sort limit
+      for r in sorted(collection.find({'$or': mongo_filter}, projection), key = lambda r: (r['xpos'], r['_id'])):
+         r.pop('_id')
+         found.setdefault((r['xpos'], r['ref'], r['alt']), []).append(r)
+         for rsid in r['rsids'] or []:
+            found.setdefault(rsid, []).append(r)
+      for variant_id, key in batch:
+         yield variant_id, found.get(key, [])
+
+
+def charge_variants_rate_limit(db, rate_limit, n_variants):
+   # adds the variants to the caller's counter of the current fixed window in one conditional update, so that concurrent requests can't
+   # push it over the limit. Returns the counter's key, or None if the variants don't fit
+   window = int(time.time() // rate_limit.get_expiry())
+   key = '{}/{}'.format(rate_limit.key_for(get_user_ip(), 'variants'), window)
+   if n_variants > rate_limit.amount:
+      return None
+   # when the counter is too high, the filter doesn't match and the upsert fails on the existing _id. It also fails when a concurrent
+   # request creates the counter first, so a failed attempt is repeated once against the now existing counter
+   for _ in xrange(2):
+      try:
+         db.variants_rate_limits.update_one(
+            {'_id': key, 'count': {'$lte': rate_limit.amount - n_variants}},
+            {'$inc': {'count': n_variants}, '$setOnInsert': {'expires_at': datetime.utcfromtimestamp((window + 1) * rate_limit.get_expiry())}},
+            upsert = True)
+         return key
+      except DuplicateKeyError:
+         pass
+   return None
+
+
+def hit_variants_rate_limit(n_variants):
+   # every requested variant counts against API_VARIANTS_RATE_LIMIT. Limiter's storage counts one hit per call, so the variants are counted in MongoDB
+   global variants_rate_limits_expiry_index
+   db = get_db()
+   if not variants_rate_limits_expiry_index:
+      db.variants_rate_limits.create_index('expires_at', expireAfterSeconds = 0)
+      variants_rate_limits_expiry_index = True
+   charged = []
+   for rate_limit in variants_rate_limits:
+      key = charge_variants_rate_limit(db, rate_limit, n_variants)
+      if key is None:
+         # a rejected request doesn't use up the caller's budget
+         for key in charged:
+            db.variants_rate_limits.update_one({'_id': key}, {'$inc': {'count': -n_variants}})
+         abort(429)
+      charged.append(key)
+
+
+@bp.route('/variants', methods = ['POST'])
+@require_authorization
+def get_variants():
+   args = parser.parse({
+      'variants': fields.List(fields.Str(validate = lambda x: len(x) > 0), required = True, validate = lambda x: 0 < len(x) <= maxVariants),
+      'vcf': fields.Bool(required = False, missing = False)
+      }, request)
+
+   queries = parse_variant_ids(args['variants'])
+   hit_variants_rate_limit(len(queries))
+   variants = find_variants_in_order(get_db()[api_collection_name], queries)
+   annotation_codec = get_annotation_codec()
+
+   if args['vcf']:
+      lines = itertools.chain(
+         (line + '\n' for line in vcf_meta),
+         [vcf_header + '\n'],
+         (format_vcf_line(r, annotation_codec.decode_all(r['vep_annotations'])) + '\n' for _, found in variants for r in found))
+      return Response(join_into_chunks(lines), mimetype = 'text/plain')
+   def to_json_line(variant_id, found):
+      data = []
+      for r in found:
+         # variants are shared between queries, so they are copied instead of modified
+         variant = {k: v for k, v in r.iteritems() if k not in ('xpos', 'vep_annotations')}
+         variant['annotations'] = [{k: a[k] for k in annotations_ordered} for a in annotation_codec.decode_all(r['vep_annotations'])]
+         data.append(variant)
+      return json.dumps({'variant_id': variant_id, 'data': data}, separators = (',', ':')) + '\n'
+   return Response(join_into_chunks(to_json_line(variant_id, found) for variant_id, found in variants), mimetype = 'application/x-ndjson')
+
+
 def deserialize_query_sort(value):
    query_sort = list()
    for key_direction in (x.strip().split(':') for x in value.strip().split(',')):
@@ -305,6 +510,15 @@ def deserialize_query_filter(value, value_type):
    return { operator: value }
 
 
+def deserialize_query_fields(value):
+   selected_fields = [x.strip() for x in value.split(',') if x.strip()]
+   if len(selected_fields) == 0:
+      raise ValidationError('empty value')
+   if any(x not in variant_fields for x in selected_fields):
+      raise ValidationError('unknown field(s)')
+   return selected_fields
+
+
 def deserialize_query_last(value):
     elements = value.strip().split(':')
     if len(elements) == 0:
@@ -382,6 +596,146 @@ def build_link_next(args, last_object_id, last_variant, mongo_sort):
     return link_next + str(last_object_id)
 
 
+def join_into_chunks(lines, chunk_size = 65536):
+   chunk = []
+   length = 0
+   for line in lines:
+      chunk.append(line)
+      length += len(line)
+      if length >= chunk_size:
+         yield ''.join(chunk)
+         chunk = []
+         length = 0
+   if chunk:
+      yield ''.join(chunk)
+
+
+def build_annotations_filter(args, annotations_filter, annotation_codec):
+   lof_key = annotation_codec.key('LoF')
+   # webargs nests dotted argument names, i.e. annotations.lof is loaded into args['annotations']['lof']
+   annotations = args.get('annotations', {})
+   filters = annotations.get('lof', None)
+   if filters is not None:
+      if len(filters) == 1:
+         annotations_filter.append({lof_key: filters[0]})
+      else:
+         annotations_filter.append({'$or': [{lof_key: v} for v in filters]})
+   filters = annotations.get('consequence', None)
+   if filters is not None:
+      annotations_filter.append({'$or': [annotation_codec.consequence_match(re.compile(v.values()[0]), negate = v.keys()[0] != '$eq') for v in filters ] })
+   return annotations_filter
+
+
+def get_output_fields(args):
+   if args['vcf']:
+      return variant_fields
+   if args['format'] == 'msgpack':
+      return args.get('fields', None) or columnar_fields
+   return args.get('fields', None) or variant_fields
+
+
+def build_projection(args):
+   # _id, chrom, pos and sort keys are always needed to build the link to the next page
+   mongo_projection = {'_id': True, 'chrom': True, 'pos': True}
+   mongo_projection.update((key, True) for key in get_output_fields(args))
+   mongo_projection.update((key, True) for key, direction in args.get('sort', []) if key != 'pos')
+   if args['annotations_mode'] != 'none':
+      mongo_projection.update(get_annotation_codec().projection(annotations_ordered + ['CANONICAL']))
+   return mongo_projection
+
+
+def get_annotations(r, args, keep_annotation):
+   if args['annotations_mode'] == 'none':
+      return None
+   return [a for a in get_annotation_codec().decode_all(r.get('vep_annotations', [])) if keep_annotation(a) and (args['annotations_mode'] == 'all' or a.get('CANONICAL'))]
+
+
+def format_json_variant(r, args, keep_annotation, single_annotation = False):
+   # if single_annotation is True, then `annotations` is the only kept annotation (or an empty object) instead of a list, like /transcript always returned
+   variant = {key: r[key] for key in get_output_fields(args) if key in r}
+   annotations = get_annotations(r, args, keep_annotation)
+   if annotations is not None:
+      annotations = [{k: a[k] for k in annotations_ordered} for a in annotations]
+      variant['annotations'] = annotations if not single_annotation else (annotations[-1] if annotations else {})
+   return variant
+
+
+def get_variants_page(cursor, args, mongo_sort, keep_annotation, single_annotation = False):
+   page = {}
+   data = []
+   r = None
+   if not args['vcf']:
+      page['format'] = 'json'
+      for r in cursor:
+         data.append(format_json_variant(r, args, keep_annotation, single_annotation))
+   else:
+      page['format'] = 'vcf'
+      page['header'] = vcf_header
+      page['meta'] = vcf_meta
+      for r in cursor:
+         data.append(format_vcf_line(r, get_annotations(r, args, keep_annotation)))
+   page['data'] = data
+   page['next'] = build_link_next(args, r['_id'], r, mongo_sort) if len(data) == args['limit'] else None
+   return page
+
+
+def stream_variants(cursor, args, keep_annotation, single_annotation = False):
+   # writes variants straight from the cursor: one JSON object per line or, if vcf is True, VCF with meta-information lines and header
+   if args['vcf']:
+      lines = itertools.chain(
+         (line + '\n' for line in vcf_meta),
+         [vcf_header + '\n'],
+         (format_vcf_line(r, get_annotations(r, args, keep_annotation)) + '\n' for r in cursor))
+      return Response(join_into_chunks(lines), mimetype = 'text/plain')
+   lines = (json.dumps(format_json_variant(r, args, keep_annotation, single_annotation), separators = (',', ':')) + '\n' for r in cursor)
+   return Response(join_into_chunks(lines), mimetype = 'application/x-ndjson')
+
+
+def get_variants_columns(rows, args, keep_annotation):
+   # one list per field; annotations are flattened into their own columns, with `variant` pointing to the row of the variant
+   columns = {key: [] for key in get_output_fields(args)}
+   annotations = {key: [] for key in ['variant'] + annotations_ordered} if args['annotations_mode'] != 'none' else None
+   for i, r in enumerate(rows):
+      for key, values in columns.iteritems():
+         values.append(r.get(key, None))
+      if annotations is not None:
+         for a in get_annotations(r, args, keep_annotation):
+            annotations['variant'].append(i)
+            for k in annotations_ordered:
+               annotations[k].append(a[k])
+   if annotations is not None:
+      columns['annotations'] = annotations
+   return columns
+
+
+def stream_variants_columns(cursor, args, keep_annotation):
+   # every message in the stream holds columns for at most API_PAGE_SIZE variants
+   while True:
+      rows = list(itertools.islice(cursor, pageSize))
+      if not rows:
+         break
+      yield msgpack.packb(get_variants_columns(rows, args, keep_annotation), use_bin_type = False)
+
+
+def respond_with_variants(response, cursor, args, mongo_sort, keep_annotation, single_annotation = False):
+   if args['format'] == 'msgpack':
+      if args['vcf']:
+         raise UserError('VCF can not be combined with msgpack format.')
+      if args['stream']:
+         return Response(stream_variants_columns(cursor, args, keep_annotation), mimetype = 'application/x-msgpack')
+      rows = list(cursor.limit(args['limit']))
+      response['format'] = 'msgpack'
+      response['data'] = get_variants_columns(rows, args, keep_annotation)
+      response['next'] = build_link_next(args, rows[-1]['_id'], rows[-1], mongo_sort) if len(rows) == args['limit'] else None
+      return Response(msgpack.packb(response, use_bin_type = False), mimetype = 'application/x-msgpack')
+   if args['stream']:
+      return stream_variants(cursor, args, keep_annotation, single_annotation)
+   response.update(get_variants_page(cursor.limit(args['limit']), args, mongo_sort, keep_annotation, single_annotation))
+   response = jsonify(response)
+   response.status_code = 200
+   return response
+
+
 @bp.route('/region', methods = ['GET'])
 @require_authorization
 def get_region():
@@ -398,6 +752,10 @@ def get_region():
        'annotations.consequence': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, str))),
        'sort': fields.Function(deserialize = deserialize_query_sort),
        'vcf': fields.Bool(required = False, missing = False),
+       'stream': fields.Bool(required = False, missing = False),
+       'fields': fields.Function(deserialize = deserialize_query_fields),
+       'annotations_mode': fields.Str(required = False, missing = 'all', validate = lambda x: x in ('none', 'canonical', 'all')),
+       'format': fields.Str(required = False, missing = 'json', validate = lambda x: x in ('json', 'msgpack')),
        'limit': fields.Int(required = False, validate = lambda x: x > 0, missing = pageSize),
        'last': fields.Function(deserialize = deserialize_query_last)
    }
@@ -419,60 +777,19 @@ def get_region():
 
    mongo_filter, mongo_sort = build_region_query(args, xstart, xend)
 
-   annotations_filter = []
-   annotations = args.get('annotations', None)
-   if annotations is not None:
-      filters = annotations.get('lof', None)
-      if filters is not None:
-         if len(filters) == 1:
-            annotations_filter.append({'LoF': filters[0]})
-         else:
-            annotations_filter.append({'$or': [{'LoF': v} for v in filters]})
-      filters = annotations.get('consequence', None)
-      if filters is not None:
-         annotations_filter.append({'$or': [{'Consequence': re.compile(v.values()[0])} if v.keys()[0] == '$eq' else {'Consequence': {'$not': re.compile(v.values()[0])}} for v in filters ] })
+   annotations_filter = build_annotations_filter(args, [], get_annotation_codec())
    if annotations_filter:
       mongo_filter['$and'].append({'vep_annotations': {'$elemMatch': {'$and': annotations_filter}}})
 
    #print mongo_filter
 
-   data = [];
    response = {}
-   last_variant = None
-   last_object_id = None
-   db = get_db()
-   collection = db[api_collection_name]
+   collection = get_db()[api_collection_name]
+   keep_annotation = lambda a: True
 
    # can be replaced with collection.aggregate. However in Mongo 3.4. collection.aggregate produced different query plan than collection.find, which was not optimal
-   cursor = collection.find(mongo_filter, projection).sort(mongo_sort + [('_id', ASCENDING)]).limit(args['limit'])
-   if not args['vcf']:
-      response['format'] = 'json'
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r['annotations'] = [{k: a[k] for k in annotations_ordered} for a in r['vep_annotations']]
-         r.pop('vep_annotations')
-         r.pop('xpos', None)
-         data.append(r)
-         last_variant = r
-   else:
-      response['format'] = 'vcf'
-      response['header'] = vcf_header
-      response['meta'] = vcf_meta
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'])
-         ))
-         last_variant = r
-
-   response['data'] = data
-   response['next'] = build_link_next(args, last_object_id, last_variant, mongo_sort) if len(data) == args['limit'] else None
-   response = jsonify(response)
-   response.status_code = 200
-   return response
+   cursor = collection.find(mongo_filter, build_projection(args)).sort(mongo_sort + [('_id', ASCENDING)])
+   return respond_with_variants(response, cursor, args, mongo_sort, keep_annotation)
 
 
 @bp.route('/gene', methods = ['GET'])
@@ -489,6 +806,10 @@ def get_gene():
        'annotations.consequence': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, str))),
        'sort': fields.Function(deserialize = deserialize_query_sort),
        'vcf': fields.Bool(required = False, missing = False),
+       'stream': fields.Bool(required = False, missing = False),
+       'fields': fields.Function(deserialize = deserialize_query_fields),
+       'annotations_mode': fields.Str(required = False, missing = 'all', validate = lambda x: x in ('none', 'canonical', 'all')),
+       'format': fields.Str(required = False, missing = 'json', validate = lambda x: x in ('json', 'msgpack')),
        'limit': fields.Int(required = False, validate = lambda x: x > 0, missing = pageSize),
        'last': fields.Function(deserialize = deserialize_query_last)
    }
@@ -501,6 +822,8 @@ def get_gene():
       ]}, projection={'_id': False})
    if not gene:
       raise UserError('Gene with name or identifier equal to {} was not found.'.format(args['name']))
+   if args['stream'] and gene['stop'] - gene['start'] > maxRegion:
+      raise UserError('Streaming genes larger than {} base-pairs is not allowed.'.format(maxRegion))
 
    response = {
       'gene': {
@@ -515,56 +838,16 @@ def get_gene():
 
    mongo_filter, mongo_sort = build_region_query(args, gene['xstart'], gene['xstop'])
 
-   annotations_filter = [ { 'Gene': gene['gene_id'] } ]
-   annotations = args.get('annotations', None)
-   if annotations is not None:
-      filters = annotations.get('lof', None)
-      if filters is not None:
-         if len(filters) == 1:
-            annotations_filter.append({'LoF': filters[0]})
-         else:
-            annotations_filter.append({'$or': [{'LoF': v} for v in filters]})
-      filters = annotations.get('consequence', None)
-      if filters is not None:
-         annotations_filter.append({'$or': [{'Consequence': re.compile(v.values()[0])} if v.keys()[0] == '$eq' else {'Consequence': {'$not': re.compile(v.values()[0])}} for v in filters ] })
+   annotation_codec = get_annotation_codec()
+   annotations_filter = build_annotations_filter(args, [ { annotation_codec.key('Gene'): gene['gene_id'] } ], annotation_codec)
    mongo_filter['$and'].append({'vep_annotations': {'$elemMatch': {'$and': annotations_filter}}})
 
-   data = [];
-   last_variant = None
-   last_object_id = None
    collection = db[api_collection_name]
+   keep_annotation = lambda a: a['Gene'] == gene['gene_id']
 
    # can be replaced with collection.aggregate. However in Mongo 3.4. collection.aggregate produced different query plan than collection.find, which was not optimal
-   cursor = collection.find(mongo_filter, projection).sort(mongo_sort + [('_id', ASCENDING)]).limit(args['limit'])
-
-   if not args['vcf']:
-      response['format'] = 'json'
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r['annotations'] = [{k: a[k] for k in annotations_ordered} for a in r['vep_annotations'] if a['Gene'] == gene['gene_id']]
-         r.pop('vep_annotations', None)
-         r.pop('xpos', None)
-         data.append(r)
-         last_variant = r
-   else:
-      response['format'] = 'vcf'
-      response['header'] = vcf_header
-      response['meta'] = vcf_meta
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join('|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'] if a['Gene'] == gene['gene_id'])
-         ))
-         last_variant = r
-
-   response['data'] = data
-   response['next'] = build_link_next(args, last_object_id, last_variant, mongo_sort) if len(data) == args['limit'] else None
-   response = jsonify(response)
-   response.status_code = 200
-   return response
+   cursor = collection.find(mongo_filter, build_projection(args)).sort(mongo_sort + [('_id', ASCENDING)])
+   return respond_with_variants(response, cursor, args, mongo_sort, keep_annotation)
 
 
 @bp.route('/transcript', methods = ['GET'])
@@ -581,6 +864,10 @@ def get_transcript():
        'annotations.consequence': fields.List(fields.Function(deserialize = lambda x: deserialize_query_filter(x, str))),
        'sort': fields.Function(deserialize = deserialize_query_sort),
        'vcf': fields.Bool(required = False, missing = False),
+       'stream': fields.Bool(required = False, missing = False),
+       'fields': fields.Function(deserialize = deserialize_query_fields),
+       'annotations_mode': fields.Str(required = False, missing = 'all', validate = lambda x: x in ('none', 'canonical', 'all')),
+       'format': fields.Str(required = False, missing = 'json', validate = lambda x: x in ('json', 'msgpack')),
        'limit': fields.Int(required = False, validate = lambda x: x > 0, missing = pageSize),
        'last': fields.Function(deserialize = deserialize_query_last)
    }
@@ -591,6 +878,8 @@ def get_transcript():
    transcript = db.transcripts.find_one({'transcript_id': args['transcript_id']}, projection={'_id': False})
    if not transcript:
       raise UserError('Transcript with identifier equal to {} was not found.'.format(args['transcript_id']))
+   if args['stream'] and transcript['stop'] - transcript['start'] > maxRegion:
+      raise UserError('Streaming transcripts larger than {} base-pairs is not allowed.'.format(maxRegion))
 
    response = {
       'transcript': {
@@ -604,57 +893,23 @@ def get_transcript():
    }
 
    mongo_filter, mongo_sort = build_region_query(args, transcript['xstart'], transcript['xstop'])
-   annotations_filter = [ { 'Feature': transcript['transcript_id'] } ]
-   annotations = args.get('annotations', None)
-   if annotations is not None:
-      filters = annotations.get('lof', None)
-      if filters is not None:
-         if len(filters) == 1:
-            annotations_filter.append({'LoF': filters[0]})
-         else:
-            annotations_filter.append({'$or': [{'LoF': v} for v in filters]})
-      filters = annotations.get('consequence', None)
-      if filters is not None:
-         annotations_filter.append({'$or': [{'Consequence': re.compile(v.values()[0])} if v.keys()[0] == '$eq' else {'Consequence': {'$not': re.compile(v.values()[0])}} for v in filters ] })
+   annotation_codec = get_annotation_codec()
+   annotations_filter = build_annotations_filter(args, [ { annotation_codec.key('Feature'): transcript['transcript_id'] } ], annotation_codec)
    mongo_filter['$and'].append({'vep_annotations': {'$elemMatch': {'$and': annotations_filter}}})
 
-   data = [];
-   last_variant = None
-   last_object_id = None
    collection = db[api_collection_name]
+   keep_annotation = lambda a: a['Feature'] == transcript['transcript_id']
+
    # can be replaced with collection.aggregate. However in Mongo 3.4. collection.aggregate produced different query plan than collection.find, which was not optimal
-   cursor = collection.find(mongo_filter, projection).sort(mongo_sort + [('_id', ASCENDING)]).limit(args['limit'])
-   if not args['vcf']:
-      response['format'] = 'json'
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r['annotations'] = {k: a[k] for k in annotations_ordered for a in r['vep_annotations'] if a['Feature'] == transcript['transcript_id']}
-         r.pop('xpos', None)
-         r.pop('vep_annotations', None)
-         data.append(r)
-         last_variant = r
-   else:
-      response['format'] = 'vcf'
-      response['header'] = vcf_header
-      response['meta'] = vcf_meta
-      for r in cursor:
-         last_object_id = r.pop('_id')
-         r.pop('xpos', None)
-         data.append('{}\t{}\t{}\t{}\t{}\t{}\t{}\tAN={};AC={};AF={};AVGDP={};AVGDP_ALT={};AVGGQ={};AVGGQ_ALT={};CSQ={}'.format(
-            r['chrom'], r['pos'], ';'.join(r['rsids']) if r['rsids'] else '.', r['ref'], r['alt'], r['site_quality'], r['filter'],
-            r['allele_num'], r['allele_count'], r['allele_freq'], r['avgdp'], r['avgdp_alt'], r['avggq'], r['avggq_alt'],
-            ','.join(['|'.join(a[k] for k in annotations_ordered) for a in r['vep_annotations'] if a['Feature'] == transcript['transcript_id']])
-         ))
-         last_variant = r
-   response['data'] = data
-   response['next'] = build_link_next(args, last_object_id, last_variant, mongo_sort) if len(data) == args['limit'] else None
-   response = jsonify(response)
-   response.status_code = 200
-   return response
+   cursor = collection.find(mongo_filter, build_projection(args)).sort(mongo_sort + [('_id', ASCENDING)])
+   # JSON has one object of annotations per variant: the annotation of the requested transcript
+   return respond_with_variants(response, cursor, args, mongo_sort, keep_annotation, single_annotation = True)
 
 
 
 limiter = Limiter(app, default_limits = app.config['API_REQUESTS_RATE_LIMIT'], key_func = get_user_ip)
+variants_rate_limits = [parse_rate_limit(x) for x in app.config['API_VARIANTS_RATE_LIMIT']]
+variants_rate_limits_expiry_index = False # TTL index on db.variants_rate_limits is created by the first request that needs it
 
 
 app.register_blueprint(bp, url_prefix = URL_PREFIX + API_URL_PREFIX)
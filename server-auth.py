@@ -10,6 +10,7 @@ import requests
 from flask import (Blueprint, Flask, abort, jsonify, render_template, request,
                    url_for)
 from pymongo import MongoClient
+from utils import set_access_token_revocation_epoch
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('--host', default = '0.0.0.0', help = 'the hostname to use to access this server')
@@ -222,6 +223,7 @@ def revoke_token():
         raise UserError('Bad access token.')
     revoked_at = datetime.utcnow()
     get_db().users.update_one({ 'email': email }, {'$set': {'access_token_revoked_at': revoked_at}})
+    set_access_token_revocation_epoch(get_db(), revoked_at)
     response = jsonify({
         'revoked': True,
         'revoked_at': revoked_at
@@ -35,10 +35,19 @@ var coverage_plot = {
     height: 70,
     margin: {top: 8, bottom: 10},
     color: '#ffa37c',
+    // smallest bin size of the coverage pyramid (see data/base_coverage/pyramid_coverage.py)
+    pyramid_min_bin_size: 16,
     create: function() {
-        var XHR = $.getJSON(window.model.url_prefix + 'api/coverage' + window.model.url_suffix);
         $(function() {
             bootstrap_plot();
+            // ask for at most one coverage bin per pixel, but only when even the finest pyramid level has more than one bin per pixel.
+            // Shorter regions get the full-resolution or pruned coverage, which is finer than the pyramid.
+            var params = {};
+            var region_length = sum(window.model.intervalset.list_of_pairs.map(function(pair){return pair[1]-pair[0]+1}));
+            if (region_length > this.pyramid_min_bin_size * window.model.plot.genome_coords_width) {
+                params.width = Math.ceil(window.model.plot.genome_coords_width);
+            }
+            var XHR = $.getJSON(window.model.url_prefix + 'api/coverage' + window.model.url_suffix, params);
 
             var svg = d3.select('#'+this.container_id).append("svg")
                 .attr("width", window.model.plot.svg_width)
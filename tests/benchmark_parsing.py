@@ -0,0 +1,138 @@
+#!/usr/bin/env python2
+import argparse
+import glob
+import gzip
+import imp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+import parsing
+import pysam
+from utils import Consequence
+
+
+argparser = argparse.ArgumentParser(description = 'Measures how many VCF records per second parsing.get_variants_from_sites_vcf reads. Benchmark sites VCF is generated from the positions and alleles in the DataPrep test VCFs, with random (but reproducible) VEP annotations, histograms and other INFO fields that BRAVO requires.')
+argparser.add_argument('-i', '--in', metavar = 'file', dest = 'in_VCFs', nargs = '+', required = False, default = sorted(glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'data', 'DataPrep', 'test', 'input*.vcf.gz'))), help = 'VCF files with positions and alleles for the benchmark. Default: data/DataPrep/test/input*.vcf.gz.')
+argparser.add_argument('-b', '--before', metavar = 'file', dest = 'before_parsing', required = False, help = 'Other version of parsing.py to compare with, e.g. saved with `git show <commit>:parsing.py > parsing_before.py`. Outputs of both versions must be identical.')
+argparser.add_argument('-a', '--annotations', metavar = 'number', dest = 'n_annotations', type = int, required = False, default = 10, help = 'Number of VEP annotations per alternate allele. Default: 10.')
+argparser.add_argument('-r', '--repeat', metavar = 'number', dest = 'repeat', type = int, required = False, default = 20, help = 'Number of times every VCF record is written to the benchmark VCF. Default: 20.')
+argparser.add_argument('-s', '--seed', metavar = 'number', dest = 'seed', type = int, required = False, default = 1, help = 'Random seed. Default: 1.')
+
+vep_fields = ['Allele', 'Consequence', 'IMPACT', 'SYMBOL', 'Gene', 'Feature_type', 'Feature', 'BIOTYPE', 'EXON', 'INTRON', 'HGVSc', 'HGVSp', 'Existing_variation', 'ALLELE_NUM', 'CANONICAL', 'LoF', 'AFR_AF', 'AMR_AF', 'EAS_AF', 'EUR_AF', 'SAS_AF']
+hist_mids = [2.5, 7.5, 12.5, 17.5, 22.5, 27.5, 32.5, 37.5, 42.5, 47.5, 55.0, 65.0, 75.0, 85.0, 95.0]
+
+
+def read_alleles(vcfs):
+    alleles = set()
+    for vcf in vcfs:
+        with gzip.GzipFile(vcf) as iz:
+            for line in iz:
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t', 5)
+                alleles.add((fields[0], int(fields[1]), fields[3], fields[4]))
+    return sorted(alleles, key = lambda x: (x[0], x[1]))
+
+
+def get_annotation(rng, allele, allele_num, pop_afs):
+    gene = 'ENSG{:011d}'.format(rng.randint(1, 60000))
+    transcript = 'ENST{:011d}'.format(rng.randint(1, 200000))
+    consequence = '&'.join(rng.sample(Consequence.csqs, rng.randint(1, 3)))
+    hgvsp = rng.choice(['', '{}.1:p.Leu{}Pro'.format(transcript, rng.randint(1, 999)), '{}.1:p.Leu{}%3D'.format(transcript, rng.randint(1, 999))])
+    hgvsc = rng.choice(['', '{}.1:c.{}A>G'.format(transcript, rng.randint(1, 9999))])
+    values = {
+        'Allele': allele, 'Consequence': consequence, 'IMPACT': rng.choice(['HIGH', 'MODERATE', 'LOW', 'MODIFIER']), 'SYMBOL': 'GENE{}'.format(gene[-4:]),
+        'Gene': gene, 'Feature_type': 'Transcript', 'Feature': transcript, 'BIOTYPE': 'protein_coding', 'EXON': '', 'INTRON': '',
+        'HGVSc': hgvsc, 'HGVSp': hgvsp, 'Existing_variation': rng.choice(['', 'rs{}'.format(rng.randint(1, 10 ** 9))]), 'ALLELE_NUM': str(allele_num),
+        'CANONICAL': rng.choice(['', 'YES']), 'LoF': ''
+    }
+    values.update(pop_afs)
+    return '|'.join(values[field] for field in vep_fields)
+
+
+def write_benchmark_vcf(alleles, out_vcf, n_annotations, repeat, seed):
+    rng = random.Random(seed)
+    with pysam.BGZFile(out_vcf, 'w') as oz:
+        oz.write('##fileformat=VCFv4.2\n')
+        for chrom in sorted(set(x[0] for x in alleles)):
+            oz.write('##contig=<ID={}>\n'.format(chrom))
+        oz.write('##INFO=<ID=AC,Number=A,Type=Integer,Description="Alternate allele count">\n')
+        oz.write('##INFO=<ID=AN,Number=1,Type=Integer,Description="Number of alleles">\n')
+        oz.write('##INFO=<ID=AF,Number=A,Type=Float,Description="Alternate allele frequency">\n')
+        oz.write('##INFO=<ID=Hom,Number=A,Type=Integer,Description="Number of homozygotes">\n')
+        for x in ['AVGDP', 'AVGGQ']:
+            oz.write('##INFO=<ID={},Number=1,Type=Float,Description="Average">\n'.format(x))
+            oz.write('##INFO=<ID={}_R,Number=R,Type=Float,Description="Average per allele">\n'.format(x))
+        for x in ['DP_HIST', 'GQ_HIST']:
+            oz.write('##INFO=<ID={},Number=1,Type=String,Description="Histogram. Mids: {}">\n'.format(x, '|'.join(str(m) for m in hist_mids)))
+            oz.write('##INFO=<ID={}_R,Number=R,Type=String,Description="Histogram per allele. Mids: {}">\n'.format(x, '|'.join(str(m) for m in hist_mids)))
+        oz.write('##INFO=<ID=CSQ,Number=.,Type=String,Description="Consequence annotations from Ensembl VEP. Format: {}">\n'.format('|'.join(vep_fields)))
+        oz.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, pos, ref, alts in alleles:
+            alts = alts.split(',')
+            for _ in xrange(repeat):
+                an = 5008
+                acs = [rng.randint(1, 100) for alt in alts]
+                csq = []
+                for allele_num, alt in enumerate(alts, 1):
+                    pop_afs = {pop: rng.choice(['', '{:.4f}'.format(rng.random())]) for pop in parsing.POP_AFS_1000G}
+                    csq.extend(get_annotation(rng, alt, allele_num, pop_afs) for _ in xrange(n_annotations))
+                info = [
+                    'AC={}'.format(','.join(str(ac) for ac in acs)),
+                    'AN={}'.format(an),
+                    'AF={}'.format(','.join('{:.6g}'.format(float(ac) / an) for ac in acs)),
+                    'Hom={}'.format(','.join(str(ac // 10) for ac in acs)),
+                    'AVGDP={:.2f}'.format(rng.uniform(10, 40)),
+                    'AVGDP_R={}'.format(','.join('{:.2f}'.format(rng.uniform(10, 40)) for _ in xrange(len(alts) + 1))),
+                    'AVGGQ={:.2f}'.format(rng.uniform(10, 99)),
+                    'AVGGQ_R={}'.format(','.join('{:.2f}'.format(rng.uniform(10, 99)) for _ in xrange(len(alts) + 1))),
+                    'DP_HIST={}'.format('|'.join(str(rng.randint(0, 1000)) for _ in hist_mids)),
+                    'DP_HIST_R={}'.format(','.join('|'.join(str(rng.randint(0, 1000)) for _ in hist_mids) for _ in xrange(len(alts) + 1))),
+                    'GQ_HIST={}'.format('|'.join(str(rng.randint(0, 1000)) for _ in hist_mids)),
+                    'GQ_HIST_R={}'.format(','.join('|'.join(str(rng.randint(0, 1000)) for _ in hist_mids) for _ in xrange(len(alts) + 1))),
+                    'CSQ={}'.format(','.join(csq))
+                ]
+                oz.write('{}\t{}\t.\t{}\t{}\t100\tPASS\t{}\n'.format(chrom, pos, ref, ','.join(alts), ';'.join(info)))
+    pysam.tabix_index(out_vcf, preset = 'vcf', force = True)
+
+
+def benchmark(parsing_module, vcf, chroms):
+    variants = []
+    start_time = time.time()
+    for chrom in chroms:
+        for variant in parsing_module.get_variants_from_sites_vcf(vcf, chrom, None, None, True):
+            variants.append(variant)
+    elapsed = time.time() - start_time
+    with closing(pysam.VariantFile(vcf)) as ifile:
+        n_records = sum(1 for _ in ifile)
+    return n_records / elapsed, len(variants) / elapsed, variants
+
+
+if __name__ == '__main__':
+    args = argparser.parse_args()
+    alleles = read_alleles(args.in_VCFs)
+    chroms = sorted(set(x[0] for x in alleles))
+    out_dir = tempfile.mkdtemp()
+    try:
+        benchmark_vcf = os.path.join(out_dir, 'benchmark.vcf.gz')
+        write_benchmark_vcf(alleles, benchmark_vcf, args.n_annotations, args.repeat, args.seed)
+        sys.stdout.write('Benchmark VCF: {} distinct sites x {} repeats, {} annotations per allele.\n'.format(len(alleles), args.repeat, args.n_annotations))
+        records_per_sec, variants_per_sec, variants = benchmark(parsing, benchmark_vcf, chroms)
+        sys.stdout.write('after:\t{:.0f} records/sec\t{:.0f} variants/sec\n'.format(records_per_sec, variants_per_sec))
+        if args.before_parsing is not None:
+            before_records_per_sec, before_variants_per_sec, before_variants = benchmark(imp.load_source('parsing_before', args.before_parsing), benchmark_vcf, chroms)
+            sys.stdout.write('before:\t{:.0f} records/sec\t{:.0f} variants/sec\n'.format(before_records_per_sec, before_variants_per_sec))
+            sys.stdout.write('speed-up:\t{:.2f}x\n'.format(records_per_sec / before_records_per_sec))
+            if before_variants != variants:
+                sys.stdout.write('Outputs differ!\n')
+                sys.exit(1)
+            sys.stdout.write('Outputs are identical.\n')
+    finally:
+        shutil.rmtree(out_dir)
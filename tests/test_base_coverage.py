@@ -0,0 +1,46 @@
+#!/usr/bin/env python2
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from base_coverage import CoverageFile, SingleChromCoverageHandler, CoverageWindowCache
+
+
+class FullResolutionCoverageTest(unittest.TestCase):
+    # full-resolution coverage files have one record per 1-based position, indexed with `tabix -s 1 -b 2 -e 2`
+    positions = [99, 100, 101, 199, 200, 201]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, '22.full.json')
+        with open(path, 'w') as ofile:
+            for position in self.positions:
+                ofile.write('22\t{0}\t{1}\n'.format(position, json.dumps({'chrom': '22', 'start': position, 'end': position, 'mean': 30.0})))
+        self.path = pysam.tabix_index(path, seq_col = 0, start_col = 1, end_col = 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_query_includes_start_and_stop(self):
+        coverage_file = CoverageFile(self.path, binned = False)
+        self.assertEqual([d['start'] for d in coverage_file.get_coverage('22', 100, 200)], [100, 101, 199, 200])
+
+    def test_single_position(self):
+        coverage_file = CoverageFile(self.path, binned = False)
+        self.assertEqual([d['start'] for d in coverage_file.get_coverage('22', 100, 100)], [100])
+
+    def test_cached_windows_agree(self):
+        handler = SingleChromCoverageHandler('22', CoverageWindowCache(1 << 20))
+        handler.add_coverage_file(CoverageFile(self.path, binned = False), 0)
+        self.assertEqual([d['start'] for d in handler.get_coverage_for_range(100, 200)], [100, 101, 199, 200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python2
+import imp
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from utils import AnnotationCodec
+
+server_api = imp.load_source('server_api', os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'server-api.py'))
+
+
+class FakeCursor(object):
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def limit(self, *args, **kwargs):
+        return self
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeCollection(object):
+    def __init__(self, documents):
+        self.documents = documents
+        self.filters = []
+
+    def find_one(self, mongo_filter, *args, **kwargs):
+        return self.documents[0] if self.documents else None
+
+    def find(self, mongo_filter, *args, **kwargs):
+        self.filters.append(mongo_filter)
+        return FakeCursor(self.documents)
+
+
+class FakeDb(object):
+    def __init__(self, collections):
+        self.collections = collections
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection([]))
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+class ServerApiTestCase(unittest.TestCase):
+    def setUp(self):
+        gene = {'gene_id': 'ENSG00000000001', 'gene_name': 'GENE1', 'chrom': '1', 'start': 100, 'stop': 200, 'strand': '+', 'xstart': 1000000100, 'xstop': 1000000200}
+        transcript = {'transcript_id': 'ENST00000000001', 'gene_id': gene['gene_id'], 'chrom': '1', 'start': 100, 'stop': 200, 'strand': '+', 'xstart': 1000000100, 'xstop': 1000000200}
+        self.db = FakeDb({'genes': FakeCollection([gene]), 'transcripts': FakeCollection([transcript])})
+        self.patched = {'get_db': lambda: self.db, 'get_annotation_codec': lambda: AnnotationCodec(), 'request_is_valid': lambda: True}
+        self.original = {name: getattr(server_api, name) for name in self.patched}
+        for name, value in self.patched.iteritems():
+            setattr(server_api, name, value)
+        self.client = server_api.app.test_client()
+        self.url_prefix = server_api.URL_PREFIX + server_api.API_URL_PREFIX
+
+    def tearDown(self):
+        for name, value in self.original.iteritems():
+            setattr(server_api, name, value)
+
+
+class AnnotationsFilterTest(ServerApiTestCase):
+    def get_annotations_filter(self, path):
+        response = self.client.get(self.url_prefix + path)
+        self.assertEqual(response.status_code, 200, response.data)
+        mongo_filter = self.db[server_api.api_collection_name].filters[-1]
+        return [x['vep_annotations']['$elemMatch']['$and'] for x in mongo_filter['$and'] if 'vep_annotations' in x][0]
+
+    def test_region_lof(self):
+        annotations_filter = self.get_annotations_filter('/region?chrom=1&start=100&end=200&annotations.lof=HC')
+        self.assertEqual(annotations_filter, [{'LoF': {'$eq': 'HC'}}])
+
+    def test_region_lof_with_annotations_mode(self):
+        annotations_filter = self.get_annotations_filter('/region?chrom=1&start=100&end=200&annotations_mode=canonical&annotations.lof=HC&annotations.lof=LC')
+        self.assertEqual(annotations_filter, [{'$or': [{'LoF': {'$eq': 'HC'}}, {'LoF': {'$eq': 'LC'}}]}])
+
+    def test_gene_lof_and_consequence(self):
+        annotations_filter = self.get_annotations_filter('/gene?name=GENE1&annotations.lof=HC&annotations.consequence=missense')
+        self.assertEqual(annotations_filter[:2], [{'Gene': 'ENSG00000000001'}, {'LoF': {'$eq': 'HC'}}])
+        self.assertEqual(annotations_filter[2]['$or'][0]['Consequence'].pattern, 'missense')
+
+    def test_transcript_lof(self):
+        annotations_filter = self.get_annotations_filter('/transcript?transcript_id=ENST00000000001&annotations.lof=HC')
+        self.assertEqual(annotations_filter, [{'Feature': 'ENST00000000001'}, {'LoF': {'$eq': 'HC'}}])
+
+
+class AnnotationsPayloadTest(ServerApiTestCase):
+    def setUp(self):
+        super(AnnotationsPayloadTest, self).setUp()
+        annotation = dict((key, '') for key in server_api.annotations_ordered)
+        annotation.update({'Gene': 'ENSG00000000001', 'Feature': 'ENST00000000001', 'Consequence': 'missense_variant'})
+        variant = {'_id': 1, 'xpos': 1000000150, 'chrom': '1', 'pos': 150, 'ref': 'A', 'alt': 'G', 'vep_annotations': [annotation]} # no CANONICAL field
+        self.db.collections[server_api.api_collection_name] = FakeCollection([variant])
+
+    def get_variants(self, path):
+        response = self.client.get(self.url_prefix + path)
+        self.assertEqual(response.status_code, 200, response.data)
+        return json.loads(response.data)['data']
+
+    def test_transcript_annotations_object(self):
+        variants = self.get_variants('/transcript?transcript_id=ENST00000000001')
+        self.assertEqual(variants[0]['annotations']['Feature'], 'ENST00000000001')
+
+    def test_canonical_without_canonical_field(self):
+        variants = self.get_variants('/transcript?transcript_id=ENST00000000001&annotations_mode=canonical')
+        self.assertEqual(variants[0]['annotations'], {})
+
+    def test_region_annotations_list(self):
+        variants = self.get_variants('/region?chrom=1&start=100&end=200')
+        self.assertEqual([a['Feature'] for a in variants[0]['annotations']], ['ENST00000000001'])
+
+
+if __name__ == '__main__':
+    unittest.main()
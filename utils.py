@@ -180,6 +180,64 @@ class ConsequenceDrilldown(object):
         HGVSs_for_top_csq = sorted({ann['HGVS'] for ann in annotation_drilldowns_for_top_csq if ann.get('HGVS')})
         return gene_symbol_for_top_csq, sorted(HGVSs_for_top_csq)
 
+class AnnotationCodec(object):
+    '''
+    Storage format of `vep_annotations` in a variants collection.
+    Collections loaded with `manage.py variants --compact-annotations` store every annotation as a positional array of values, in the order of the field names
+    kept in db.annotation_fields, and store Consequence as a list of indices into Consequence.csqs. Other collections store annotations as dicts.
+    Everything outside of the database works with dicts, so annotations are decoded right after they are read.
+    '''
+    def __init__(self, fields=None):
+        self.fields = fields
+        self.compact = fields is not None
+        if self.compact:
+            self._indices = {field: i for i, field in enumerate(fields)}
+            self._consequence_index = self._indices['Consequence']
+
+    @staticmethod
+    def load(db, collection):
+        document = db.annotation_fields.find_one({'_id': collection})
+        return AnnotationCodec(document['fields'] if document is not None else None)
+
+    def encode(self, annotation):
+        if not self.compact: return annotation
+        if len(annotation) != len(self.fields):
+            raise Exception('Annotation fields {!r} do not match {!r}.'.format(sorted(annotation), self.fields))
+        values = [annotation[field] for field in self.fields]
+        values[self._consequence_index] = [Consequence.csqidxs[csq] for csq in values[self._consequence_index].split('&')]
+        return values
+
+    def decode(self, values):
+        if not isinstance(values, list): return values # already a dict
+        annotation = dict(zip(self.fields, values))
+        annotation['Consequence'] = '&'.join(Consequence.csqs[csqidx] for csqidx in annotation['Consequence'])
+        return annotation
+
+    def encode_all(self, annotations): return [self.encode(annotation) for annotation in annotations]
+    def decode_all(self, annotations): return [self.decode(annotation) for annotation in annotations]
+
+    def key(self, field):
+        "Name of `field` inside of an annotation, for queries like {'vep_annotations': {'$elemMatch': {codec.key('Gene'): gene_id}}}"
+        return str(self._indices[field]) if self.compact else field
+
+    def consequence_match(self, regex, negate=False):
+        "Query for the annotations whose Consequence matches `regex` (or doesn't, if `negate`). In compact collections every consequence term is matched separately."
+        if not self.compact:
+            return {'Consequence': {'$not': regex} if negate else regex}
+        csqidxs = [csqidx for csqidx, csq in enumerate(Consequence.csqs) if regex.search(csq)]
+        return {self.key('Consequence'): {'$nin' if negate else '$in': csqidxs}}
+
+    def projection(self, fields):
+        "Projection that reads `fields` of every annotation. Positional arrays can't be projected per field, so compact annotations are read whole."
+        if self.compact: return {'vep_annotations': True}
+        return {'vep_annotations.{}'.format(field): True for field in fields}
+
+    def first_annotation_has(self, field, value):
+        "Aggregation expression: True if the most severe annotation of the variant has `field` equal to `value`."
+        if self.compact:
+            return {'$eq': [{'$arrayElemAt': [{'$arrayElemAt': ['$vep_annotations', 0]}, self._indices[field]]}, value]}
+        return {'$in': [{'k': field, 'v': value}, {'$objectToArray': {'$arrayElemAt': ['$vep_annotations', 0]}}]} # works even if the annotation has no such field
+
 class defaultdict_that_passes_key_to_default_factory(dict):
     "A class like collections.defaultdict, but where the default_factory takes the missing key as an argument."
     def __init__(self, default_factory):
@@ -196,6 +254,89 @@ def mkdict(*dicts, **ret):
     for d in dicts: ret.update({k:True for k in d} if isinstance(d, (set,list)) else d)
     return ret
 
+def gzip_chunks(chunks, level=6):
+    "Compresses an iterable of strings into the chunks of a single gzip file, without holding more than one chunk in memory."
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # 16 + MAX_WBITS for a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed: yield compressed
+    yield compressor.flush()
+
+def set_access_token_revocation_epoch(db, revoked_at):
+    "Tells API servers to drop the access tokens they authorized recently, e.g. after a token was revoked or API access was disabled for a user."
+    db.access_token_revocations.replace_one({'_id': 'epoch'}, {'_id': 'epoch', 'revoked_at': revoked_at}, upsert=True)
+
+def get_access_token_revocation_epoch(db):
+    "Time of the latest revocation written by `set_access_token_revocation_epoch`, or None."
+    document = db.access_token_revocations.find_one({'_id': 'epoch'})
+    return document['revoked_at'] if document else None
+
+def get_tabix_contig_sizes(path):
+    "Returns {chrom: size} where no record of the chromosome starts after `size`, estimated from the tabix (.tbi) or CSI (.csi) index of `path`. Empty if `path` has neither."
+    import os
+    if os.path.isfile(path + '.tbi'):
+        return _get_tbi_contig_sizes(path + '.tbi')
+    if os.path.isfile(path + '.csi'):
+        return _get_csi_contig_sizes(path, path + '.csi')
+    return {}
+
+def _get_tbi_contig_sizes(index_path):
+    # size is the end of the last 16 kbp window in the linear index of the chromosome
+    import gzip, struct
+    with gzip.GzipFile(index_path, 'rb') as iz:
+        data = iz.read()
+    if data[:4] != 'TBI\x01':
+        raise Exception('{} is not a tabix index!'.format(index_path))
+    n_ref, _, _, _, _, _, _, l_nm = struct.unpack_from('<8i', data, 4)
+    names = data[36:36 + l_nm].split('\x00')[:n_ref]
+    offset = 36 + l_nm
+    sizes = {}
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        for _ in xrange(n_bin):
+            _, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8 + 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        sizes[name] = n_intv * 16384
+    return sizes
+
+def _get_csi_contig_sizes(path, index_path):
+    # CSI has no linear index, so size is the end of the last bin at the finest level. Records in coarser bins span bin boundaries and start before it.
+    # Chromosome names are stored in the index of tabix'ed files, and in the header of BCF files.
+    import gzip, struct
+    with gzip.GzipFile(index_path, 'rb') as iz:
+        data = iz.read()
+    if data[:4] != 'CSI\x01':
+        raise Exception('{} is not a CSI index!'.format(index_path))
+    min_shift, depth, l_aux = struct.unpack_from('<3i', data, 4)
+    if l_aux >= 28:
+        l_nm, = struct.unpack_from('<i', data, 16 + 24)
+        names = data[16 + 28:16 + 28 + l_nm].split('\x00')
+    else:
+        import pysam
+        with pysam.VariantFile(path) as ifile:
+            names = list(ifile.header.contigs)
+    offset = 16 + l_aux
+    n_ref, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    first_leaf_bin = ((1 << 3 * depth) - 1) // 7
+    pseudo_bin = ((1 << 3 * (depth + 1)) - 1) // 7 + 1
+    sizes = {}
+    for name in names[:n_ref]:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        last_leaf_bin = None
+        for _ in xrange(n_bin):
+            bin_number, _, n_chunk = struct.unpack_from('<IQi', data, offset)
+            offset += 16 + 16 * n_chunk
+            if first_leaf_bin <= bin_number < pseudo_bin - 1 and (last_leaf_bin is None or bin_number > last_leaf_bin):
+                last_leaf_bin = bin_number
+        sizes[name] = (last_leaf_bin - first_leaf_bin + 1) << min_shift if last_leaf_bin is not None else 0
+    return sizes
+
 def clamp(num, min_value, max_value):
     return max(min_value, min(max_value, num))
 